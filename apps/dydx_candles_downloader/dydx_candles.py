@@ -1,85 +1,284 @@
 """
-Script to download the last 2 dydx 1-hour candles every hour and store them into a postgresql db.
+Script to download the last dydx candles and store them into a postgresql db.
+
+Each job of JOBS downloads the candles of one resolution inside its lookback every interval, and saves them into its
+own table. By default only the 1-hour candles are downloaded, every hour. Jobs are staggered by their offset so they do
+not all hit the exchange rate limit at the same time: the jobs without an offset are spread evenly across the shortest
+interval of JOBS (see stagger_jobs). Tables missing are created on start. For example, to download the 5-minute candles
+too (2.5 minutes after the 1-hour ones), add to JOBS:
+    CandleJob(Resolution.MINS_5, "dydx_candles_5mins", timedelta(minutes=5), timedelta(minutes=10))
+The downloader sleeps until the next target and wakes up at once on SIGINT/SIGTERM. If targets are missed (for example,
+because a cycle took longer than an interval), the next cycle also downloads the candles since the last one (up to
+MAX_CATCH_UP). The delay between each target and the actual start of its cycle is logged as scheduling lag.
+Every GAP_SCAN_INTERVAL, the candles missing in the last GAP_SCAN_LOOKBACK of each job (for example, from a failed
+cycle) are downloaded again.
+If ARCHIVE_RESPONSES = True the raw candle pages downloaded are saved on ARCHIVE_FOLDER (see reingest.py).
+If METRICS_PORT is not None, the metrics of the downloader (latency of each stage, rows per cycle, requests and 429s per
+market, scheduling lag, db pool usage and upserted rows) are served in the Prometheus format on
+http://127.0.0.1:METRICS_PORT/metrics. They are not authenticated: set the env var DYDX_METRICS_HOST to serve them on
+another address (docker-compose.yml sets 0.0.0.0 and publishes the port on the localhost of the host only).
+If the env var DYDX_PROFILE=1 is set, the cycle number DYDX_PROFILE_CYCLE (1 by default) is profiled and the profile is
+saved on ./data/profiles (see utils/profiling.py).
 
 Db credentials are pulled from ./credentials/db_credentials.py.
 
 Use setup.py before running this code to create the table inside the db and fill the table with historical data (if desired, check setup.py for more info).
 """
 
+import asyncio
 import signal
+import threading
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta, timezone
-from time import sleep
 
 from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.backfill import repair_gaps
 from utils.db_connector import DatabaseConnector
-from utils.dydx_client import DydxClient
+from utils.db_schema import (
+    create_candles_indexes,
+    create_candles_table,
+    create_month_partitions,
+    is_compact,
+    is_partitioned,
+    month_start,
+)
+from utils.dydx_client import RESOLUTION_DELTAS, DydxClient, Resolution
 from utils.logger import setup_logger
+from utils.metrics import METRICS, metrics_host
+from utils.profiling import Profile, profile_cycle, profile_stage, profiling_enabled
+from utils.response_archive import ResponseArchive
+
+
+@dataclass(frozen=True)
+class CandleJob:
+    """
+    Download job of the candles of one resolution.
+
+    Every interval (shifted by offset), the candles of resolution between now - lookback and now are downloaded and
+    upserted into table_name, so the last candles are overwritten until they are closed. If offset is None, it is set by
+    stagger_jobs.
+    """
 
-TABLE_NAME = "dydx_candles"
+    resolution: str
+    table_name: str
+    interval: timedelta
+    lookback: timedelta
+    offset: timedelta = None
 
 
-def next_target(target_interval: int = 3600) -> datetime:
+### SETTINGS ###
+JOBS = [
+    CandleJob(Resolution.HOURS_1, "dydx_candles", interval=timedelta(hours=1), lookback=timedelta(hours=2)),
+]
+GAP_SCAN_INTERVAL = timedelta(hours=6)
+GAP_SCAN_LOOKBACK = timedelta(days=3)
+PARTITION_MONTHS_AHEAD = 2
+MAX_CATCH_UP = timedelta(days=1)
+ARCHIVE_RESPONSES = False
+ARCHIVE_FOLDER = "./data/archive"
+METRICS_PORT = 9100
+
+
+def next_target(target_interval: int = 3600, offset: int = 0) -> datetime:
     now = datetime.utcnow().replace(tzinfo=timezone.utc)
-    next_target = now + timedelta(seconds=target_interval - now.timestamp() % target_interval)
+    next_target = now + timedelta(seconds=target_interval - (now.timestamp() - offset) % target_interval)
     return next_target
 
 
+def stagger_jobs(jobs: list) -> list:
+    """Returns jobs with the offset of the jobs without one spread evenly across the shortest interval: the i-th of n
+    jobs is shifted by i * shortest interval / n, so the first one runs on the interval boundary.
+    """
+    shortest_interval = min(job.interval for job in jobs)
+    return [
+        job if job.offset is not None else replace(job, offset=i * shortest_interval / len(jobs))
+        for i, job in enumerate(jobs)
+    ]
+
+
+def job_target(job: CandleJob) -> datetime:
+    return next_target(job.interval.total_seconds(), job.offset.total_seconds())
+
+
 class DxdxCandleDownloader:
-    def __init__(self, logger=None):
-        self.logger = logger if logger else setup_logger(name=f"{TABLE_NAME}_downloader", folder_path=".//data")
+    def __init__(self, logger=None, jobs: list = None):
+        self.logger = logger if logger else setup_logger(name="dydx_candles_downloader", folder_path=".//data")
         self.running: bool = False
+        self.stop_event = threading.Event()
+        self.jobs = stagger_jobs(jobs if jobs else JOBS)
+
+        # Seconds between the last target of each table and the start of its cycle
+        self.scheduling_lag = {}
 
         # Initialize the exchange and db clients
-        self.exchange_client = DydxClient(self.logger)
-        self.db_client = DatabaseConnector(DB_CREDENTIALS, self.logger)
+        archive = ResponseArchive(ARCHIVE_FOLDER) if ARCHIVE_RESPONSES else None
+        self.exchange_client = DydxClient(self.logger, archive=archive)
+        self.db_client = DatabaseConnector(DB_CREDENTIALS, self.logger, pooled=True)
+
+        # Partitioned tables, the partitions must exist before inserting the candles
+        self.partitioned = {}
+
+        METRICS.add_collector(self.pool_metrics)
+
+    def pool_metrics(self) -> list:
+        """Returns the db pool stats as (name, value, labels) gauges for METRICS."""
+        return [(f"db_pool_{name}", value, {}) for name, value in self.db_client.pool_stats().items()]
+
+    def setup_tables(self) -> bool:
+        """Creates the tables of the jobs if missing. Returns True if all tables are ready."""
+        for job in self.jobs:
+            partitioned = is_partitioned(self.db_client, job.table_name)
+            compact = is_compact(self.db_client, job.table_name)
+            if create_candles_table(self.db_client, job.table_name, partitioned, compact) != "CREATE TABLE":
+                self.logger.error(f"Something happened creating the {job.table_name} table.")
+                return False
+            if create_candles_indexes(self.db_client, job.table_name, partitioned, compact) != "CREATE INDEX":
+                self.logger.error(f"Something happened creating the {job.table_name} index.")
+                return False
+
+            # Updates the indexes of the rollup tables too, as insert_candles upserts them
+            for rollup_table_name, _ in self.db_client.get_rollup_tables(job.table_name):
+                if create_candles_indexes(self.db_client, rollup_table_name) != "CREATE INDEX":
+                    self.logger.error(f"Something happened creating the {rollup_table_name} index.")
+                    return False
+
+            self.partitioned[job.table_name] = partitioned
+
+        return True
+
+    def stop(self):
+        """Stops the downloader. It wakes up at once if waiting, a cycle already started is finished first."""
+        self.running = False
+        self.stop_event.set()
+
+    def run_job(self, job: CandleJob, markets_list: list, time_now: datetime, last_end: datetime = None) -> datetime:
+        """Downloads the candles of job inside its lookback and saves them. Returns the end date of the download.
+
+        If last_end (the end date of the previous download) is before the lookback, the candles since last_end are
+        downloaded too, so missed targets are caught up.
+        """
+        # Gets the start time of the last candle and the start time. It downloads the previous candles too to overwrite
+        # them and ensure they are up to date
+        candle_seconds = RESOLUTION_DELTAS[job.resolution].total_seconds()
+        end = datetime.fromtimestamp(time_now.timestamp() // candle_seconds * candle_seconds, tz=timezone.utc)
+        start = end - job.lookback
+        if last_end is not None:
+            start = min(start, max(last_end, end - MAX_CATCH_UP))
+
+        # Download candles from the exchange
+        download_start = datetime.now().replace(tzinfo=timezone.utc)
+        with profile_stage("download"):
+            candles = self.exchange_client.get_all_markets_candles(markets_list, start, end, job.resolution)
+        download_end = datetime.now().replace(tzinfo=timezone.utc)
+        METRICS.observe("stage_seconds", (download_end - download_start).total_seconds(), stage="download")
+        METRICS.set("cycle_rows", len(candles), table=job.table_name)
+        METRICS.inc("rows_total", len(candles), table=job.table_name)
+
+        # Creates the partitions of the next months if missing
+        if self.partitioned[job.table_name]:
+            with profile_stage("partitions"):
+                create_month_partitions(self.db_client, job.table_name, end, month_start(end, PARTITION_MONTHS_AHEAD))
+
+        # Saves candle data inside the db
+        save_start = datetime.now().replace(tzinfo=timezone.utc)
+        with profile_stage("save"):
+            self.db_client.insert_candles(job.table_name, candles)
+        save_end = datetime.now().replace(tzinfo=timezone.utc)
+
+        self.logger.debug(
+            f"{job.table_name}: Download time: {download_end-download_start}. Save time: {save_end-save_start}."
+        )
+
+        return end
 
     def run(self):
         self.logger.info("Program start.")
+        if not self.setup_tables():
+            self.db_client.close()
+            return
         self.running = True
 
-        target = next_target()
-        self.logger.info(f"Waiting for target: {target}")
+        if METRICS_PORT is not None:
+            METRICS.serve(METRICS_PORT)
+            self.logger.info(f"Serving metrics on {metrics_host()}:{METRICS_PORT}.")
+
+        targets = {job: job_target(job) for job in self.jobs}
+        next_gap_scans = dict(targets)
+        last_ends = {}
+        cycles = 0
+        for job, target in targets.items():
+            self.logger.info(f"{job.table_name}: Waiting for target: {target}")
 
         while self.running:
             time_now = datetime.utcnow().replace(tzinfo=timezone.utc)
-            if time_now >= target:
-                self.logger.info(f"Target reached.")
+            due_jobs = sorted([job for job, target in targets.items() if time_now >= target], key=targets.get)
+            if due_jobs:
+                # Downloading online markets, once for all the jobs due
+                with METRICS.time("stage_seconds", stage="market_list"):
+                    markets_list = self.exchange_client.get_online_markets()
+
+            for job in due_jobs:
+                if not self.running:
+                    break
 
-                # Gets start (current) time and start time.
-                # It will download the las 2 candles to overwrite the previous one to ensure is up to date
-                end = time_now.replace(minute=0, second=0, microsecond=0)
-                start = end - timedelta(hours=2)
+                time_now = datetime.utcnow().replace(tzinfo=timezone.utc)
+                lag = time_now - targets[job]
+                self.scheduling_lag[job.table_name] = lag.total_seconds()
+                METRICS.set("cycle_lag_seconds", lag.total_seconds(), table=job.table_name)
+                self.logger.info(f"{job.table_name}: Target reached. Scheduling lag: {lag.total_seconds():.3f}s.")
 
-                # Downloading online markets
-                markets_list = self.exchange_client.get_online_markets()
+                cycles += 1
+                profile = None
+                if profiling_enabled() and cycles == profile_cycle():
+                    profile = Profile(f"cycle_{cycles}_{job.table_name}", logger=self.logger)
+                    profile.start()
 
-                # Download candles from the exchange
-                download_start = datetime.now().replace(tzinfo=timezone.utc)
-                candles = self.exchange_client.get_all_markets_candles(markets_list, start, end)
-                download_end = datetime.now().replace(tzinfo=timezone.utc)
+                with METRICS.time("cycle_seconds", table=job.table_name):
+                    end = self.run_job(job, markets_list, time_now, last_ends.get(job))
+                last_ends[job] = end
 
-                # Saves candle data inside the db
-                save_start = datetime.now().replace(tzinfo=timezone.utc)
-                self.db_client.insert_candles(TABLE_NAME, candles)
-                save_end = datetime.now().replace(tzinfo=timezone.utc)
+                if profile:
+                    profile.stop()
 
-                target = next_target()
+                # Targets skipped while waiting or running are caught up by the next cycle (see run_job)
+                target = job_target(job)
+                missed_targets = (target - targets[job]) // job.interval - 1
+                if missed_targets > 0:
+                    METRICS.inc("missed_targets_total", missed_targets, table=job.table_name)
+                    self.logger.warning(f"{job.table_name}: {missed_targets} targets missed, catching up next cycle.")
+                targets[job] = target
 
-                self.logger.debug(f"Download time: {download_end-download_start}. Save time: {save_end-save_start}.")
+                # Downloads the candles missed by previous cycles
+                if time_now >= next_gap_scans[job]:
+                    asyncio.run(
+                        repair_gaps(
+                            self.exchange_client,
+                            self.db_client,
+                            job.table_name,
+                            since=end - GAP_SCAN_LOOKBACK,
+                            resolution=job.resolution,
+                        )
+                    )
+                    next_gap_scans[job] = time_now + GAP_SCAN_INTERVAL
 
-                self.logger.info(f"Waiting for target: {target}")
+                self.logger.info(f"{job.table_name}: Waiting for target: {targets[job]}")
 
-            sleep(0.1)
+            # Sleeps until the next target, or until stop is called
+            wait = min(targets.values()) - datetime.utcnow().replace(tzinfo=timezone.utc)
+            self.stop_event.wait(max(wait.total_seconds(), 0))
 
+        METRICS.close()
+        self.db_client.close()
         self.logger.info("Program end.")
 
 
 def main():
     def signal_handler(signum, frame):
-        client.running = False
+        client.stop()
         client.logger.info("Ending program. Waiting for cycle to finish...")
 
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     client = DxdxCandleDownloader()
     client.run()
@@ -7,6 +7,7 @@ import pandas as pd
 
 # Import the credentials and the db client
 from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.candles_cache import CandlesCache
 from utils.db_connector import DatabaseConnector
 
 # Initialize the client
@@ -23,3 +24,10 @@ market_list = ["ADA-USD", "BTC-USD", "ETH-USD"]
 candles = db_client.get_candles(market_list, start, end, to_file=True, file_path="./dydx_candles.pkl")
 
 print(candles)
+
+# Import the data using a local cache
+# The candles are saved on ./data/candles_cache, and the next calls only download from the DB the candles not cached
+cache = CandlesCache(db_client)
+candles = cache.get_candles(market_list, start, end)
+
+print(candles)
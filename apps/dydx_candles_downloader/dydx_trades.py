@@ -0,0 +1,67 @@
+"""
+Script to build the last dydx candles in real time from the trades stream and store them into a postgresql db.
+
+The public trades of the ONLINE markets (or only MARKETS, if not None) are received from the dYdX v3 websocket and
+aggregated into candles of RESOLUTION, which are upserted into TABLE_NAME every FLUSH_INTERVAL seconds (see
+utils/dydx_websocket.py). The candle in progress can be read from the db within seconds, instead of after the next
+cycle of dydx_candles.py.
+
+Run it next to dydx_candles.py, not instead of it: the first candle after each (re)connection is not built, and trades
+missed are not received again. The downloader overwrites the last candles with the ones of the exchange every cycle, so
+it reconciles them.
+If RECORD_PATH is not None, the messages received are appended to it, to be replayed by
+benchmarks/fake_dydx_websocket.py.
+If METRICS_PORT is not None, the metrics of the collector (messages, trades, bars saved, reconnections and lag of the
+stream) are served in the Prometheus format on http://127.0.0.1:METRICS_PORT/metrics (see DYDX_METRICS_HOST in
+dydx_candles.py to serve them on another address).
+
+Db credentials are pulled from ./credentials/db_credentials.py.
+
+Use setup.py before running this code to create the table inside the db.
+"""
+
+import asyncio
+import signal
+
+from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.db_connector import DatabaseConnector
+from utils.dydx_client import Resolution
+from utils.dydx_websocket import DydxTradesCollector
+from utils.logger import setup_logger
+from utils.metrics import METRICS, metrics_host
+
+### SETTINGS ###
+TABLE_NAME = "dydx_candles"
+RESOLUTION = Resolution.HOURS_1
+MARKETS = None
+FLUSH_INTERVAL = 10.0
+RECORD_PATH = None
+METRICS_PORT = 9101
+
+
+def main():
+    def signal_handler(signum, frame):
+        collector.stop()
+        logger.info("Ending program. Saving the candles in progress...")
+
+    logger = setup_logger(name="dydx_trades_collector", folder_path=".//data", file_name="trades_logs.log")
+    db_client = DatabaseConnector(DB_CREDENTIALS, logger, pooled=True)
+    collector = DydxTradesCollector(
+        db_client, logger, TABLE_NAME, RESOLUTION, MARKETS, flush_interval=FLUSH_INTERVAL, record_path=RECORD_PATH
+    )
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    if METRICS_PORT is not None:
+        METRICS.serve(METRICS_PORT)
+        logger.info(f"Serving metrics on {metrics_host()}:{METRICS_PORT}.")
+
+    asyncio.run(collector.run())
+
+    METRICS.close()
+    db_client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+reingest.py for dydx_candle.py
+
+Rebuilds the candles of a table from the raw exchange responses archived by setup.py and dydx_candles.py (with
+ARCHIVE_RESPONSES = True), without any request to the exchange. Use it after a schema change or a parsing fix.
+
+The archived pages of MARKETS (all if None) and RESOLUTION between START_DATE and END_DATE (no limit if None) are read
+in the order they were received, formatted with the same code as the downloads, and upserted into TABLE_NAME in
+batches of at least BATCH_SIZE candles. A candle received several times keeps the values of the last one received.
+The table must exist (run setup.py first, with IMPORT_HISTORICAL_CANDLES = False to skip the download).
+"""
+
+from time import perf_counter
+
+from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.db_connector import DatabaseConnector
+from utils.db_schema import table_exists
+from utils.dydx_client import Resolution, format_candles
+from utils.logger import setup_logger
+from utils.response_archive import ResponseArchive
+
+ARCHIVE_FOLDER = "./data/archive"
+TABLE_NAME = "dydx_candles"
+RESOLUTION = Resolution.HOURS_1
+MARKETS = None
+START_DATE = None
+END_DATE = None
+BATCH_SIZE = 100000
+
+
+def reingest(logger=None) -> int:
+    """Upserts the archived candles into TABLE_NAME. Returns the number of candles saved."""
+    logger = logger if logger else setup_logger(name="db_client_logger", debug_level="DEBUG")
+    logger.info(f"Re-ingesting archived candles from {ARCHIVE_FOLDER} into {TABLE_NAME} table.")
+
+    db_client = DatabaseConnector(DB_CREDENTIALS, logger, pooled=True)
+    if not table_exists(db_client, TABLE_NAME):
+        logger.error(f"Table {TABLE_NAME} does not exist, run setup.py first. Exiting.")
+        db_client.close()
+        return 0
+
+    archive = ResponseArchive(ARCHIVE_FOLDER)
+    pages = archive.find_pages(MARKETS, RESOLUTION, START_DATE, END_DATE)
+    logger.info(f"{len(pages)} archived pages found.")
+
+    time_start = perf_counter()
+    total_candles, failed_candles = 0, 0
+    records = []
+    for i, entry in enumerate(pages):
+        records += archive.read_page(entry)
+        if len(records) < BATCH_SIZE and i < len(pages) - 1:
+            continue
+
+        candles_data = format_candles(records)
+        if START_DATE is not None:
+            candles_data = candles_data[candles_data["date"] >= START_DATE]
+        if END_DATE is not None:
+            candles_data = candles_data[candles_data["date"] <= END_DATE]
+
+        if db_client.insert_candles(TABLE_NAME, candles_data) == "":
+            failed_candles += len(candles_data)
+        else:
+            total_candles += len(candles_data)
+        records = []
+
+        logger.debug(
+            f"Re-ingest progress: {i + 1}/{len(pages)} pages, {total_candles} candles, "
+            f"{total_candles / (perf_counter() - time_start):.0f} candles/s."
+        )
+
+    if failed_candles:
+        logger.error(f"Unable to save {failed_candles} candles.")
+    logger.info(f"Re-ingest complete. {total_candles} candles saved. Upserts: {db_client.upsert_counts}.")
+
+    db_client.close()
+
+    return total_candles
+
+
+def main():
+    reingest()
+
+
+if __name__ == "__main__":
+    main()
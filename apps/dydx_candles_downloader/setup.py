@@ -4,23 +4,79 @@ setup.py for dydx_candle.py
 Run this program before dydx_candle.py to set up the table in the database.
 
 If IMPORT_HISTORICAL_CANDLES == True, this program will download and save historical data.
+The history of each market starts at its first candle (from ./data/config.py) and is downloaded in concurrent
+100-candle windows, which are saved as soon as they are downloaded.
 If DELETE_PREVIOUS_DATA = True it will delete all previous data before importing the new data. If false no data will be imported.
+If INCREMENTAL_BACKFILL = True (and DELETE_PREVIOUS_DATA = False) only the candles missing before and after the data
+already present are imported. The progress is saved on a checkpoint table, so an interrupted backfill is resumed
+where it stopped on the next run.
+If REPAIR_GAPS = True the candles missing between the saved candles are downloaded again at the end of the setup. Only
+the candles after the ones scanned by the previous setup are scanned (see utils.backfill.repair_gaps).
+If PARTITIONED_TABLE = True the table is partitioned by month, with a BRIN index on date. dydx_candles.py creates the
+next months partitions ahead of time. Old months can be removed with utils.db_schema.detach_month_partition.
+If COMPACT_TABLE = True markets and resolutions are stored as smallint ids of lookup tables, without id column, so the
+table and its index are much smaller. Reads and writes through DatabaseConnector are not affected.
+An existing table without the selected schema is migrated (the previous one is kept as {TABLE_NAME}_previous).
+If CREATE_ROLLUPS = True the 4HOURS and 1DAY rollup tables ({TABLE_NAME}_4hours and {TABLE_NAME}_1day) are created and
+filled from the 1-hour candles. After that, every insert of 1-hour candles updates them.
+If ARCHIVE_RESPONSES = True the raw candle pages downloaded are saved on ARCHIVE_FOLDER, so the table can be rebuilt
+later without the exchange (see reingest.py).
+If the env var DYDX_PROFILE=1 is set, the whole setup is profiled and the profile is saved on ./data/profiles (see
+utils/profiling.py).
 """
 
+import asyncio
 from datetime import datetime, timezone
 
 import pandas as pd
 
 from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from data.config import DYDX_CANDLES_FIRST
+from utils.backfill import (
+    clear_checkpoints,
+    create_checkpoint_table,
+    get_checkpoints,
+    plan_backfill,
+    repair_gaps,
+    run_backfill,
+    save_checkpoints,
+)
 from utils.db_connector import DatabaseConnector
+from utils.db_schema import (
+    create_candles_indexes,
+    create_candles_table,
+    create_month_partitions,
+    create_rollup_tables,
+    is_compact,
+    is_partitioned,
+    migrate_candles_table,
+    month_start,
+    table_exists,
+)
 from utils.dydx_client import DydxClient
 from utils.logger import setup_logger
+from utils.profiling import Profile, profile_stage, profiling_enabled
+from utils.response_archive import ResponseArchive
 
 IMPORT_HISTORICAL_CANDLES = True
-DELETE_PREVIOUS_DATA = True
+DELETE_PREVIOUS_DATA = False
+INCREMENTAL_BACKFILL = True
+REPAIR_GAPS = True
+PARTITIONED_TABLE = False
+COMPACT_TABLE = False
+PARTITION_MONTHS_AHEAD = 2
+CREATE_ROLLUPS = True
+ARCHIVE_RESPONSES = False
+ARCHIVE_FOLDER = "./data/archive"
 
 EXCHANGE_START_DATE = datetime(2020, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
 TABLE_NAME = "dydx_candles"
+MAX_CONCURRENCY = 20
+
+FIRST_CANDLES = {
+    market: datetime.strptime(first_candle, "%Y-%m-%d %H:%M:%S%z")
+    for market, first_candle in DYDX_CANDLES_FIRST.items()
+}
 
 
 def setup(logger=None):
@@ -28,47 +84,77 @@ def setup(logger=None):
     logger.info("Starting setup for dydx_candle.py")
 
     # Initialize clients
-    db_client = DatabaseConnector(DB_CREDENTIALS, logger)
-    exchange_client = DydxClient(logger)
+    db_client = DatabaseConnector(DB_CREDENTIALS, logger, pooled=True)
+    exchange_client = DydxClient(logger, archive=ResponseArchive(ARCHIVE_FOLDER) if ARCHIVE_RESPONSES else None)
+
+    # Moves the candles of an existing table into a new table if it has not the selected schema
+    partitioned = is_partitioned(db_client, TABLE_NAME)
+    compact = is_compact(db_client, TABLE_NAME)
+    if table_exists(db_client, TABLE_NAME) and (
+        (PARTITIONED_TABLE and not partitioned) or (COMPACT_TABLE and not compact)
+    ):
+        partitioned, compact = PARTITIONED_TABLE or partitioned, COMPACT_TABLE or compact
+        logger.info(f"Migrating {TABLE_NAME} table (partitioned: {partitioned}, compact: {compact})...")
+        if not migrate_candles_table(db_client, TABLE_NAME, partitioned, compact, PARTITION_MONTHS_AHEAD):
+            logger.error("Something happened migrating the table, exiting.")
+            return
+        logger.info(f"Table migrated. The previous table is kept as {TABLE_NAME}_previous.")
+
+    partitioned = PARTITIONED_TABLE or partitioned
+    compact = COMPACT_TABLE or compact
 
     # Create candles table
-    sql = f"""
-        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-            id BIGSERIAL PRIMARY KEY,
-            date TIMESTAMP WITH TIME ZONE,
-            updated TIMESTAMP WITH TIME ZONE,
-            market TEXT,
-            resolution TEXT,
-            open_price REAL,
-            close_price REAL,
-            high_price REAL,
-            low_price REAL,
-            volume REAL
-        );
-    """
-    msg = db_client.send_request(sql)
+    msg = create_candles_table(db_client, TABLE_NAME, partitioned, compact)
     if msg != "CREATE TABLE":
         logger.error(msg)
         logger.error("Something happened creating the table, exiting.")
         return
     logger.info("Candle table created/already exist.")
 
+    # Create the month partitions, from the exchange start to PARTITION_MONTHS_AHEAD months from now
+    if partitioned:
+        partitions_end = month_start(datetime.now(timezone.utc), PARTITION_MONTHS_AHEAD)
+        msg = create_month_partitions(db_client, TABLE_NAME, EXCHANGE_START_DATE, partitions_end)
+        if msg != "CREATE TABLE":
+            logger.error(msg)
+            logger.error("Something happened creating the partitions, exiting.")
+            return
+        logger.info("Candle partitions created/already exist.")
+
     # Set up indexes for candles table
-    sql = f"""
-        CREATE UNIQUE INDEX IF NOT EXISTS {TABLE_NAME}_idx_date_market 
-            ON {TABLE_NAME} (date, market);
-    """
-    msg = db_client.send_request(sql)
+    msg = create_candles_indexes(db_client, TABLE_NAME, partitioned, compact)
     if msg != "CREATE INDEX":
         logger.error(msg)
         logger.error("Something happened creating the index, exiting.")
         return
     logger.info("Candle index created/already exist.")
 
+    # Create rollup tables, filled from the current candles the first time
+    if CREATE_ROLLUPS:
+        rollups_exist = bool(db_client.get_rollup_tables(TABLE_NAME))
+        msg = create_rollup_tables(db_client, TABLE_NAME)
+        if msg != "CREATE INDEX":
+            logger.error(msg)
+            logger.error("Something happened creating the rollup tables, exiting.")
+            return
+        logger.info("Rollup tables created/already exist.")
+
+        if not rollups_exist:
+            logger.info("Filling rollup tables...")
+            db_client.refresh_rollups(TABLE_NAME)
+
+    # Create backfill checkpoint table
+    msg = create_checkpoint_table(db_client)
+    if msg != "CREATE TABLE":
+        logger.error(msg)
+        logger.error("Something happened creating the checkpoint table, exiting.")
+        return
+    logger.info("Checkpoint table created/already exist.")
+
     # Checks for previous data inside the table
     sql = f"""
         SELECT market, MIN(date) as first_candle, MAX(date) as last_candle
-        FROM {TABLE_NAME}
+        FROM {db_client.get_candles_source(TABLE_NAME)} AS candles
         GROUP BY market;
     """
     data = db_client.send_query(sql)
@@ -79,8 +165,12 @@ def setup(logger=None):
     if IMPORT_HISTORICAL_CANDLES:
         # With previous data present:
         if bool(data):
+            # Keep current data and import only the missing candles
+            if not DELETE_PREVIOUS_DATA and INCREMENTAL_BACKFILL:
+                logger.info("Previous data is present. Importing only the missing data.")
+
             # DO nothing
-            if not DELETE_PREVIOUS_DATA:
+            elif not DELETE_PREVIOUS_DATA:
                 logger.info("Previous data is present. Keeping current data.")
                 logger.info("Setup complete.")
                 return
@@ -88,13 +178,17 @@ def setup(logger=None):
             # Erase all data
             else:
                 logger.info("Previous data is present. Erasing previous data.")
-                sql = f"""TRUNCATE TABLE {TABLE_NAME} RESTART IDENTITY;"""
+                tables_str = ", ".join([TABLE_NAME] + [table for table, _ in db_client.get_rollup_tables(TABLE_NAME)])
+                sql = f"""TRUNCATE TABLE {tables_str} RESTART IDENTITY;"""
                 msg = db_client.send_request(sql)
                 if msg != "TRUNCATE TABLE":
                     logger.error(msg)
                     logger.error("Something happened erasing the table, exiting.")
                     return
                 logger.info(f"Table {TABLE_NAME} truncated.")
+
+                clear_checkpoints(db_client, TABLE_NAME)
+                data = {}
         else:
             logger.info("No previous data found")
 
@@ -110,25 +204,50 @@ def setup(logger=None):
 
         logger.info(f"Downloading candle date between {EXCHANGE_START_DATE} and {end_date}...")
 
-        # Downloads the historical candles for each market
-        download_time = datetime.now()
-        candles_data = exchange_client.get_all_markets_candles(markets_list, EXCHANGE_START_DATE, end_date)
-        logger.debug(f"Data downloaded in {datetime.now() - download_time}")
-        logger.info("All candle data downloaded.")
-
-        logger.info(f"Saving candle date into dydx_candle table...")
-        insert_time = datetime.now()
-        db_client.insert_candles(table_name="dydx_candles", candles_data=candles_data)
+        with profile_stage("plan"):
+            # Gets the ranges already downloaded. Data saved without checkpoints (by a previous version or by
+            # dydx_candles.py) is assumed complete between its first and last candle.
+            covered = get_checkpoints(db_client, TABLE_NAME)
+            unchecked = [
+                (market, market_data["first_candle"], market_data["last_candle"])
+                for market, market_data in data.items()
+                if market not in covered
+            ]
+            save_checkpoints(db_client, TABLE_NAME, unchecked)
+            covered.update({market: [(first_candle, last_candle)] for market, first_candle, last_candle in unchecked})
+
+            # Splits the missing history of each market into windows of one request each
+            plan = plan_backfill(
+                markets_list, EXCHANGE_START_DATE, end_date, first_candles=FIRST_CANDLES, covered=covered
+            )
+        logger.info(f"Downloading {len(plan)} windows and saving them into {TABLE_NAME} table...")
+
+        # Downloads the windows concurrently and saves each one when finished
+        with profile_stage("backfill"):
+            total_candles = asyncio.run(
+                run_backfill(
+                    exchange_client, db_client, TABLE_NAME, plan, max_concurrency=MAX_CONCURRENCY, checkpoint=True
+                )
+            )
+        logger.info(f"All candle data downloaded. {total_candles} candles saved.")
 
-        logger.debug(f"Save the downloaded data to the db took {datetime.now() - insert_time}.")
         logger.debug(f"Total time to download and save candle data to the db: {datetime.now() - debug_time}.")
 
+    if REPAIR_GAPS:
+        logger.info(f"Looking for gaps in {TABLE_NAME} table...")
+        with profile_stage("repair_gaps"):
+            asyncio.run(repair_gaps(exchange_client, db_client, TABLE_NAME, max_concurrency=MAX_CONCURRENCY))
+
     logger.info("Setup complete.")
     return
 
 
 def main():
-    setup()
+    if profiling_enabled():
+        with Profile("setup"):
+            setup()
+    else:
+        setup()
 
 
 if __name__ == "__main__":
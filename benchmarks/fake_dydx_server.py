@@ -0,0 +1,191 @@
+"""
+Local fake of the dYdX v3 public REST api, used by the benchmarks to measure the clients without hitting the exchange.
+
+Only the endpoints used by DydxClient are served:
+    /v3/markets                 number_of_markets ONLINE markets (BTC-USD, M001-USD, M002-USD...)
+    /v3/candles/{market}        synthetic candles from fromISO to before toISO, newest first, like the exchange
+
+Every market has a candle at each step of the resolution since first_candle. The prices only depend on the market and
+the date, so repeated downloads return the same candles.
+
+Knobs:
+    latency         seconds slept before answering each request
+    page_size       max candles per response (the limit sent by the client is also respected)
+    rate_429        fraction of the candle requests answered with 429 (Too Many Requests)
+
+Point a client at it with DydxClient(host=server.host). Run standalone from the project root:
+
+python -m benchmarks.fake_dydx_server
+"""
+
+import json
+import random
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from utils.dydx_client import CANDLES_PER_REQUEST, RESOLUTION_DELTAS
+
+### SETTINGS ###
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+def market_names(number_of_markets: int) -> list:
+    return ["BTC-USD"] + [f"M{i:03d}-USD" for i in range(1, number_of_markets)]
+
+
+class FakeDydxServer:
+    """
+    Fake dYdX public api served from a background thread. Use it as a context manager, or call start and stop.
+
+    The knobs can be changed while the server is running.
+    """
+
+    def __init__(
+        self,
+        host: str = HOST,
+        port: int = PORT,
+        latency: float = 0.0,
+        page_size: int = CANDLES_PER_REQUEST,
+        number_of_markets: int = 10,
+        rate_429: float = 0.0,
+        first_candle: datetime = datetime(2021, 1, 1, tzinfo=timezone.utc),
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.page_size = page_size
+        self.markets = market_names(number_of_markets)
+        self.rate_429 = rate_429
+        self.first_candle = first_candle
+        self.random = random.Random(seed)
+
+        # Requests answered, by status
+        self.requests = {200: 0, 400: 0, 404: 0, 429: 0}
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def host(self) -> str:
+        return f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake_dydx_server", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = {status: 0 for status in self.requests}
+
+    def candle(self, market: str, date: datetime, resolution: str) -> dict:
+        """Returns the raw candle of market starting at date."""
+        step = int(date.timestamp() // RESOLUTION_DELTAS[resolution].total_seconds())
+        price = 100 + self.markets.index(market) + step % 50
+        date_str = date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+        return {
+            "startedAt": date_str,
+            "updatedAt": date_str,
+            "market": market,
+            "resolution": resolution,
+            "low": str(price - 1.5),
+            "high": str(price + 1.5),
+            "open": str(price - 0.5),
+            "close": str(price + 0.5),
+            "baseTokenVolume": "1234.5",
+            "trades": "42",
+            "usdVolume": str(1234.5 * price),
+            "startingOpenInterest": "98765.4",
+        }
+
+    def candles(self, market: str, query: dict) -> dict:
+        """Returns the candles answer of the exchange: the last candles started between fromISO and toISO."""
+        resolution = query.get("resolution", "1DAY")
+        delta = RESOLUTION_DELTAS[resolution]
+        limit = min(int(query.get("limit", CANDLES_PER_REQUEST)), self.page_size)
+        to_date = pd.Timestamp(query["toISO"], tz="UTC") if "toISO" in query else pd.Timestamp.now(tz="UTC")
+        from_date = pd.Timestamp(query["fromISO"], tz="UTC") if "fromISO" in query else self.first_candle
+
+        # Last candle started before toISO, going back until fromISO or the first candle
+        end = (to_date - pd.Timedelta(microseconds=1)).floor(delta).to_pydatetime()
+        start = max(from_date, self.first_candle)
+        dates = pd.date_range(end=end, periods=limit, freq=delta)[::-1]
+
+        return {"candles": [self.candle(market, date, resolution) for date in dates if date >= start]}
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections, like the exchange
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                # The body sent by the client is discarded, so the next request of the connection can be read
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                sleep(server.latency)
+
+                url = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                parts = url.path.strip("/").split("/")
+
+                if parts == ["v3", "markets"]:
+                    status, body = 200, {"markets": {m: {"market": m, "status": "ONLINE"} for m in server.markets}}
+                elif parts[:2] == ["v3", "candles"] and len(parts) == 3:
+                    with server.lock:
+                        throttled = server.random.random() < server.rate_429
+                    if parts[2] not in server.markets:
+                        status, body = 400, {"errors": [{"msg": f"{parts[2]} is not a valid market"}]}
+                    elif throttled:
+                        status, body = 429, {"errors": [{"msg": "Too many requests"}]}
+                    else:
+                        status, body = 200, server.candles(parts[2], query)
+                else:
+                    status, body = 404, {"errors": [{"msg": "Not found"}]}
+
+                with server.lock:
+                    server.requests[status] += 1
+
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    with FakeDydxServer() as server:
+        print(f"Fake dYdX api listening on {server.host}. Ctrl+C to stop.")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Local fake of the dYdX v3 public websocket, that replays recorded messages. Used to check and measure
+DydxTradesCollector (utils/dydx_websocket.py) without connecting to the exchange.
+
+Messages are JSON lines, as recorded by DydxTradesCollector(record_path=...), or generated by synthetic_messages. On each
+connection to ws://host:port/v3/ws:
+    subscribe v3_markets                the recorded markets snapshot is sent (by default, every market recorded, ONLINE)
+    subscribe v3_trades, id=market      the recorded trades snapshot of market is sent (by default, the first recorded
+                                        trade of market)
+Once every market recorded is subscribed (or after subscribe_timeout seconds), the recorded trades updates of the
+markets subscribed are sent in the recorded order, waiting delay seconds between them, and replayed is set. The
+connection is kept open until the client closes it or the server is stopped.
+
+Point a collector at it with DydxTradesCollector(host=server.url). Run standalone from the project root, replaying a
+recording or synthetic trades:
+
+python -m benchmarks.fake_dydx_websocket [recording.jsonl]
+"""
+
+import asyncio
+import json
+import random
+import socket
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import WSMsgType, web
+
+from benchmarks.fake_dydx_server import market_names
+from utils.dydx_websocket import MARKETS_CHANNEL, TRADES_CHANNEL
+
+### SETTINGS ###
+HOST = "127.0.0.1"
+PORT = 8766
+
+
+def date_str(date: datetime) -> str:
+    return date.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def load_messages(file_path: str) -> list:
+    """Returns the messages of a recording (one JSON message per line)."""
+    with open(file_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_messages(
+    markets: list, start: datetime, duration: timedelta, trades_per_hour: int = 1000, seed: int = 0
+) -> list:
+    """Returns the messages of a session trading markets between start and start + duration, like a recording.
+
+    Each market has a snapshot of a few trades before start, and then trades_per_hour trades at random dates, sent
+    (newest first) in updates of 1 to 5 trades. Prices follow a random walk.
+    """
+    rng = random.Random(seed)
+    messages = [
+        {
+            "type": "subscribed",
+            "channel": MARKETS_CHANNEL,
+            "contents": {"markets": {market: {"market": market, "status": "ONLINE"} for market in markets}},
+        }
+    ]
+
+    trades = []
+    for i, market in enumerate(markets):
+        price = 100.0 + i
+        snapshot = [
+            {"side": "BUY", "size": "1", "price": str(price), "createdAt": date_str(start - timedelta(seconds=seconds))}
+            for seconds in (10, 20, 30)
+        ]
+        messages.append(
+            {"type": "subscribed", "channel": TRADES_CHANNEL, "id": market, "contents": {"trades": snapshot}}
+        )
+
+        milliseconds = sorted(
+            rng.sample(
+                range(int(duration.total_seconds() * 1000)), int(trades_per_hour * duration / timedelta(hours=1))
+            )
+        )
+        for ms in milliseconds:
+            price = max(price * (1 + rng.gauss(0, 0.001)), 0.01)
+            trades.append(
+                (
+                    ms,
+                    market,
+                    {
+                        "side": rng.choice(["BUY", "SELL"]),
+                        "size": f"{rng.uniform(0.01, 10):.3f}",
+                        "price": f"{price:.4f}",
+                        "createdAt": date_str(start + timedelta(milliseconds=ms)),
+                        "liquidation": False,
+                    },
+                )
+            )
+
+    # Trades of all markets in time order, grouped into updates of consecutive trades of the same market
+    trades.sort(key=lambda trade: trade[0])
+    i = 0
+    while i < len(trades):
+        market, size = trades[i][1], rng.randint(1, 5)
+        group = []
+        while i < len(trades) and trades[i][1] == market and len(group) < size:
+            group.append(trades[i][2])
+            i += 1
+        messages.append(
+            {"type": "channel_data", "channel": TRADES_CHANNEL, "id": market, "contents": {"trades": group[::-1]}}
+        )
+
+    return messages
+
+
+class FakeDydxWebsocket:
+    """
+    Fake dYdX public websocket replaying messages, served from a background thread. Use it as a context manager, or
+    call start and stop.
+    """
+
+    def __init__(
+        self,
+        messages: list,
+        host: str = HOST,
+        port: int = PORT,
+        delay: float = 0.0,
+        subscribe_timeout: float = 1.0,
+    ):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.subscribe_timeout = subscribe_timeout
+
+        # (channel, id): first snapshot recorded
+        self.snapshots = {}
+        self.updates = []
+        for message in messages:
+            if message.get("type") == "subscribed":
+                self.snapshots.setdefault((message["channel"], message.get("id")), message)
+            elif message.get("type") == "channel_data" and message.get("channel") == TRADES_CHANNEL:
+                self.updates.append(message)
+        self.markets = sorted(
+            {message["id"] for message in self.updates}
+            | {market for channel, market in self.snapshots if channel == TRADES_CHANNEL}
+        )
+
+        # Set when all the updates have been sent to a client
+        self.replayed = threading.Event()
+        self.connections = 0
+
+        self.loop = None
+        self.thread = None
+        self.websockets = set()
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/v3/ws"
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(ready,), name="fake_dydx_websocket", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def serve(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/v3/ws", self.handler)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+
+        # The socket is bound here so the port is known when port == 0
+        sock = socket.socket()
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        self.loop.run_until_complete(web.SockSite(runner, sock).start())
+        ready.set()
+
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+        self.loop.close()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.close_websockets(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    async def close_websockets(self):
+        for websocket in list(self.websockets):
+            await websocket.close()
+
+    def trades_snapshot(self, market: str) -> dict:
+        if (TRADES_CHANNEL, market) in self.snapshots:
+            return self.snapshots[(TRADES_CHANNEL, market)]
+
+        trades = [message["contents"]["trades"][-1] for message in self.updates if message["id"] == market][:1]
+        return {"type": "subscribed", "channel": TRADES_CHANNEL, "id": market, "contents": {"trades": trades}}
+
+    def markets_snapshot(self) -> dict:
+        if (MARKETS_CHANNEL, None) in self.snapshots:
+            return self.snapshots[(MARKETS_CHANNEL, None)]
+
+        markets = {market: {"market": market, "status": "ONLINE"} for market in self.markets}
+        return {"type": "subscribed", "channel": MARKETS_CHANNEL, "contents": {"markets": markets}}
+
+    async def handler(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.websockets.add(websocket)
+        self.connections += 1
+
+        subscribed = set()
+        replay = None
+        async for message in websocket:
+            if message.type != WSMsgType.TEXT:
+                continue
+            subscription = json.loads(message.data)
+            channel = subscription.get("channel")
+
+            if subscription.get("type") != "subscribe":
+                await websocket.send_json({"type": "error", "message": f"Invalid message type: {subscription}"})
+            elif channel == MARKETS_CHANNEL:
+                await websocket.send_json(self.markets_snapshot())
+                if replay is None:
+                    replay = asyncio.create_task(self.replay(websocket, subscribed))
+            elif channel == TRADES_CHANNEL and subscription.get("id") in self.markets:
+                await websocket.send_json(self.trades_snapshot(subscription["id"]))
+                subscribed.add(subscription["id"])
+            else:
+                await websocket.send_json({"type": "error", "message": f"Invalid subscription: {subscription}"})
+
+        if replay is not None:
+            replay.cancel()
+        self.websockets.discard(websocket)
+
+        return websocket
+
+    async def replay(self, websocket: web.WebSocketResponse, subscribed: set):
+        """Sends the updates of the markets subscribed, once the client has subscribed to all of them."""
+        deadline = self.loop.time() + self.subscribe_timeout
+        while len(subscribed) < len(self.markets) and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+        for message in self.updates:
+            if message["id"] in subscribed:
+                await websocket.send_str(json.dumps(message))
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+        self.replayed.set()
+
+
+def main():
+    if len(sys.argv) > 1:
+        messages = load_messages(sys.argv[1])
+    else:
+        start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        messages = synthetic_messages(market_names(3), start, timedelta(hours=1))
+
+    with FakeDydxWebsocket(messages, delay=0.01) as server:
+        print(
+            f"Fake dYdX websocket listening on {server.url}, replaying {len(server.updates)} updates. Ctrl+C to stop."
+        )
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the candle formatting of DydxClient.get_market_candles.
+
+Compares the previous formatting (pd.concat of each page inside the pagination loop, plus one astype per column) with
+format_candles (raw pages accumulated and decoded once) on a synthetic market with 26k 1-hour candles (~3 years).
+
+Run from the project root:
+
+python -m benchmarks.format_candles_benchmark
+"""
+
+from datetime import datetime, timedelta, timezone
+from timeit import repeat
+
+import pandas as pd
+
+from utils.dydx_client import CANDLE_COLUMNS, CANDLES_PER_REQUEST, format_candles
+
+### SETTINGS ###
+NUMBER_OF_CANDLES = 26000
+REPEAT = 5
+
+
+def synthetic_pages(number_of_candles: int) -> list:
+    """Returns the raw candle pages the exchange would send for a market, newest page first."""
+    end = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    candles = []
+    for i in range(number_of_candles):
+        date = (end - timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        price = 100 + (i % 50)
+        candles.append(
+            {
+                "startedAt": date,
+                "updatedAt": date,
+                "market": "BTC-USD",
+                "resolution": "1HOUR",
+                "low": str(price - 1.5),
+                "high": str(price + 1.5),
+                "open": str(price - 0.5),
+                "close": str(price + 0.5),
+                "baseTokenVolume": "1234.5",
+                "trades": "42",
+                "usdVolume": "123456.7",
+                "startingOpenInterest": "98765.4",
+            }
+        )
+
+    return [candles[i : i + CANDLES_PER_REQUEST] for i in range(0, number_of_candles, CANDLES_PER_REQUEST)]
+
+
+def previous_format(pages: list) -> pd.DataFrame:
+    """Formatting of get_market_candles before format_candles, page loop included."""
+    data = pd.DataFrame()
+    for page in pages:
+        raw_data = pd.DataFrame.from_dict(page)
+        raw_data["startedAt"] = pd.to_datetime(raw_data["startedAt"], utc=True)
+        data = pd.concat([data, raw_data], axis=0)
+
+    data = data.drop_duplicates(subset="startedAt", keep="last")
+    data = data.reset_index(drop=True)
+    data["startedAt"] = pd.to_datetime(data["startedAt"], utc=True)
+    data["updatedAt"] = pd.to_datetime(data["updatedAt"], utc=True)
+    data["market"] = data["market"].astype(str)
+    data["resolution"] = data["resolution"].astype(str)
+    data["low"] = data["low"].astype(float)
+    data["high"] = data["high"].astype(float)
+    data["open"] = data["open"].astype(float)
+    data["close"] = data["close"].astype(float)
+    data["baseTokenVolume"] = data["baseTokenVolume"].astype(float)
+    data["trades"] = data["trades"].astype(int)
+    data["usdVolume"] = data["usdVolume"].astype(float)
+    data["startingOpenInterest"] = data["startingOpenInterest"].astype(float)
+    data = data.rename(
+        columns={
+            "startedAt": "date",
+            "updatedAt": "updated",
+            "low": "low_price",
+            "high": "high_price",
+            "open": "open_price",
+            "close": "close_price",
+            "baseTokenVolume": "volume",
+        }
+    )
+
+    return data[CANDLE_COLUMNS]
+
+
+def current_format(pages: list) -> pd.DataFrame:
+    """Formatting of get_market_candles with format_candles, page loop included."""
+    records = []
+    for page in pages:
+        records += page
+
+    return format_candles(records)
+
+
+def main():
+    pages = synthetic_pages(NUMBER_OF_CANDLES)
+    print(f"Formatting {NUMBER_OF_CANDLES} candles in {len(pages)} pages, best of {REPEAT}.")
+
+    # Both must return the same candles
+    pd.testing.assert_frame_equal(
+        previous_format(pages).sort_values("date").reset_index(drop=True),
+        current_format(pages).sort_values("date").reset_index(drop=True),
+        check_dtype=False,
+    )
+
+    previous_time = min(repeat(lambda: previous_format(pages), number=1, repeat=REPEAT))
+    current_time = min(repeat(lambda: current_format(pages), number=1, repeat=REPEAT))
+
+    print(f"Previous: {previous_time * 1000:.1f} ms.")
+    print(f"Current: {current_time * 1000:.1f} ms.")
+    print(f"Speed-up: {previous_time / current_time:.1f}x.")
+
+
+if __name__ == "__main__":
+    main()
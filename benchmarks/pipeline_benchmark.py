@@ -0,0 +1,253 @@
+"""
+End-to-end benchmark of the candle pipeline: download from the exchange, save into the db and read back.
+
+The exchange is the local fake api of benchmarks/fake_dydx_server.py (with LATENCY, PAGE_SIZE and RATE_429), and the db
+is a throwaway database created on the Postgres server of ./credentials/db_credentials.py and dropped at the end.
+For each (markets, candles per market) of SIZES, the best and median time of REPEAT runs of each step are measured:
+    get_market_candles                  one market, sync client
+    get_all_markets_candles             all markets, sync client
+    get_all_markets_candles_async       all markets, async client
+    insert_candles                      all candles into an empty table
+    insert_candles_unchanged            the same candles again (nothing to write)
+    get_candles                         all candles back from the db
+    get_candles_binary                  all candles back from the db, decoded with NumPy
+
+The results are printed and saved as json on RESULTS_FOLDER. If the json of a previous run is given, each step is
+compared with it and the program exits with code 1 if any of them is more than REGRESSION_THRESHOLD slower.
+
+Run from the project root:
+
+python -m benchmarks.pipeline_benchmark [baseline.json]
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from statistics import median
+from time import perf_counter
+from uuid import uuid4
+
+import psycopg
+
+from benchmarks.fake_dydx_server import FakeDydxServer
+from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.db_connector import DatabaseConnector
+from utils.db_schema import create_candles_indexes, create_candles_table, create_month_partitions, month_start
+from utils.dydx_client import CANDLES_PER_REQUEST, RESOLUTION_DELTAS, DydxClient, Resolution
+from utils.logger import setup_logger
+from utils.rate_limiter import SlidingWindowLimiter
+
+### SETTINGS ###
+SIZES = [(10, 100), (10, 1000), (50, 1000)]  # (markets, candles per market)
+REPEAT = 3
+RESOLUTION = Resolution.HOURS_1
+END_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+TABLE_NAME = "dydx_candles"
+PARTITIONED_TABLE = False
+COMPACT_TABLE = False
+# Fake exchange
+LATENCY = 0.02
+PAGE_SIZE = CANDLES_PER_REQUEST
+RATE_429 = 0.0
+RATE_LIMITED = False  # If False the exchange rate limiter is bypassed, so only the client is measured
+# Results
+RESULTS_FOLDER = "./data/benchmarks"
+REGRESSION_THRESHOLD = 0.2
+
+
+@contextmanager
+def throwaway_database(db_credentials: dict) -> dict:
+    """Creates an empty database on the server of db_credentials and drops it on exit. Yields its credentials."""
+    database = f"dydx_benchmark_{uuid4().hex[:8]}"
+    conninfo = {
+        "host": db_credentials["host"],
+        "port": db_credentials["port"],
+        "dbname": db_credentials["database"],
+        "user": db_credentials["user"],
+        "password": db_credentials["password"],
+    }
+
+    with psycopg.connect(**conninfo, autocommit=True) as conn:
+        conn.execute(f"CREATE DATABASE {database} TEMPLATE template0 ENCODING 'UTF8';")
+    try:
+        yield {**db_credentials, "database": database}
+    finally:
+        with psycopg.connect(**conninfo, autocommit=True) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {database} WITH (FORCE);")
+
+
+def measure(function, repeat: int = REPEAT, setup=None) -> dict:
+    """Runs function repeat times (calling setup before each run, untimed). Returns the times and the last result."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+
+    return {"seconds_min": min(times), "seconds_median": median(times), "result": result}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_size(
+    server: FakeDydxServer,
+    exchange_client: DydxClient,
+    db_client: DatabaseConnector,
+    number_of_markets: int,
+    number_of_candles: int,
+) -> list:
+    """Benchmarks every step with number_of_markets markets of number_of_candles candles. Returns the results."""
+    markets = server.markets[:number_of_markets]
+    start = END_DATE - RESOLUTION_DELTAS[RESOLUTION] * (number_of_candles - 1)
+
+    steps = {
+        "get_market_candles": lambda: exchange_client.get_market_candles(markets[0], start, END_DATE, RESOLUTION),
+        "get_all_markets_candles": lambda: exchange_client.get_all_markets_candles(
+            markets, start, END_DATE, RESOLUTION
+        ),
+        "get_all_markets_candles_async": lambda: asyncio.run(
+            exchange_client.get_all_markets_candles_async(markets, start, END_DATE, RESOLUTION)
+        ),
+    }
+
+    results = []
+
+    def add_result(name: str, measured: dict, rows: int, requests: dict = None):
+        result = {
+            "benchmark": name,
+            "markets": number_of_markets,
+            "candles": number_of_candles,
+            "rows": rows,
+            "seconds_min": measured["seconds_min"],
+            "seconds_median": measured["seconds_median"],
+            "rows_per_second": rows / max(measured["seconds_min"], 1e-9),
+        }
+        if requests is not None:
+            # Average per run
+            result["requests"] = requests[200] / REPEAT
+            result["throttled"] = requests[429] / REPEAT
+        results.append(result)
+        print(
+            f"{name:<32}{number_of_markets:>6} markets{number_of_candles:>7} candles: "
+            f"{measured['seconds_min'] * 1000:>9.1f} ms ({result['rows_per_second']:>9.0f} rows/s)."
+        )
+
+    candles_data = None
+    for name, function in steps.items():
+        server.reset_stats()
+        measured = measure(function)
+        add_result(name, measured, len(measured["result"]), dict(server.requests))
+        candles_data = measured["result"]
+
+    def truncate_table():
+        db_client.send_request(f"TRUNCATE {TABLE_NAME};")
+
+    measured = measure(lambda: db_client.insert_candles(TABLE_NAME, candles_data), setup=truncate_table)
+    add_result("insert_candles", measured, len(candles_data))
+
+    measured = measure(lambda: db_client.insert_candles(TABLE_NAME, candles_data))
+    add_result("insert_candles_unchanged", measured, len(candles_data))
+
+    measured = measure(lambda: db_client.get_candles(markets, start, END_DATE, table_name=TABLE_NAME))
+    add_result("get_candles", measured, len(measured["result"]))
+
+    measured = measure(lambda: db_client.get_candles_binary(markets, start, END_DATE, table_name=TABLE_NAME))
+    add_result("get_candles_binary", measured, len(measured["result"]))
+
+    return results
+
+
+def compare(results: list, baseline: dict) -> bool:
+    """Prints the change of each result against the same benchmark of baseline. Returns True if any regressed."""
+    key = lambda result: (result["benchmark"], result["markets"], result["candles"])
+    baseline_results = {key(result): result for result in baseline["results"]}
+
+    regression = False
+    print(f"Compared with {baseline.get('commit', '')[:10]} ({baseline.get('date', '')}):")
+    for result in results:
+        if key(result) not in baseline_results:
+            continue
+
+        change = result["seconds_min"] / baseline_results[key(result)]["seconds_min"] - 1
+        flag = ""
+        if change > REGRESSION_THRESHOLD:
+            regression = True
+            flag = " REGRESSION"
+        print(
+            f"{result['benchmark']:<32}{result['markets']:>6} markets{result['candles']:>7} candles: {change:+.1%}{flag}"
+        )
+
+    return regression
+
+
+def main():
+    logger = setup_logger(name="pipeline_benchmark", save_on_file=False, debug_level="WARNING")
+
+    baseline = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as f:
+            baseline = json.load(f)
+
+    number_of_markets = max(markets for markets, _ in SIZES)
+    server = FakeDydxServer(
+        latency=LATENCY, page_size=PAGE_SIZE, number_of_markets=number_of_markets, rate_429=RATE_429, port=0
+    )
+
+    results = []
+    with server, throwaway_database(DB_CREDENTIALS) as db_credentials:
+        exchange_client = DydxClient(logger, host=server.host)
+        if not RATE_LIMITED:
+            exchange_client.rate_limiter = SlidingWindowLimiter(capacity=1, period=0)
+
+        with DatabaseConnector(db_credentials, logger, pooled=True) as db_client:
+            create_candles_table(db_client, TABLE_NAME, PARTITIONED_TABLE, COMPACT_TABLE)
+            if PARTITIONED_TABLE:
+                first_date = END_DATE - RESOLUTION_DELTAS[RESOLUTION] * max(candles for _, candles in SIZES)
+                create_month_partitions(db_client, TABLE_NAME, first_date, month_start(END_DATE, 1))
+            create_candles_indexes(db_client, TABLE_NAME, PARTITIONED_TABLE, COMPACT_TABLE)
+
+            print(f"Fake exchange on {server.host}, latency {LATENCY * 1000:.0f} ms. Best of {REPEAT}.")
+            for markets, candles in SIZES:
+                results += run_size(server, exchange_client, db_client, markets, candles)
+
+    date = datetime.now(timezone.utc)
+    report = {
+        "date": date.isoformat(),
+        "commit": git_commit(),
+        "settings": {
+            "sizes": SIZES,
+            "repeat": REPEAT,
+            "resolution": RESOLUTION,
+            "partitioned_table": PARTITIONED_TABLE,
+            "compact_table": COMPACT_TABLE,
+            "latency": LATENCY,
+            "page_size": PAGE_SIZE,
+            "rate_429": RATE_429,
+            "rate_limited": RATE_LIMITED,
+        },
+        "results": results,
+    }
+
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    file_path = os.path.join(RESULTS_FOLDER, f"pipeline_{date.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(file_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved on {file_path}.")
+
+    if baseline and compare(results, baseline):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
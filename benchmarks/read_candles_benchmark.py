@@ -0,0 +1,92 @@
+"""
+Benchmark of the bulk candle reads of DatabaseConnector.
+
+Compares get_candles (fetchall of Python tuples, then DataFrame and casts) with get_candles_binary (binary COPY decoded
+with np.frombuffer) on one year of 1-hour candles of NUMBER_OF_MARKETS synthetic markets, saved into a throwaway
+database on the Postgres server of ./credentials/db_credentials.py.
+
+Run from the project root:
+
+python -m benchmarks.read_candles_benchmark
+"""
+
+from datetime import datetime, timedelta, timezone
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.fake_dydx_server import market_names
+from benchmarks.pipeline_benchmark import throwaway_database
+from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.db_connector import DatabaseConnector
+from utils.db_schema import create_candles_indexes, create_candles_table
+from utils.logger import setup_logger
+
+### SETTINGS ###
+NUMBER_OF_MARKETS = 40
+START_DATE = datetime(2022, 1, 1, tzinfo=timezone.utc)
+END_DATE = datetime(2022, 12, 31, 23, tzinfo=timezone.utc)
+TABLE_NAME = "dydx_candles"
+COMPACT_TABLE = False
+REPEAT = 3
+
+
+def synthetic_candles(markets: list, start: datetime, end: datetime) -> pd.DataFrame:
+    """Returns 1-hour candles of markets between start and end dates."""
+    dates = pd.date_range(start, end, freq=timedelta(hours=1))
+    prices = 100 + np.random.default_rng(0).random(len(dates) * len(markets)) * 10
+
+    return pd.DataFrame(
+        {
+            "date": np.tile(dates, len(markets)),
+            "updated": np.tile(dates, len(markets)),
+            "market": np.repeat(markets, len(dates)),
+            "resolution": "1HOUR",
+            "open_price": prices,
+            "close_price": prices + 0.5,
+            "high_price": prices + 1.5,
+            "low_price": prices - 1.5,
+            "volume": 1234.5,
+        }
+    )
+
+
+def main():
+    logger = setup_logger(name="read_candles_benchmark", save_on_file=False, debug_level="WARNING")
+    markets = market_names(NUMBER_OF_MARKETS)
+
+    with throwaway_database(DB_CREDENTIALS) as db_credentials:
+        with DatabaseConnector(db_credentials, logger, pooled=True) as db_client:
+            create_candles_table(db_client, TABLE_NAME, compact=COMPACT_TABLE)
+            create_candles_indexes(db_client, TABLE_NAME, compact=COMPACT_TABLE)
+            db_client.insert_candles(TABLE_NAME, synthetic_candles(markets, START_DATE, END_DATE))
+            db_client.send_request(f"ANALYZE {TABLE_NAME};")
+
+            def current():
+                return db_client.get_candles(markets, START_DATE, END_DATE, table_name=TABLE_NAME)
+
+            def binary(price_dtype=np.float64):
+                return db_client.get_candles_binary(markets, START_DATE, END_DATE, TABLE_NAME, price_dtype=price_dtype)
+
+            rows = len(current())
+            print(f"Reading {rows} candles of {NUMBER_OF_MARKETS} markets, best of {REPEAT}.")
+
+            # Both must return the same candles
+            pd.testing.assert_frame_equal(
+                current(), binary().astype({"market": object, "resolution": object}), check_dtype=False
+            )
+
+            results = {
+                "get_candles": min(repeat(current, number=1, repeat=REPEAT)),
+                "get_candles_binary": min(repeat(binary, number=1, repeat=REPEAT)),
+                "get_candles_binary float32": min(repeat(lambda: binary(np.float32), number=1, repeat=REPEAT)),
+            }
+
+    for name, seconds in results.items():
+        print(f"{name}: {seconds * 1000:.1f} ms ({rows / seconds:.0f} rows/s).")
+    print(f"Speed-up: {results['get_candles'] / results['get_candles_binary']:.1f}x.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Replay check and benchmark of the real-time candles built from trades by DydxTradesCollector.
+
+The messages of RECORDING_PATH (recorded with DydxTradesCollector(record_path=...)), or synthetic trades of
+NUMBER_OF_MARKETS markets during DURATION if None, are replayed by the local fake websocket of
+benchmarks/fake_dydx_websocket.py. The collector saves the bars into a throwaway database created on the Postgres server
+of ./credentials/db_credentials.py and dropped at the end.
+
+The candles saved are compared with the ones computed directly from the trades replayed (the trades before the first
+full bar of each market are skipped, like the collector does), and the trades per second handled are printed. The
+program exits with code 1 if they differ.
+
+Run from the project root:
+
+python -m benchmarks.trades_collector_benchmark
+"""
+
+import asyncio
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+
+import pandas as pd
+
+from benchmarks.fake_dydx_server import market_names
+from benchmarks.fake_dydx_websocket import FakeDydxWebsocket, load_messages, synthetic_messages
+from benchmarks.pipeline_benchmark import throwaway_database
+from credentials.db_credentials import db_credentials as DB_CREDENTIALS
+from utils.db_connector import DatabaseConnector
+from utils.db_schema import create_candles_indexes, create_candles_table
+from utils.dydx_client import RESOLUTION_DELTAS, Resolution
+from utils.dydx_websocket import TRADES_CHANNEL, DydxTradesCollector, bar_start, parse_date
+from utils.logger import setup_logger
+
+### SETTINGS ###
+RECORDING_PATH = None
+NUMBER_OF_MARKETS = 20
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+DURATION = timedelta(hours=6)
+TRADES_PER_HOUR = 2000
+RESOLUTION = Resolution.HOURS_1
+TABLE_NAME = "dydx_candles"
+FLUSH_INTERVAL = 0.5
+
+
+def expected_candles(messages: list, resolution: str) -> pd.DataFrame:
+    """Returns the candles of the trades of messages, from the first bar after the snapshot of each market."""
+    delta = RESOLUTION_DELTAS[resolution]
+    complete_from = {}
+    trades = []
+    for message in messages:
+        if message.get("channel") != TRADES_CHANNEL:
+            continue
+        if message["type"] == "subscribed" and message["id"] not in complete_from:
+            dates = [parse_date(trade["createdAt"]) for trade in message["contents"]["trades"]]
+            complete_from[message["id"]] = bar_start(max(dates), resolution) + delta
+        elif message["type"] == "channel_data":
+            trades += [(message["id"], trade) for trade in reversed(message["contents"]["trades"])]
+
+    data = pd.DataFrame(
+        [
+            (market, parse_date(trade["createdAt"]), float(trade["price"]), float(trade["size"]))
+            for market, trade in trades
+            if parse_date(trade["createdAt"]) >= complete_from[market]
+        ],
+        columns=["market", "created", "price", "size"],
+    )
+    data["date"] = data["created"].dt.floor(delta)
+
+    candles = data.groupby(["date", "market"], sort=True).agg(
+        open_price=("price", "first"),
+        close_price=("price", "last"),
+        high_price=("price", "max"),
+        low_price=("price", "min"),
+        volume=("size", "sum"),
+    )
+
+    return candles.reset_index()
+
+
+def main():
+    logger = setup_logger(name="trades_collector_benchmark", save_on_file=False, debug_level="WARNING")
+    if RECORDING_PATH:
+        messages = load_messages(RECORDING_PATH)
+    else:
+        messages = synthetic_messages(market_names(NUMBER_OF_MARKETS), START_DATE, DURATION, TRADES_PER_HOUR)
+    expected = expected_candles(messages, RESOLUTION)
+    last_trade = max(
+        parse_date(trade["createdAt"])
+        for message in messages
+        if message.get("type") == "channel_data"
+        for trade in message["contents"]["trades"]
+    )
+    number_of_trades = sum(
+        len(message["contents"]["trades"]) for message in messages if message.get("type") == "channel_data"
+    )
+
+    with throwaway_database(DB_CREDENTIALS) as db_credentials:
+        with DatabaseConnector(db_credentials, logger, pooled=True) as db_client:
+            create_candles_table(db_client, TABLE_NAME)
+            create_candles_indexes(db_client, TABLE_NAME)
+
+            with FakeDydxWebsocket(messages, port=0) as server:
+                collector = DydxTradesCollector(
+                    db_client, logger, TABLE_NAME, RESOLUTION, host=server.url, flush_interval=FLUSH_INTERVAL
+                )
+                thread = threading.Thread(target=asyncio.run, args=(collector.run(),))
+
+                # Replayed once the collector has handled the newest trade sent
+                start = perf_counter()
+                thread.start()
+                server.replayed.wait()
+                while collector.event_time is None or collector.event_time < last_trade:
+                    sleep(0.001)
+                replay_seconds = perf_counter() - start
+                collector.stop()
+                thread.join()
+                total_seconds = perf_counter() - start
+
+            saved = db_client.get_candles(
+                list(expected["market"].unique()),
+                expected["date"].min(),
+                expected["date"].max(),
+                table_name=TABLE_NAME,
+                resolution=RESOLUTION,
+            )
+
+    print(f"Replayed {len(server.updates)} updates ({number_of_trades} trades) of {len(server.markets)} markets.")
+    print(f"Replay: {replay_seconds:.2f}s ({number_of_trades / replay_seconds:.0f} trades/s).")
+    print(f"Replay and last flush: {total_seconds:.2f}s. {len(saved)} candles saved.")
+
+    columns = list(expected.columns)
+    saved = saved[columns].sort_values(["date", "market"]).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(saved, expected, check_dtype=False)
+    except AssertionError as e:
+        print(f"The candles saved differ from the trades replayed: {e}")
+        sys.exit(1)
+    print("The candles saved match the trades replayed.")
+
+
+if __name__ == "__main__":
+    main()
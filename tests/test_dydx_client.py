@@ -0,0 +1,75 @@
+"""
+Unit tests of DydxClient (utils/dydx_client.py) against the local fake exchange of benchmarks/fake_dydx_server.py.
+
+Run from the project root:
+
+python -m pytest -q tests
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.fake_dydx_server import FakeDydxServer
+from utils.dydx_client import DydxClient, Resolution
+from utils.logger import setup_logger
+from utils.rate_limiter import SlidingWindowLimiter
+
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+NUMBER_OF_MARKETS = 3
+HOUR = timedelta(hours=1)
+
+
+class FailingArchive:
+    """ResponseArchive whose writes always fail, like a full disk."""
+
+    def __init__(self):
+        self.appends = 0
+
+    def append(self, market: str, resolution: str, candles: list):
+        self.appends += 1
+        raise OSError(28, "No space left on device")
+
+
+@pytest.fixture(scope="module")
+def server():
+    with FakeDydxServer(port=0, number_of_markets=NUMBER_OF_MARKETS) as server:
+        yield server
+
+
+@pytest.fixture
+def archive():
+    return FailingArchive()
+
+
+@pytest.fixture
+def client(server, archive):
+    logger = setup_logger(name="test_dydx_client", save_on_file=False, debug_level="CRITICAL")
+    client = DydxClient(logger, host=server.host, archive=archive)
+    # No rate limit against the fake exchange
+    client.rate_limiter = SlidingWindowLimiter(capacity=1, period=0)
+    return client
+
+
+@pytest.mark.parametrize(
+    "duration",
+    [timedelta(hours=50), timedelta(hours=250)],
+    ids=["threaded", "sequential"],
+)
+def test_archive_failure_keeps_the_candles(server, client, archive, duration):
+    # One request per market is downloaded from threads, more from a single one
+    candles = client.get_all_markets_candles(server.markets, START_DATE, START_DATE + duration, Resolution.HOURS_1)
+
+    # Every candle between start and end (both included) of every market
+    assert archive.appends > 0
+    assert candles.groupby("market").size().to_dict() == {market: duration // HOUR + 1 for market in server.markets}
+
+
+def test_archive_failure_keeps_the_candles_async(server, client, archive):
+    end = START_DATE + timedelta(hours=250)
+    candles = asyncio.run(client.get_all_markets_candles_async(server.markets, START_DATE, end, Resolution.HOURS_1))
+
+    assert archive.appends > 0
+    assert client.failed_windows == []
+    assert candles.groupby("market").size().to_dict() == {market: 251 for market in server.markets}
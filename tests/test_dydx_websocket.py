@@ -0,0 +1,200 @@
+"""
+Unit tests of DydxTradesCollector (utils/dydx_websocket.py), fed with the messages of benchmarks/fake_dydx_websocket.py.
+
+The db is a stub that keeps the candles saved, so no Postgres or exchange is needed. Run from the project root:
+
+python -m pytest -q tests
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+from benchmarks.fake_dydx_websocket import date_str, synthetic_messages
+from utils.dydx_client import Resolution
+from utils.dydx_websocket import TRADES_CHANNEL, DydxTradesCollector, parse_date
+from utils.logger import setup_logger
+
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+MARKETS = ["BTC-USD", "M001-USD"]
+
+
+class StubDatabase:
+    """Keeps the candles passed to insert_candles. If failing == True the saves fail, like DatabaseConnector."""
+
+    def __init__(self):
+        self.saves = []
+        self.failing = False
+
+    def insert_candles(self, table_name: str, candles_data: pd.DataFrame, keep_newer: bool = False) -> str:
+        if self.failing:
+            return ""
+        self.saves.append((table_name, candles_data, keep_newer))
+        return f"INSERT 0 {len(candles_data)}"
+
+    def candles(self) -> pd.DataFrame:
+        """Returns the last version saved of each candle."""
+        candles = pd.concat([candles_data for _, candles_data, _ in self.saves], ignore_index=True)
+        return candles.drop_duplicates(["date", "market"], keep="last").sort_values(["date", "market"])
+
+
+class StubWebsocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_json(self, data: dict):
+        self.sent.append(data)
+
+
+def trade(date: datetime, price: float, size: float = 1.0) -> dict:
+    return {"side": "BUY", "size": str(size), "price": str(price), "createdAt": date_str(date)}
+
+
+def trades_message(market: str, trades: list) -> dict:
+    # Newest first, like the exchange
+    return {"type": "channel_data", "channel": TRADES_CHANNEL, "id": market, "contents": {"trades": trades[::-1]}}
+
+
+def subscribed_message(market: str, trades: list) -> dict:
+    return {"type": "subscribed", "channel": TRADES_CHANNEL, "id": market, "contents": {"trades": trades[::-1]}}
+
+
+@pytest.fixture
+def db():
+    return StubDatabase()
+
+
+@pytest.fixture
+def collector(db):
+    logger = setup_logger(name="test_dydx_websocket", save_on_file=False, debug_level="WARNING")
+    return DydxTradesCollector(db, logger, "dydx_candles", Resolution.HOURS_1)
+
+
+def feed(collector: DydxTradesCollector, messages: list) -> StubWebsocket:
+    websocket = StubWebsocket()
+
+    async def handle_messages():
+        for message in messages:
+            await collector.handle_message(websocket, message)
+
+    asyncio.run(handle_messages())
+    return websocket
+
+
+def flush(collector: DydxTradesCollector, close_all: bool = False) -> bool:
+    return asyncio.run(collector.flush(close_all))
+
+
+def test_replayed_trades_build_ohlcv(collector, db):
+    messages = synthetic_messages(MARKETS, START_DATE, timedelta(hours=3), trades_per_hour=500)
+    websocket = feed(collector, messages)
+
+    # Every ONLINE market of the markets snapshot is subscribed
+    assert [data["id"] for data in websocket.sent] == MARKETS
+
+    trades = [
+        (message["id"], parse_date(trade["createdAt"]), float(trade["price"]), float(trade["size"]))
+        for message in messages
+        if message["type"] == "channel_data"
+        for trade in reversed(message["contents"]["trades"])
+    ]
+    expected = (
+        pd.DataFrame(trades, columns=["market", "created", "price", "size"])
+        .assign(date=lambda data: data["created"].dt.floor("1h"))
+        .groupby(["date", "market"])
+        .agg(
+            open_price=("price", "first"),
+            close_price=("price", "last"),
+            high_price=("price", "max"),
+            low_price=("price", "min"),
+            volume=("size", "sum"),
+            trades=("price", "size"),
+            updated=("created", "max"),
+        )
+        .reset_index()
+    )
+
+    # Trade count of each bar, before they are saved and dropped
+    counts = {key: bar["trades"] for key, bar in collector.bars.items()}
+    assert counts == {(row.market, row.date): row.trades for row in expected.itertuples()}
+    assert sum(counts.values()) == len(trades) == 3 * 500 * len(MARKETS)
+
+    assert flush(collector, close_all=True)
+    saved = db.candles().reset_index(drop=True)
+    columns = ["date", "market", "open_price", "close_price", "high_price", "low_price", "volume", "updated"]
+    pd.testing.assert_frame_equal(saved[columns], expected[columns], check_dtype=False)
+    assert (saved["resolution"] == Resolution.HOURS_1).all()
+    assert all(keep_newer for _, _, keep_newer in db.saves)
+
+
+def test_snapshot_and_partial_bar_are_skipped(collector, db):
+    market = "BTC-USD"
+    feed(
+        collector,
+        [
+            subscribed_message(market, [trade(START_DATE + timedelta(minutes=50), 100)]),
+            # Same bar as the snapshot, it started before the subscription
+            trades_message(market, [trade(START_DATE + timedelta(minutes=55), 101)]),
+            trades_message(market, [trade(START_DATE + timedelta(hours=1, minutes=1), 102)]),
+        ],
+    )
+
+    assert list(collector.bars) == [(market, START_DATE + timedelta(hours=1))]
+    assert collector.bars[(market, START_DATE + timedelta(hours=1))]["trades"] == 1
+
+
+def test_bars_close_once_the_stream_passes_their_end(collector, db):
+    market = "BTC-USD"
+    feed(
+        collector,
+        [
+            subscribed_message(market, [trade(START_DATE - timedelta(minutes=1), 100)]),
+            trades_message(market, [trade(START_DATE + timedelta(minutes=10), 100), trade(START_DATE, 99)]),
+            trades_message(market, [trade(START_DATE + timedelta(hours=1, minutes=5), 105, size=2)]),
+            trades_message(market, [trade(START_DATE + timedelta(hours=2, seconds=2), 110)]),
+        ],
+    )
+
+    # The stream is 2 seconds past the end of the second bar, less than close_delay: only the first one is closed
+    assert flush(collector)
+    assert list(collector.bars) == [
+        (market, START_DATE + timedelta(hours=1)),
+        (market, START_DATE + timedelta(hours=2)),
+    ]
+    assert len(db.candles()) == 3
+
+    # Late trade of the closed bar: dropped, it would overwrite the saved candle with a single trade
+    feed(collector, [trades_message(market, [trade(START_DATE + timedelta(minutes=59), 50)])])
+    assert (market, START_DATE) not in collector.bars
+
+    feed(collector, [trades_message(market, [trade(START_DATE + timedelta(hours=2, seconds=6), 111)])])
+    assert flush(collector)
+    assert list(collector.bars) == [(market, START_DATE + timedelta(hours=2))]
+
+    first_bar = db.candles().iloc[0]
+    assert (first_bar["open_price"], first_bar["close_price"], first_bar["low_price"]) == (99, 100, 99)
+    assert first_bar["volume"] == 2
+
+
+def test_failed_save_is_retried(collector, db):
+    market = "BTC-USD"
+    feed(
+        collector,
+        [
+            subscribed_message(market, [trade(START_DATE - timedelta(minutes=1), 100)]),
+            trades_message(market, [trade(START_DATE + timedelta(minutes=1), 100)]),
+            trades_message(market, [trade(START_DATE + timedelta(hours=1, minutes=1), 101)]),
+        ],
+    )
+
+    db.failing = True
+    assert not flush(collector)
+    # Not saved, so the closed bar is kept
+    assert len(collector.bars) == 2 and len(collector.dirty) == 2
+
+    db.failing = False
+    assert flush(collector)
+    assert list(collector.bars) == [(market, START_DATE + timedelta(hours=1))]
+    assert len(db.candles()) == 2
@@ -0,0 +1,95 @@
+"""
+Unit tests of SlidingWindowLimiter and backoff_delay (utils/rate_limiter.py), on a fake clock.
+
+Run from the project root:
+
+python -m pytest -q tests
+"""
+
+import pytest
+
+import utils.rate_limiter as rate_limiter
+from utils.rate_limiter import SlidingWindowLimiter, backoff_delay
+
+CAPACITY = 5
+PERIOD = 10.0
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(clock):
+    return SlidingWindowLimiter(CAPACITY, PERIOD)
+
+
+def test_starts_empty(limiter):
+    # A full window is available at once, with no wait
+    assert [limiter._reserve() for _ in range(CAPACITY)] == [0.0] * CAPACITY
+    assert limiter.stats()["waits"] == 0
+
+
+def test_call_over_capacity_waits_for_the_window_boundary(clock, limiter):
+    for _ in range(CAPACITY):
+        limiter._reserve()
+        clock.now += 1.0
+
+    # The first call started 5 seconds ago: the next one starts once it is PERIOD old
+    assert limiter._reserve() == pytest.approx(PERIOD - CAPACITY)
+    assert limiter.stats() == {"requests": CAPACITY + 1, "waits": 1, "throttles": 0, "retries": 0}
+
+
+def test_window_boundary(clock, limiter):
+    for _ in range(CAPACITY):
+        limiter._reserve()
+
+    # Just before the boundary the call waits until it, at the boundary the next one starts at once
+    clock.now += PERIOD - 0.001
+    assert limiter._reserve() == pytest.approx(0.001)
+    clock.now += 0.001
+    assert limiter._reserve() == 0.0
+
+
+def test_at_most_capacity_calls_in_any_window(clock, limiter):
+    starts = []
+    for _ in range(4 * CAPACITY):
+        starts.append(clock.now + limiter._reserve())
+        clock.now += 0.5
+
+    assert all(starts[i] - starts[i - CAPACITY] >= PERIOD for i in range(CAPACITY, len(starts)))
+
+
+def test_throttled_spreads_the_next_calls_over_the_period(clock, limiter):
+    limiter._reserve()
+    limiter.throttled()
+
+    # The window is full: the next calls start PERIOD / CAPACITY apart
+    waits = [limiter._reserve() for _ in range(CAPACITY)]
+    assert waits == pytest.approx([(i + 1) * PERIOD / CAPACITY for i in range(CAPACITY)])
+    assert limiter.stats()["throttles"] == 1
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_backoff_delay_bounds(attempt):
+    delays = [backoff_delay(attempt, base=0.5, cap=30.0) for _ in range(200)]
+    assert all(0 <= delay <= min(30.0, 0.5 * 2**attempt) for delay in delays)
+
+
+def test_backoff_delay_is_jittered(monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: high)
+    assert [backoff_delay(attempt) for attempt in range(8)] == [0.5, 1, 2, 4, 8, 16, 30, 30]
+
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: low)
+    assert backoff_delay(5) == 0
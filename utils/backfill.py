@@ -0,0 +1,403 @@
+import asyncio
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Union
+
+import aiohttp
+
+from utils.db_connector import DatabaseConnector
+from utils.dydx_client import (
+    CANDLES_PER_REQUEST,
+    RESOLUTION_DELTAS,
+    DydxClient,
+    Resolution,
+    candle_windows,
+    format_candles,
+)
+
+CHECKPOINT_TABLE_NAME = "backfill_checkpoints"
+GAP_SCAN_TABLE_NAME = "gap_scan_checkpoints"
+# The candles before the last gap scan checkpoint that are scanned again, as the candles around it may have changed
+GAP_SCAN_MARGIN = timedelta(days=3)
+
+
+def merge_ranges(ranges: list, resolution: str = Resolution.HOURS_1) -> list:
+    """Merges a list of (start, end) candle ranges (both included) into the minimum list of sorted ranges."""
+    delta = RESOLUTION_DELTAS[resolution]
+
+    merged = []
+    for range_start, range_end in sorted(ranges):
+        if merged and range_start <= merged[-1][1] + delta:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+
+    return merged
+
+
+def missing_ranges(start: datetime, end: datetime, covered: list, resolution: str = Resolution.HOURS_1) -> list:
+    """Returns the (start, end) ranges between start and end dates that are not inside the covered ranges."""
+    delta = RESOLUTION_DELTAS[resolution]
+
+    missing = []
+    cursor = start
+    for range_start, range_end in merge_ranges(covered, resolution):
+        if range_start > cursor:
+            missing.append((cursor, min(range_start - delta, end)))
+        cursor = max(cursor, range_end + delta)
+        if cursor > end:
+            return missing
+
+    missing.append((cursor, end))
+
+    return missing
+
+
+def plan_backfill(
+    market_list: Union[tuple, list],
+    start: datetime,
+    end: datetime,
+    resolution: str = Resolution.HOURS_1,
+    first_candles: dict = None,
+    covered: dict = None,
+) -> list:
+    """Returns a list of (market, window_start, window_end) with all the windows needed to download market_list
+    between start and end dates.
+
+    first_candles is an optional dict of market: datetime with the first candle available on the exchange for each
+    market. The range of each market is clipped to it, so no requests are wasted before the market existed.
+
+    covered is an optional dict of market: list of (start, end) ranges already downloaded (see get_checkpoints).
+    Only the ranges not covered are planned.
+    """
+    first_candles = first_candles if first_candles else {}
+    covered = covered if covered else {}
+
+    plan = []
+    for market in market_list:
+        market_start = max(start, first_candles.get(market, start))
+        for range_start, range_end in missing_ranges(market_start, end, covered.get(market, []), resolution):
+            plan += [(market, *window) for window in candle_windows(range_start, range_end, resolution)]
+
+    return plan
+
+
+def create_checkpoint_table(db_client: DatabaseConnector) -> str:
+    """Creates the checkpoint tables if they do not exist. Returns the status message.
+
+    Each row of the checkpoint table is a range of candles of a market already saved in table_name, so an interrupted
+    backfill can be resumed. Each row of the gap scan table is the last candle of a table scanned for gaps (see
+    repair_gaps), so the next scan starts from there.
+    """
+    sql = f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE_NAME} (
+            table_name TEXT,
+            market TEXT,
+            resolution TEXT,
+            range_start TIMESTAMP WITH TIME ZONE,
+            range_end TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (table_name, market, resolution, range_start)
+        );
+        CREATE TABLE IF NOT EXISTS {GAP_SCAN_TABLE_NAME} (
+            table_name TEXT,
+            resolution TEXT,
+            scanned_until TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (table_name, resolution)
+        );
+    """
+    return db_client.send_request(sql)
+
+
+def get_checkpoints(db_client: DatabaseConnector, table_name: str, resolution: str = Resolution.HOURS_1) -> dict:
+    """Returns a dict of market: list of (start, end) ranges already saved in table_name.
+
+    The ranges are merged and stored back merged, so the checkpoint table stays small.
+    """
+    covered = {}
+    with db_client.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""DELETE FROM {CHECKPOINT_TABLE_NAME}
+                WHERE table_name = %s AND resolution = %s
+                RETURNING market, range_start, range_end;""",
+                (table_name, resolution),
+            )
+            for market, range_start, range_end in cur.fetchall():
+                covered.setdefault(market, []).append((range_start, range_end))
+
+            covered = {market: merge_ranges(ranges, resolution) for market, ranges in covered.items()}
+
+            cur.executemany(
+                f"""INSERT INTO {CHECKPOINT_TABLE_NAME} (table_name, market, resolution, range_start, range_end)
+                VALUES (%s, %s, %s, %s, %s);""",
+                [
+                    (table_name, market, resolution, range_start, range_end)
+                    for market, ranges in covered.items()
+                    for range_start, range_end in ranges
+                ],
+            )
+
+    return covered
+
+
+def save_checkpoints(
+    db_client: DatabaseConnector, table_name: str, ranges: list, resolution: str = Resolution.HOURS_1
+) -> str:
+    """Saves a list of (market, range_start, range_end) as already downloaded. Returns the status message."""
+    sql = f"""
+        INSERT INTO {CHECKPOINT_TABLE_NAME} (table_name, market, resolution, range_start, range_end)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (table_name, market, resolution, range_start)
+        DO UPDATE SET range_end = GREATEST({CHECKPOINT_TABLE_NAME}.range_end, excluded.range_end);
+    """
+    values_list = [
+        (table_name, market, resolution, range_start, range_end) for market, range_start, range_end in ranges
+    ]
+    return db_client.send_many(sql, values_list)
+
+
+def clear_checkpoints(db_client: DatabaseConnector, table_name: str) -> str:
+    """Deletes all the checkpoints of table_name. Returns the status message."""
+    sql = f"DELETE FROM {CHECKPOINT_TABLE_NAME} WHERE table_name = %s;"
+    return db_client.send_request(sql, (table_name,))
+
+
+async def run_backfill(
+    exchange_client: DydxClient,
+    db_client: DatabaseConnector,
+    table_name: str,
+    plan: list,
+    resolution: str = Resolution.HOURS_1,
+    max_concurrency: int = 20,
+    checkpoint: bool = False,
+    batch_size: int = 10000,
+    queue_size: int = 100,
+) -> int:
+    """Downloads all windows of plan and inserts them into table_name. Returns the number of candles saved.
+
+    Works as a streaming pipeline: max_concurrency downloaders put the downloaded windows into a queue of queue_size
+    windows, and a single writer takes them out and saves them into the db in batches of at least batch_size candles.
+    Each batch is saved while the next one is being downloaded. As the downloaders wait when the queue is full, the
+    memory used does not depend on the size of plan.
+
+    If checkpoint == True, the windows of each saved batch are recorded in the checkpoint table (see get_checkpoints).
+    """
+    logger = exchange_client.logger
+    windows_queue = asyncio.Queue(maxsize=queue_size)
+    plan_iter = iter(plan)
+    # failed_windows is only updated inside the event loop, and the rest only by save_batch
+    stats = {"windows": 0, "candles": 0, "failed_windows": 0, "failed_saves": 0}
+    time_start = perf_counter()
+
+    def save_batch(records: list, windows: list):
+        """Formats and saves a batch of raw candles into the db. Runs outside the event loop.
+
+        Any error is recorded as a failed save, so a bad batch does not stop the writer (and the downloaders waiting
+        on the full queue with it).
+        """
+        try:
+            candles_data = format_candles(records)
+            if db_client.insert_candles(table_name, candles_data) == "":
+                stats["failed_saves"] += len(windows)
+                return
+
+            if checkpoint:
+                save_checkpoints(db_client, table_name, windows, resolution)
+        except Exception as e:
+            logger.error(f"Unable to save a batch of {len(windows)} windows: {e!r}")
+            stats["failed_saves"] += len(windows)
+            return
+
+        stats["windows"] += len(windows)
+        stats["candles"] += len(candles_data)
+        logger.debug(
+            f"Backfill progress: {stats['windows']}/{len(plan)} windows, {stats['candles']} candles, "
+            f"{stats['candles'] / (perf_counter() - time_start):.0f} candles/s."
+        )
+
+    async def downloader(session: aiohttp.ClientSession):
+        # All downloaders share plan_iter, so each window is downloaded once
+        for market, window_start, window_end in plan_iter:
+            records = await exchange_client.get_candles_window_async(
+                session, market, window_start, window_end, resolution
+            )
+            await windows_queue.put((market, window_start, window_end, records))
+
+    async def writer():
+        records, windows, save_task = [], [], None
+        while True:
+            window = await windows_queue.get()
+            if window is None or len(records) >= batch_size:
+                # Waits for the previous batch, so only one batch is being saved at a time
+                if save_task:
+                    await save_task
+                save_task = asyncio.create_task(asyncio.to_thread(save_batch, records, windows))
+                records, windows = [], []
+
+            if window is None:
+                await save_task
+                return
+
+            market, window_start, window_end, window_records = window
+            if window_records is None:
+                stats["failed_windows"] += 1
+                continue
+
+            records += window_records
+            windows.append((market, window_start, window_end))
+
+    async with exchange_client.create_session(max_concurrency) as session:
+        writer_task = asyncio.create_task(writer())
+        downloads = asyncio.gather(*[downloader(session) for _ in range(max_concurrency)])
+        try:
+            # If the writer fails the downloaders are cancelled, or they would wait forever on the full queue
+            await asyncio.wait([downloads, writer_task], return_when=asyncio.FIRST_COMPLETED)
+            if writer_task.done():
+                # The writer only returns after the last window, so it failed
+                writer_task.result()
+            await downloads
+            await windows_queue.put(None)
+            await writer_task
+        finally:
+            downloads.cancel()
+            writer_task.cancel()
+            await asyncio.gather(downloads, writer_task, return_exceptions=True)
+
+    if stats["failed_windows"]:
+        logger.error(f"Unable to download {stats['failed_windows']} windows.")
+    if stats["failed_saves"]:
+        logger.error(f"Unable to save {stats['failed_saves']} windows.")
+
+    logger.debug(f"Rate limiter stats: {exchange_client.rate_limit_stats()}")
+
+    return stats["candles"]
+
+
+def get_gap_scan_checkpoint(
+    db_client: DatabaseConnector, table_name: str, resolution: str = Resolution.HOURS_1
+) -> datetime:
+    """Returns the last candle date of table_name scanned for gaps, or None if it was never scanned."""
+    sql = f"SELECT scanned_until FROM {GAP_SCAN_TABLE_NAME} WHERE table_name = %s AND resolution = %s;"
+    data = db_client.send_query(sql, (table_name, resolution))
+
+    return data[0][0] if data else None
+
+
+def save_gap_scan_checkpoint(
+    db_client: DatabaseConnector, table_name: str, scanned_until: datetime, resolution: str = Resolution.HOURS_1
+) -> str:
+    """Saves scanned_until as the last candle date of table_name scanned for gaps. Returns the status message."""
+    sql = f"""
+        INSERT INTO {GAP_SCAN_TABLE_NAME} (table_name, resolution, scanned_until)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (table_name, resolution) DO UPDATE SET scanned_until = excluded.scanned_until;
+    """
+    return db_client.send_request(sql, (table_name, resolution, scanned_until))
+
+
+def find_gaps(
+    db_client: DatabaseConnector, table_name: str, since: datetime = None, resolution: str = Resolution.HOURS_1
+) -> dict:
+    """Returns a dict of market: list of (start, end) ranges of candles of resolution missing between the candles of
+    table_name. If since is given, only the candles after since are checked.
+
+    Each candle is compared with the previous one of its market (LAG), so the gaps come straight from a single
+    ordered pass over the rows, without generating every expected candle.
+    """
+    delta = RESOLUTION_DELTAS[resolution]
+    since_str = "AND date >= %(since)s" if since else ""
+
+    sql = f"""
+        SELECT market, previous_date + %(delta)s AS gap_start, date - %(delta)s AS gap_end
+        FROM (
+            SELECT market, date, LAG(date) OVER (PARTITION BY market ORDER BY date) AS previous_date
+            FROM {db_client.get_candles_source(table_name)} AS candles
+            WHERE resolution = %(resolution)s {since_str}
+        ) AS candles
+        WHERE date - previous_date > %(delta)s
+        ORDER BY market, gap_start;
+    """
+    data = db_client.send_query(sql, {"delta": delta, "since": since, "resolution": resolution})
+
+    gaps = {}
+    for market, gap_start, gap_end in data:
+        gaps.setdefault(market, []).append((gap_start, gap_end))
+
+    return gaps
+
+
+def plan_gap_repair(gaps: dict, resolution: str = Resolution.HOURS_1) -> list:
+    """Returns a list of (market, window_start, window_end) with the minimum windows needed to download the gaps.
+    Gaps closer than CANDLES_PER_REQUEST candles share the same window.
+    """
+    max_span = RESOLUTION_DELTAS[resolution] * (CANDLES_PER_REQUEST - 1)
+
+    plan = []
+    for market, ranges in gaps.items():
+        window = None
+        for gap_start, gap_end in sorted(ranges):
+            # The gap fits inside the current window
+            if window and gap_end <= window[0] + max_span:
+                window = (window[0], gap_end)
+                continue
+
+            if window:
+                plan.append((market, *window))
+
+            windows = candle_windows(gap_start, gap_end, resolution)
+            plan += [(market, *w) for w in windows[:-1]]
+            window = windows[-1]
+
+        if window:
+            plan.append((market, *window))
+
+    return plan
+
+
+async def repair_gaps(
+    exchange_client: DydxClient,
+    db_client: DatabaseConnector,
+    table_name: str,
+    since: datetime = None,
+    resolution: str = Resolution.HOURS_1,
+    max_concurrency: int = 20,
+) -> int:
+    """Finds the gaps of table_name after since (see find_gaps) and downloads them from the exchange.
+    Returns the number of candles saved.
+
+    If since is None, the scan starts GAP_SCAN_MARGIN before the last candle scanned by the previous scan (the whole
+    table the first time), and the gap scan checkpoint is updated: to the last candle if no gaps are found, or to the
+    first gap otherwise, so gaps that could not be repaired are scanned again next time. The checkpoint tables must
+    exist (see create_checkpoint_table).
+    """
+    logger = exchange_client.logger
+
+    checkpoint = since is None
+    if checkpoint:
+        scanned_until = get_gap_scan_checkpoint(db_client, table_name, resolution)
+        since = scanned_until - GAP_SCAN_MARGIN if scanned_until else None
+        logger.info(f"Scanning {table_name} for gaps since {since if since else 'the first candle'}.")
+
+        sql = f"SELECT MAX(date) FROM {db_client.get_candles_source(table_name)} AS candles WHERE resolution = %s;"
+        data = db_client.send_query(sql, (resolution,))
+        last_candle = data[0][0] if data else None
+
+    gaps = find_gaps(db_client, table_name, since, resolution)
+    if checkpoint and last_candle:
+        first_gap = min([ranges[0][0] for ranges in gaps.values()], default=last_candle)
+        save_gap_scan_checkpoint(db_client, table_name, first_gap, resolution)
+
+    if not gaps:
+        logger.info(f"No gaps found in {table_name}.")
+        return 0
+
+    plan = plan_gap_repair(gaps, resolution)
+    logger.info(
+        f"Found {sum(len(ranges) for ranges in gaps.values())} gaps in {len(gaps)} markets of {table_name}. "
+        f"Repairing them with {len(plan)} requests..."
+    )
+
+    total_candles = await run_backfill(exchange_client, db_client, table_name, plan, resolution, max_concurrency)
+    logger.info(f"Gaps repaired. {total_candles} candles saved.")
+
+    return total_candles
@@ -0,0 +1,200 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from utils.db_connector import CANDLES_QUERY_COLUMNS
+from utils.dydx_client import RESOLUTION_DELTAS, Resolution
+
+# Cached column: dtype of its file. The date is stored as nanoseconds since epoch (UTC).
+CACHE_COLUMNS = {
+    "date": np.int64,
+    "open_price": np.float64,
+    "close_price": np.float64,
+    "high_price": np.float64,
+    "low_price": np.float64,
+    "volume": np.float64,
+}
+
+# Cached candles that are downloaded again on each read, as the downloader can still rewrite them in the db (the REST
+# lookback of each cycle and the gap scans of dydx_candles.py, GAP_SCAN_LOOKBACK).
+RECHECK_PERIOD = timedelta(days=3)
+
+
+class CandlesCache:
+    """
+    Local columnar cache of the candles of a table, used to avoid querying the db for candles already downloaded.
+
+    Each market is stored on folder_path/table_name/resolution/market/ as one append-only binary file per column,
+    plus a meta.json file with the range of dates covered and the number of rows. The files are opened memory mapped,
+    so reading cached candles does not copy them.
+
+    Only closed candles are cached. Closed candles can still be rewritten in the db for a while (by the next cycles of
+    the downloader and its gap scans), so the cached candles of the last recheck_period are downloaded again on each
+    read that reaches them. A repeated get_candles only queries the db for those candles, the candles after the cached
+    range and the candles not closed yet.
+
+    db_client can be any object with the get_candles method of DatabaseConnector.
+    """
+
+    def __init__(
+        self,
+        db_client,
+        folder_path: str = "./data/candles_cache",
+        table_name: str = "dydx_candles",
+        resolution: str = Resolution.HOURS_1,
+        recheck_period: timedelta = RECHECK_PERIOD,
+    ):
+        self.db_client = db_client
+        self.folder_path = os.path.join(folder_path, table_name, resolution)
+        self.table_name = table_name
+        self.resolution = resolution
+        self.delta = RESOLUTION_DELTAS[resolution]
+        self.recheck_period = recheck_period
+
+    def market_path(self, market: str) -> str:
+        return os.path.join(self.folder_path, market)
+
+    def read_meta(self, market: str) -> dict:
+        """Returns the meta of the market cache, or None if the market is not cached."""
+        try:
+            with open(os.path.join(self.market_path(market), "meta.json"), "r") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        meta["start"] = datetime.fromisoformat(meta["start"])
+        meta["end"] = datetime.fromisoformat(meta["end"])
+
+        return meta
+
+    def write_meta(self, market: str, start: datetime, end: datetime, rows: int):
+        # Written to a temp file and renamed, so the meta is never left half written
+        meta_file = os.path.join(self.market_path(market), "meta.json")
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump({"start": start.isoformat(), "end": end.isoformat(), "rows": rows}, f)
+        os.replace(meta_file + ".tmp", meta_file)
+
+    def write_candles(self, market: str, candle_data: pd.DataFrame, rows: int, start: datetime, end: datetime):
+        """Appends candle_data (ordered by date) after the first rows of the market files and sets the covered range.
+
+        The files are truncated to rows first, so a previous append interrupted before updating the meta is dropped.
+        """
+        os.makedirs(self.market_path(market), exist_ok=True)
+
+        for column, dtype in CACHE_COLUMNS.items():
+            if column == "date":
+                values = candle_data["date"].dt.tz_convert("UTC").dt.tz_localize(None).astype("datetime64[ns]")
+                values = values.to_numpy().view(np.int64)
+            else:
+                values = candle_data[column].to_numpy(dtype=dtype)
+
+            with open(os.path.join(self.market_path(market), f"{column}.bin"), "ab") as f:
+                f.truncate(rows * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(values).tobytes())
+
+        self.write_meta(market, start, end, rows + len(candle_data))
+
+    def rows_before(self, market: str, rows: int, date: datetime) -> int:
+        """Returns the number of cached candles of market (out of rows) that start before date."""
+        if rows == 0:
+            return 0
+        dates = np.memmap(os.path.join(self.market_path(market), "date.bin"), dtype=np.int64, mode="r", shape=(rows,))
+        return int(np.searchsorted(dates, pd.Timestamp(date).value, side="left"))
+
+    def update_market(self, market: str, start: datetime, end: datetime) -> dict:
+        """Downloads from the db the closed candles of market between start and end that are not cached yet, and
+        the cached ones of the last recheck_period. Returns the updated meta."""
+        meta = self.read_meta(market)
+
+        # Nothing cached or missing candles before the cached range: the cache is built again from start
+        if meta is None or start < meta["start"]:
+            end = max(end, meta["end"]) if meta else end
+            candle_data = self.db_client.get_candles(
+                market, start, end, table_name=self.table_name, resolution=self.resolution
+            )
+            self.write_candles(market, candle_data, 0, start, end)
+            return self.read_meta(market)
+
+        # The last cached candles (they may have been rewritten) and the missing candles after the cached range
+        recheck_start = max(meta["start"], meta["end"] - self.recheck_period)
+        if end >= recheck_start:
+            end = max(end, meta["end"])
+            rows = self.rows_before(market, meta["rows"], recheck_start)
+            candle_data = self.db_client.get_candles(
+                market, recheck_start, end, table_name=self.table_name, resolution=self.resolution
+            )
+            self.write_candles(market, candle_data, rows, meta["start"], end)
+
+        return self.read_meta(market)
+
+    def get_market_arrays(self, market: str, start: datetime, end: datetime) -> dict:
+        """Returns a dict of column: array with the cached candles of market between start and end dates.
+
+        The arrays are read only memory mapped views of the cache files (no copy). Dates are int64 nanoseconds since
+        epoch. The range must be already cached (see update_market).
+        """
+        meta = self.read_meta(market)
+        rows = meta["rows"] if meta else 0
+
+        arrays = {}
+        for column, dtype in CACHE_COLUMNS.items():
+            if rows == 0:
+                arrays[column] = np.empty(0, dtype=dtype)
+            else:
+                file_path = os.path.join(self.market_path(market), f"{column}.bin")
+                arrays[column] = np.memmap(file_path, dtype=dtype, mode="r", shape=(rows,))
+
+        first = np.searchsorted(arrays["date"], pd.Timestamp(start).value, side="left")
+        last = np.searchsorted(arrays["date"], pd.Timestamp(end).value, side="right")
+
+        return {column: values[first:last] for column, values in arrays.items()}
+
+    def get_candles(
+        self,
+        market_list: Union[tuple, list, str],
+        start: datetime,
+        end: datetime,
+    ) -> pd.DataFrame:
+        """Returns the candles of market_list between start and end dates, in the same format as
+        DatabaseConnector.get_candles.
+
+        Closed candles are read from the cache (downloading first the ones not cached). Candles not closed yet are
+        read from the db.
+        """
+        market_list = [market_list] if isinstance(market_list, str) else market_list
+
+        # Only closed candles are cached
+        last_closed = datetime.now(timezone.utc) - self.delta
+        cache_end = min(end, last_closed)
+
+        candles = []
+        for market in market_list:
+            if start <= cache_end:
+                self.update_market(market, start, cache_end)
+                arrays = self.get_market_arrays(market, start, cache_end)
+
+                candle_data = pd.DataFrame({column: values for column, values in arrays.items() if column != "date"})
+                candle_data.insert(0, "date", pd.to_datetime(arrays["date"], unit="ns", utc=True))
+                candle_data.insert(1, "market", market)
+                candle_data.insert(2, "resolution", self.resolution)
+                candles.append(candle_data)
+
+        if end > cache_end:
+            live_start = max(start, cache_end + timedelta(microseconds=1))
+            candles.append(
+                self.db_client.get_candles(
+                    market_list, live_start, end, table_name=self.table_name, resolution=self.resolution
+                )
+            )
+
+        candles = [candle_data for candle_data in candles if not candle_data.empty]
+        if not candles:
+            return pd.DataFrame(columns=CANDLES_QUERY_COLUMNS)
+
+        candle_data = pd.concat(candles, ignore_index=True)
+
+        return candle_data.sort_values(by=["date", "market"], kind="stable").reset_index(drop=True)
@@ -1,11 +1,53 @@
-import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Union
+from time import perf_counter
+from typing import Iterator, Union
+from uuid import uuid4
 
+import numpy as np
 import pandas as pd
 import psycopg
+from psycopg_pool import ConnectionPool
 
 from utils.logger import setup_logger
+from utils.metrics import METRICS
+
+CANDLES_QUERY_COLUMNS = [
+    "date",
+    "market",
+    "resolution",
+    "open_price",
+    "close_price",
+    "high_price",
+    "low_price",
+    "volume",
+]
+
+# Resolution: bucket size of the rollup tables kept from the 1-hour candles (see get_rollup_tables)
+ROLLUP_BASE_RESOLUTION = "1HOUR"
+ROLLUP_RESOLUTIONS = {
+    "4HOURS": timedelta(hours=4),
+    "1DAY": timedelta(days=1),
+}
+# Buckets are aligned to midnight UTC, like the exchange candles
+ROLLUP_ORIGIN = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# Time a market ranking is cached (see rank_markets)
+MARKET_RANKING_TTL = timedelta(minutes=10)
+
+# Resolutions of the exchange. Their position is the resolution code of the binary reads (see get_candles_binary).
+RESOLUTIONS = ["1MIN", "5MINS", "15MINS", "30MINS", "1HOUR", "4HOURS", "1DAY"]
+PRICE_COLUMNS = ["open_price", "close_price", "high_price", "low_price", "volume"]
+# Microseconds between the epoch and 2000-01-01, the origin of the binary timestamps
+POSTGRES_EPOCH_US = 946684800000000
+
+MARKETS_TABLE_NAME = "markets"
+RESOLUTIONS_TABLE_NAME = "resolutions"
+# Dictionary encoded column of compact tables: (decoded column, lookup table). See get_candles_source.
+DICTIONARY_COLUMNS = {
+    "market_id": ("market", MARKETS_TABLE_NAME),
+    "resolution_id": ("resolution", RESOLUTIONS_TABLE_NAME),
+}
 
 
 class DatabaseConnector:
@@ -20,9 +62,22 @@ class DatabaseConnector:
             "user": "example_user",
             "password": "example_user_password"
         }
+
+    If pooled == True, connections are kept open in a pool between calls instead of opening a new connection for
+    each call. pool_min_size and pool_max_size bound the number of open connections, pool_max_idle (seconds) closes
+    connections above pool_min_size that were not used for that time, and every connection is checked before being
+    lent so broken connections are replaced transparently.
     """
 
-    def __init__(self, db_credentials: dict, logger=None):
+    def __init__(
+        self,
+        db_credentials: dict,
+        logger=None,
+        pooled: bool = False,
+        pool_min_size: int = 1,
+        pool_max_size: int = 4,
+        pool_max_idle: float = 600.0,
+    ):
         self.conninfo_str = f"""
         host={db_credentials["host"]}
         port={db_credentials["port"]}
@@ -33,10 +88,283 @@ class DatabaseConnector:
 
         self.logger = logger if logger else setup_logger(name="db_client_logger")
 
+        # Cached table columns, keyed by table name. Filled on first use by get_table_columns.
+        self.table_columns = {}
+        # Rows upserted by insert_candles since the start. Unchanged rows are not written (no dead tuples, no WAL).
+        self.upsert_counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        # Existing rollup tables, keyed by table name. Filled on first use by get_rollup_tables.
+        self.rollup_tables = {}
+        # Cached market rankings, keyed by the arguments of rank_markets: (time computed, ranking)
+        self.market_rankings = {}
+
+        self.pool = None
+        if pooled:
+            self.pool = ConnectionPool(
+                self.conninfo_str,
+                min_size=pool_min_size,
+                max_size=pool_max_size,
+                max_idle=pool_max_idle,
+                check=ConnectionPool.check_connection,
+                name="db_client_pool",
+                open=True,
+            )
+
+    def close(self):
+        """Closes the connection pool, if any."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def pool_stats(self) -> dict:
+        """Returns the stats of the connection pool (size, available connections, requests waiting...), or an empty
+        dict if not pooled."""
+        if self.pool is None:
+            return {}
+        return self.pool.get_stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that lends a connection.
+
+        In pooled mode the connection is borrowed from the pool and given back on exit, otherwise a new connection is
+        opened and closed on exit. In both cases the transaction is committed on success and rolled back on error.
+        """
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            with psycopg.connect(self.conninfo_str) as conn:
+                yield conn
+
+    def get_table_columns(self, table_name: str, cur: psycopg.Cursor = None) -> list:
+        """Returns a list of (column_name, udt_name) for table_name, in ordinal order.
+
+        The result is cached, so the information_schema is only queried once per table.
+        An empty list is returned (and not cached) if the table does not exist.
+        """
+        if table_name in self.table_columns:
+            return self.table_columns[table_name]
+
+        sql = """
+            SELECT column_name, udt_name
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+            AND table_name = %s
+            ORDER BY ordinal_position;
+        """
+        if cur is None:
+            columns = self.send_query(sql, (table_name,))
+        else:
+            cur.execute(sql, (table_name,))
+            columns = cur.fetchall()
+
+        columns = [tuple(column) for column in columns] if columns else []
+        if columns:
+            self.table_columns[table_name] = columns
+
+        return columns
+
+    def get_staging_columns(self, table_name: str, cur: psycopg.Cursor = None) -> list:
+        """Returns a list of (column_name, udt_name) with the columns of the candles of table_name as they are inserted
+        and queried: without the id, and with the dictionary encoded columns of compact tables decoded as text."""
+        return [
+            (DICTIONARY_COLUMNS[column][0], "text") if column in DICTIONARY_COLUMNS else (column, udt)
+            for column, udt in self.get_table_columns(table_name, cur)
+            if column != "id"
+        ]
+
+    def get_candles_source(self, table_name: str, cur: psycopg.Cursor = None) -> str:
+        """Returns what to select the candles of table_name from: table_name itself, or for compact tables (with
+        dictionary encoded market_id and resolution_id columns) a sub query that decodes them by joining the lookup
+        tables. Both can be used as FROM {source} AS alias.
+        """
+        table_columns = [column for column, _ in self.get_table_columns(table_name, cur) if column != "id"]
+        if not any(column in DICTIONARY_COLUMNS for column in table_columns):
+            return table_name
+
+        select_list, joins = [], []
+        for column in table_columns:
+            if column in DICTIONARY_COLUMNS:
+                decoded_column, lookup_table_name = DICTIONARY_COLUMNS[column]
+                select_list.append(f"{lookup_table_name}.{decoded_column}")
+                joins.append(f"JOIN {lookup_table_name} ON {lookup_table_name}.{column} = compact.{column}")
+            else:
+                select_list.append(f"compact.{column}")
+
+        return f"(SELECT {', '.join(select_list)} FROM {table_name} AS compact {' '.join(joins)})"
+
+    @staticmethod
+    def candles_table_name(table_name: str, resolution: str = None) -> str:
+        """Returns the name of the table with the candles of table_name at resolution (table_name itself for 1-hour
+        candles, the rollup table otherwise)."""
+        if resolution is None or resolution not in ROLLUP_RESOLUTIONS:
+            return table_name
+        return f"{table_name}_{resolution.lower()}"
+
+    def get_rollup_tables(self, table_name: str, cur: psycopg.Cursor = None) -> list:
+        """Returns a list of (rollup_table_name, resolution) with the rollup tables of table_name that exist.
+
+        The result is cached, so tables created later are only seen by new DatabaseConnector instances.
+        """
+        if table_name in self.rollup_tables:
+            return self.rollup_tables[table_name]
+
+        rollup_tables = []
+        for resolution in ROLLUP_RESOLUTIONS:
+            rollup_table_name = self.candles_table_name(table_name, resolution)
+            sql = "SELECT to_regclass(%s) IS NOT NULL;"
+            if cur is None:
+                data = self.send_query(sql, (rollup_table_name,))
+            else:
+                cur.execute(sql, (rollup_table_name,))
+                data = cur.fetchall()
+
+            if data and data[0][0]:
+                rollup_tables.append((rollup_table_name, resolution))
+
+        self.rollup_tables[table_name] = rollup_tables
+
+        return rollup_tables
+
+    @staticmethod
+    def rollup_query(candles_source: str, rollup_table_name: str, resolution: str, candles_from: str) -> str:
+        """Returns the sql to recompute the rollup_table_name candles of the buckets with candles in candles_from
+        (a table or a sub query with market and date columns), from the candles of candles_source (see
+        get_candles_source).
+
+        For each market only the buckets between its first and last candle in candles_from are read and upserted, so
+        the cost depends on the new candles, not on the history. Buckets with the same values are not rewritten.
+        """
+        return f"""
+            INSERT INTO {rollup_table_name}
+                (date, updated, market, resolution, open_price, close_price, high_price, low_price, volume)
+            SELECT
+                date_bin(%(delta)s, candles.date, %(origin)s) AS bucket,
+                MAX(candles.updated),
+                candles.market,
+                '{resolution}',
+                (ARRAY_AGG(candles.open_price ORDER BY candles.date))[1],
+                (ARRAY_AGG(candles.close_price ORDER BY candles.date DESC))[1],
+                MAX(candles.high_price),
+                MIN(candles.low_price),
+                SUM(candles.volume)
+            FROM (
+                SELECT
+                    market,
+                    date_bin(%(delta)s, MIN(date), %(origin)s) AS range_start,
+                    date_bin(%(delta)s, MAX(date), %(origin)s) + %(delta)s AS range_end
+                FROM {candles_from} AS new_candles
+                GROUP BY market
+            ) AS ranges
+            JOIN {candles_source} AS candles
+            ON candles.market = ranges.market
+            AND candles.date >= ranges.range_start
+            AND candles.date < ranges.range_end
+            AND candles.resolution = '{ROLLUP_BASE_RESOLUTION}'
+            GROUP BY bucket, candles.market
+            ON CONFLICT (date, market, resolution)
+            DO UPDATE SET
+                updated = excluded.updated,
+                open_price = excluded.open_price,
+                close_price = excluded.close_price,
+                high_price = excluded.high_price,
+                low_price = excluded.low_price,
+                volume = excluded.volume
+            WHERE ({rollup_table_name}.open_price, {rollup_table_name}.close_price, {rollup_table_name}.high_price,
+                {rollup_table_name}.low_price, {rollup_table_name}.volume)
+            IS DISTINCT FROM (excluded.open_price, excluded.close_price, excluded.high_price, excluded.low_price,
+                excluded.volume);
+        """
+
+    def refresh_rollups(self, table_name: str, start: datetime = None, end: datetime = None) -> str:
+        """Recomputes the rollup tables of table_name between start and end dates (all the table by default) and
+        return the status message.
+
+        insert_candles keeps the rollups up to date, use it to fill the rollup tables of a table with previous data.
+        """
+        candles_source = self.get_candles_source(table_name)
+        where_str = "WHERE date BETWEEN %(start)s AND %(end)s" if start or end else ""
+        candles_from = f"(SELECT market, date FROM {candles_source} AS candles {where_str})"
+        values = {
+            "origin": ROLLUP_ORIGIN,
+            "start": start if start else datetime.min.replace(tzinfo=timezone.utc),
+            "end": end if end else datetime.max.replace(tzinfo=timezone.utc),
+        }
+
+        status = "INSERT 0 0"
+        for rollup_table_name, resolution in self.get_rollup_tables(table_name):
+            sql = self.rollup_query(candles_source, rollup_table_name, resolution, candles_from)
+            status = self.send_request(sql, {**values, "delta": ROLLUP_RESOLUTIONS[resolution]})
+            if status == "":
+                return status
+
+        return status
+
+    def rank_markets(
+        self,
+        number_of_markets: int = 25,
+        window: timedelta = timedelta(days=180),
+        end: datetime = None,
+        table_name: str = "dydx_candles",
+        market_list: Union[tuple, list] = None,
+    ) -> list:
+        """Returns a list of (market, volume_usd) with the number_of_markets markets with the most volume traded in usd
+        (volume * close price) between end - window and end (now by default), sorted by volume.
+
+        The volume is summed with a single query on the 1DAY rollup table of table_name if it exists, or on the 1-hour
+        candles of table_name otherwise. If market_list is given, only its markets are ranked (for example, the
+        online markets).
+
+        Rankings are cached for MARKET_RANKING_TTL, and dropped when candles are inserted into table_name with this
+        DatabaseConnector. Candles inserted by other processes are seen after the TTL.
+        """
+        key = (table_name, number_of_markets, window, end, tuple(sorted(market_list)) if market_list else None)
+        now = datetime.now(timezone.utc)
+        if key in self.market_rankings and now - self.market_rankings[key][0] < MARKET_RANKING_TTL:
+            return list(self.market_rankings[key][1])
+
+        resolution = "1DAY"
+        if (self.candles_table_name(table_name, resolution), resolution) not in self.get_rollup_tables(table_name):
+            resolution = ROLLUP_BASE_RESOLUTION
+        candles_source = self.get_candles_source(self.candles_table_name(table_name, resolution))
+
+        market_str = "AND market = ANY(%(markets)s)" if market_list else ""
+        sql = f"""
+            SELECT market, SUM(volume * close_price) AS volume_usd
+            FROM {candles_source} AS candles
+            WHERE date >= %(start)s AND date < %(end)s
+            AND resolution = %(resolution)s
+            {market_str}
+            GROUP BY market
+            ORDER BY volume_usd DESC NULLS LAST, market
+            LIMIT %(limit)s;
+        """
+        values = {
+            "start": (end if end else now) - window,
+            "end": end if end else now,
+            "resolution": resolution,
+            "markets": list(market_list) if market_list else None,
+            "limit": number_of_markets,
+        }
+        data = self.send_query(sql, values)
+        if data == "":
+            return []
+
+        ranking = [(market, float(volume_usd) if volume_usd is not None else 0.0) for market, volume_usd in data]
+        self.market_rankings[key] = (now, ranking)
+
+        return list(ranking)
+
     def send_request(self, sql: str, values: tuple = ()) -> str:
         """Sends sql query to the db and return the status message."""
         try:
-            with psycopg.connect(self.conninfo_str) as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(sql, values)
                     status = cur.statusmessage
@@ -49,13 +377,14 @@ class DatabaseConnector:
 
         return status
 
-    def send_query(self, sql: str, values: tuple = ()) -> str:
-        """Sends sql query to the db and return all data queried."""
+    def send_many(self, sql: str, values_list: list) -> str:
+        """Sends sql query to the db once for each values of values_list, in a single transaction.
+        Return the status message."""
         try:
-            with psycopg.connect(self.conninfo_str) as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute(sql, values)
-                    data = cur.fetchall()
+                    cur.executemany(sql, values_list)
+                    status = cur.statusmessage
                     conn.commit()
 
         except psycopg.Error as e:
@@ -63,85 +392,218 @@ class DatabaseConnector:
             self.logger.error("Unable to execute command.")
             return ""
 
-        return data
+        return status
+
+    def send_query(self, sql: str, values: tuple = (), prepare: bool = None) -> str:
+        """Sends sql query to the db and return all data queried.
 
-    def insert_candles(self, table_name: str, candles_data: pd.DataFrame):
-        # Saves candle_data on a temp csv file.
+        If prepare == True the statement is prepared server side, so repeated calls on a pooled connection skip
+        parsing and planning.
+        """
         try:
-            temp_file = f"./temp_{table_name}.csv"
-            candles_data.to_csv(temp_file, index=False, header=False)
-        except Exception as e:
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, values, prepare=prepare)
+                    data = cur.fetchall()
+                    conn.commit()
+
+        except psycopg.Error as e:
             self.logger.error(e)
-            self.logger.error("Unable to save data as temp csv.")
-            return
+            self.logger.error("Unable to execute command.")
+            return ""
+
+        return data
+
+    def insert_candles(self, table_name: str, candles_data: pd.DataFrame, keep_newer: bool = False) -> str:
+        """Upserts candles_data into table_name and return the status message of the upsert.
+
+        The DataFrame columns are streamed from memory into a session scoped staging table with a binary COPY, and
+        upserted from there into table_name. Only the DataFrame columns that exist in table_name are copied.
+
+        In compact tables, market and resolution are encoded into their ids by joining the lookup tables. New markets
+        and resolutions are added to the lookup tables first.
+
+        Rows are keyed on (date, market, resolution). Existing rows are only updated if any value changed, so candles
+        downloaded again without changes do not produce dead tuples. The number of rows inserted, updated and unchanged
+        is logged and added to upsert_counts.
+
+        If keep_newer == True, existing rows updated later than (or at the same time as) the new candle are not
+        overwritten. The trades collector uses it, so a bar saved late does not overwrite the candle reconciled by the
+        downloader.
+
+        The buckets of the rollup tables of table_name (see get_rollup_tables) with new candles are recomputed in the
+        same transaction.
+        """
+        if candles_data.empty:
+            return "INSERT 0 0"
 
-        # Reads the temp csv file and inserts the data into the table_name
         try:
-            with psycopg.connect(self.conninfo_str) as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cur:
-                    # Get the table columns from the table
+                    # Get the table columns from the table. The staging table holds every column except the id,
+                    # with market and resolution decoded.
+                    table_columns = [col[0] for col in self.get_table_columns(table_name, cur) if col[0] != "id"]
+                    staging_columns = self.get_staging_columns(table_name, cur)
+                    staging_columns_str = ", ".join([col[0] for col in staging_columns])
+                    candles_source = self.get_candles_source(table_name, cur)
+
+                    copy_columns = [col for col in staging_columns if col[0] in candles_data.columns]
+                    copy_names = [col[0] for col in copy_columns]
+                    copy_columns_str = ", ".join(copy_names)
+
+                    # Create the staging table once per session. Its rows are deleted on each commit.
                     cur.execute(
-                        f"""SELECT column_name
-                        FROM information_schema.columns
-                        WHERE table_schema = 'public'
-                        AND table_name   = '{table_name}'
-                        ORDER BY ordinal_position;"""
+                        f"""CREATE TEMPORARY TABLE IF NOT EXISTS staging_table_{table_name}
+                        ON COMMIT DELETE ROWS
+                        AS SELECT {staging_columns_str} FROM {candles_source} AS candles
+                        WITH NO DATA;"""
                     )
-                    table_columns = cur.fetchall()
-                    table_columns.pop(0)
-                    table_columns = [x[0] for x in table_columns]
-                    table_columns_str = ", ".join(table_columns)
 
-                    # Create a staging table
+                    # Copy the data from the DataFrame to the staging table
+                    copy_start = perf_counter()
+                    with cur.copy(
+                        f"COPY staging_table_{table_name} ({copy_columns_str}) FROM STDIN WITH (FORMAT BINARY);"
+                    ) as copy:
+                        copy.set_types([col[1] for col in copy_columns])
+                        for row in zip(*[candles_data[col].tolist() for col in copy_names]):
+                            copy.write_row(row)
+                    copy_time = perf_counter() - copy_start
+
+                    # Encode the dictionary columns, adding the new values to the lookup tables
+                    insert_names, select_list, joins = [], [], []
+                    for table_column, (staging_column, _) in zip(table_columns, staging_columns):
+                        if staging_column not in copy_names:
+                            continue
+
+                        insert_names.append(table_column)
+                        if table_column in DICTIONARY_COLUMNS:
+                            lookup_table_name = DICTIONARY_COLUMNS[table_column][1]
+                            # Only the missing values are inserted, so no ids of the sequence are wasted
+                            cur.execute(
+                                f"""INSERT INTO {lookup_table_name} ({staging_column})
+                                SELECT DISTINCT {staging_column} FROM staging_table_{table_name} AS staging
+                                WHERE NOT EXISTS (
+                                    SELECT 1 FROM {lookup_table_name}
+                                    WHERE {lookup_table_name}.{staging_column} = staging.{staging_column}
+                                )
+                                ON CONFLICT DO NOTHING;"""
+                            )
+                            select_list.append(f"{lookup_table_name}.{table_column}")
+                            joins.append(
+                                f"JOIN {lookup_table_name} "
+                                f"ON {lookup_table_name}.{staging_column} = staging.{staging_column}"
+                            )
+                        else:
+                            select_list.append(f"staging.{table_column}")
+
+                    key_columns = ["date", "market", "resolution"]
+                    if "market_id" in table_columns:
+                        key_columns = ["date", "market_id", "resolution_id"]
+                    value_columns = [col for col in insert_names if col not in key_columns]
+
+                    # Count the staged rows already in table_name, to tell inserted and updated rows apart
+                    select_dict = dict(zip(insert_names, select_list))
+                    key_conditions_str = " AND ".join([f"current.{col} = {select_dict[col]}" for col in key_columns])
                     cur.execute(
-                        f"""CREATE TEMPORARY TABLE staging_table_{table_name}
-                        (LIKE {table_name}
-                        INCLUDING constraints
-                        INCLUDING indexes);"""
+                        f"""SELECT COUNT(*)
+                        FROM staging_table_{table_name} AS staging
+                        {" ".join(joins)}
+                        JOIN {table_name} AS current ON {key_conditions_str};"""
                     )
-                    if cur.statusmessage != "CREATE TABLE":
-                        self.logger.error(cur.statusmessage)
-                        self.logger.error("Unable to create staging table.")
-                        return
+                    existing_rows = cur.fetchone()[0]
 
-                    cur.execute(f"CREATE SEQUENCE staging_table_{table_name}_id_seq;")
+                    # Insert data from staging table to table_name. Rows without changes are skipped.
+                    do_update_columns_str = ", ".join([f"{col} = excluded.{col}" for col in value_columns])
+                    current_values_str = ", ".join([f"{table_name}.{col}" for col in value_columns])
+                    new_values_str = ", ".join([f"excluded.{col}" for col in value_columns])
+                    keep_newer_str = f"AND {table_name}.updated < excluded.updated" if keep_newer else ""
                     cur.execute(
-                        f"ALTER TABLE staging_table_{table_name} ALTER COLUMN id SET DEFAULT nextval('staging_table_{table_name}_id_seq');"
-                    )
-                    if cur.statusmessage != "ALTER TABLE":
-                        self.logger.error(cur.statusmessage)
-                        self.logger.error("Unable to alter staging table.")
-                        return
-
-                    # Copy the data from the csv to the staging table
-                    with open(temp_file, "r") as f:
-                        with cur.copy(
-                            f"""COPY staging_table_{table_name} ({table_columns_str}) FROM STDIN WITH (FORMAT CSV);
-                            """
-                        ) as copy:
-                            while data := f.read(8192):
-                                copy.write(data)
-
-                    cur.execute(f"DROP SEQUENCE IF EXISTS staging_table_{table_name}_id_seq CASCADE;")
-
-                    # Insert data from staging table to table_name
-                    do_update_columns_str = ", ".join([f"{col} = excluded.{col}" for col in table_columns])
-                    cur.execute(
-                        f"""INSERT INTO {table_name} ({table_columns_str})
-                        SELECT {table_columns_str}
-                        FROM staging_table_{table_name}
-                        ON CONFLICT (date, market)
-                        DO UPDATE SET {do_update_columns_str};
+                        f"""INSERT INTO {table_name} ({", ".join(insert_names)})
+                        SELECT {", ".join(select_list)}
+                        FROM staging_table_{table_name} AS staging
+                        {" ".join(joins)}
+                        ON CONFLICT ({", ".join(key_columns)})
+                        DO UPDATE SET {do_update_columns_str}
+                        WHERE ROW({current_values_str}) IS DISTINCT FROM ROW({new_values_str}) {keep_newer_str};
                         """
                     )
-                    self.logger.debug(cur.statusmessage)
+                    status = cur.statusmessage
+                    self.logger.debug(status)
+
+                    # The row count only includes the rows written
+                    inserted_rows = len(candles_data) - existing_rows
+                    updated_rows = cur.rowcount - inserted_rows
+                    upsert_counts = {
+                        "inserted": inserted_rows,
+                        "updated": updated_rows,
+                        "unchanged": existing_rows - updated_rows,
+                    }
+
+                    # Refresh the rollup buckets of the staged candles
+                    for rollup_table_name, resolution in self.get_rollup_tables(table_name, cur):
+                        sql = self.rollup_query(
+                            candles_source, rollup_table_name, resolution, f"staging_table_{table_name}"
+                        )
+                        cur.execute(sql, {"delta": ROLLUP_RESOLUTIONS[resolution], "origin": ROLLUP_ORIGIN})
+                        self.logger.debug(f"{rollup_table_name}: {cur.statusmessage}")
+
+                    total_time = perf_counter() - copy_start
+                    METRICS.observe("stage_seconds", copy_time, stage="copy")
+                    METRICS.observe("stage_seconds", total_time - copy_time, stage="upsert")
+
+                    rows = len(candles_data)
+                    self.logger.debug(
+                        f"{rows} rows copied in {copy_time:.3f}s ({rows / max(copy_time, 1e-9):.0f} rows/s), "
+                        f"upserted in {total_time:.3f}s ({rows / max(total_time, 1e-9):.0f} rows/s). "
+                        f"Inserted: {upsert_counts['inserted']}, updated: {upsert_counts['updated']}, "
+                        f"unchanged: {upsert_counts['unchanged']}."
+                    )
 
-                    # Delete temp csv file
-                    os.remove(f"./temp_{table_name}.csv")
+            # Only counted once committed
+            for key, value in upsert_counts.items():
+                self.upsert_counts[key] += value
+                METRICS.inc("upserted_rows_total", value, table=table_name, result=key)
+
+            # The market rankings of table_name are out of date
+            for key in [key for key in self.market_rankings if key[0] == table_name]:
+                del self.market_rankings[key]
 
         except psycopg.Error as e:
             self.logger.error(e)
             self.logger.error("Unable to execute command.")
+            return ""
+
+        return status
+
+    @staticmethod
+    def candles_query(
+        market_list: Union[tuple, list, str], start: datetime, end: datetime, table_name: str, resolution: str = None
+    ) -> tuple:
+        """Returns the (sql, values) to select the candles of market_list between start and end, ordered by date. If
+        resolution is given, only the candles of resolution are selected. table_name can be a sub query too (see
+        get_candles_source)."""
+        market_list = [market_list] if isinstance(market_list, str) else list(market_list)
+        resolution_str = "AND resolution = %s" if resolution else ""
+
+        sql = f"""
+            SELECT {", ".join(CANDLES_QUERY_COLUMNS)} FROM {table_name} AS candles
+            WHERE date BETWEEN %s AND %s
+            AND market = ANY(%s)
+            {resolution_str}
+            ORDER BY date, market
+        """
+
+        return sql, (start, end, market_list) + ((resolution,) if resolution else ())
+
+    @staticmethod
+    def candles_frame(data: list) -> pd.DataFrame:
+        """Returns a typed DataFrame from the rows of a candles_query."""
+        candle_data = pd.DataFrame(data if data else [], columns=CANDLES_QUERY_COLUMNS)
+        candle_data["date"] = pd.to_datetime(candle_data["date"], utc=True)
+        for column in ["open_price", "close_price", "high_price", "low_price", "volume"]:
+            candle_data[column] = candle_data[column].astype(float)
+
+        return candle_data
 
     def get_candles(
         self,
@@ -151,46 +613,151 @@ class DatabaseConnector:
         table_name: str = "dydx_candles",
         to_file: bool = False,
         file_path: str = "./dydx_candles.pkl",
+        resolution: str = None,
     ):
+        """Returns the candles of market_list between start and end dates.
+
+        If resolution is 4HOURS or 1DAY the candles are read from the rollup table of table_name. If resolution is
+        given, only the candles of resolution are returned: none for a resolution that is not stored, instead of the
+        candles of another one.
+        """
         start = end - timedelta(hours=1) if start == None else start
-        market_list = [market_list] if isinstance(market_list, str) else market_list
 
-        market_placeholders = ",".join(["%s"] * len(market_list))
+        # Send the query
+        candles_source = self.get_candles_source(self.candles_table_name(table_name, resolution))
+        sql, values = self.candles_query(market_list, start, end, candles_source, resolution)
+        data = self.send_query(sql, values, prepare=True)
 
-        sql = f"""
-            SELECT date, market, resolution, open_price, close_price, high_price, low_price, volume FROM {table_name}
-            WHERE date BETWEEN %s AND %s
-            AND market IN ({market_placeholders})
+        candle_data = self.candles_frame(data)
+
+        if to_file:
+            candle_data.to_pickle(file_path)
+
+        return candle_data
+
+    def iter_candles(
+        self,
+        market_list: Union[tuple, list, str],
+        start: datetime,
+        end: datetime,
+        table_name: str = "dydx_candles",
+        chunk_size: int = 100000,
+        resolution: str = None,
+    ) -> Iterator[pd.DataFrame]:
+        """Yields the candles of market_list between start and end dates in DataFrames of at most chunk_size rows,
+        ordered by date. resolution selects the candles like in get_candles.
+
+        The rows are read through a server side cursor, so only one chunk is held in memory at a time. Use it to
+        process datasets that do not fit in memory. The connection is held until the iterator is exhausted or closed.
+
+        Unlike get_candles, db errors are raised (psycopg.Error) after being logged, as the chunks already yielded
+        could not be told apart from a complete result otherwise.
         """
+        candles_source = self.get_candles_source(self.candles_table_name(table_name, resolution))
+        sql, values = self.candles_query(market_list, start, end, candles_source, resolution)
+
+        try:
+            with self.connection() as conn:
+                with conn.cursor(name=f"iter_candles_{uuid4().hex}") as cur:
+                    cur.itersize = chunk_size
+                    cur.execute(sql, values)
+                    while data := cur.fetchmany(chunk_size):
+                        yield self.candles_frame(data)
 
-        # Add the start and end values to the values tuple
-        values = (start, end) + tuple(market_list)
+        except psycopg.Error as e:
+            self.logger.error(e)
+            self.logger.error("Unable to read all the candles.")
+            raise
 
-        # Send the query
-        data = self.send_query(sql, values)
+    def get_candles_binary(
+        self,
+        market_list: Union[tuple, list, str],
+        start: datetime,
+        end: datetime,
+        table_name: str = "dydx_candles",
+        resolution: str = None,
+        price_dtype=np.float64,
+    ) -> pd.DataFrame:
+        """Returns the candles of market_list between start and end dates, like get_candles, for bulk reads.
 
-        candle_data = pd.DataFrame(
-            data,
-            columns=["date", "market", "resolution", "open_price", "close_price", "high_price", "low_price", "volume"],
+        Each column is sent as a single bytea with the binary (COPY) encoding of its values one after the other: dates
+        as int64 microseconds since 2000-01-01, market and resolution as int16 positions in market_list and RESOLUTIONS,
+        and prices as price_dtype (np.float64 or np.float32). Every value has a fixed width, so each column is decoded
+        at once with np.frombuffer, without any Python object per row. Market and resolution are returned as
+        categorical columns.
+
+        A binary COPY TO STDOUT is not used, as it sends one message per row, which are read one by one in Python.
+
+        A bytea value is at most 1 GB, so a column can not be larger than that: about 130 million candles with float64
+        prices (8 bytes per value). Split larger reads into several date ranges.
+        """
+        # Unique markets, as they are the categories of the market column
+        market_list = [market_list] if isinstance(market_list, str) else list(dict.fromkeys(market_list))
+        candles_source = self.get_candles_source(self.candles_table_name(table_name, resolution))
+
+        price_type = "float8" if np.dtype(price_dtype) == np.float64 else "float4"
+        columns_sql = {
+            "date": "timestamptz_send(date)",
+            "market": "int2send(market_code::int2)",
+            "resolution": "int2send(COALESCE(resolution_code, 0)::int2)",
+        }
+        for column in PRICE_COLUMNS:
+            columns_sql[column] = f"{price_type}send(COALESCE({column}, 'NaN')::{price_type})"
+        # string_agg skips null values, so none must be aggregated. Each aggregate sorts on its own: the order must be on
+        # the unique key of the candles, so that every column comes back in the same row order
+        aggregates_str = ", ".join(
+            [
+                f"string_agg({column_sql}, ''::bytea ORDER BY date, market, resolution)"
+                for column_sql in columns_sql.values()
+            ]
         )
 
-        candle_data = candle_data.astype(
+        sql = f"""
+            SELECT {aggregates_str}
+            FROM {candles_source} AS candles
+            JOIN unnest(%(markets)s::text[]) WITH ORDINALITY AS markets(market, market_code) USING (market)
+            LEFT JOIN unnest(%(resolutions)s::text[]) WITH ORDINALITY AS resolutions(resolution, resolution_code)
+            USING (resolution)
+            WHERE date BETWEEN %(start)s AND %(end)s
+            {"AND resolution = %(resolution)s" if resolution else ""};
+        """
+        values = {
+            "markets": market_list,
+            "resolutions": RESOLUTIONS,
+            "start": start,
+            "end": end,
+            "resolution": resolution,
+        }
+
+        try:
+            with self.connection() as conn:
+                with conn.cursor(binary=True) as cur:
+                    cur.execute(sql, values)
+                    data = cur.fetchone()
+
+        except psycopg.Error as e:
+            self.logger.error(e)
+            self.logger.error("Unable to execute command.")
+            data = None
+
+        # Big endian dtype of each column
+        dtypes = {"date": ">i8", "market": ">i2", "resolution": ">i2"}
+        dtypes.update({column: np.dtype(price_dtype).newbyteorder(">") for column in PRICE_COLUMNS})
+
+        arrays = {}
+        for (column, dtype), column_bytes in zip(dtypes.items(), data if data else [None] * len(dtypes)):
+            column_values = np.frombuffer(column_bytes if column_bytes else b"", dtype=dtype)
+            arrays[column] = column_values.astype(column_values.dtype.newbyteorder("="))
+
+        dates = (arrays["date"] + POSTGRES_EPOCH_US) * 1000
+        candle_data = pd.DataFrame(
             {
-                "date": str,
-                "market": str,
-                "resolution": str,
-                "open_price": float,
-                "close_price": float,
-                "high_price": float,
-                "low_price": float,
-                "volume": float,
+                "date": pd.DatetimeIndex(dates.view("datetime64[ns]"), tz="UTC"),
+                "market": pd.Categorical.from_codes(arrays["market"] - 1, categories=market_list),
+                "resolution": pd.Categorical.from_codes(arrays["resolution"] - 1, categories=RESOLUTIONS),
             }
         )
-
-        candle_data["date"] = pd.to_datetime(candle_data["date"], utc=True)
-        candle_data = candle_data.sort_values(by="date").reset_index(drop=True)
-
-        if to_file:
-            candle_data.to_pickle(file_path)
+        for column in PRICE_COLUMNS:
+            candle_data[column] = arrays[column]
 
         return candle_data
@@ -0,0 +1,324 @@
+from datetime import datetime, timezone
+
+import psycopg
+
+from utils.db_connector import (
+    DICTIONARY_COLUMNS,
+    MARKETS_TABLE_NAME,
+    RESOLUTIONS_TABLE_NAME,
+    ROLLUP_RESOLUTIONS,
+    DatabaseConnector,
+)
+
+
+def lookup_tables_sql() -> str:
+    """Returns the sql to create the markets and resolutions lookup tables of the compact candles tables."""
+    return f"""
+        CREATE TABLE IF NOT EXISTS {MARKETS_TABLE_NAME} (
+            market_id SMALLSERIAL PRIMARY KEY,
+            market TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS {RESOLUTIONS_TABLE_NAME} (
+            resolution_id SMALLSERIAL PRIMARY KEY,
+            resolution TEXT UNIQUE NOT NULL
+        );
+    """
+
+
+def candles_table_sql(table_name: str, partitioned: bool = False, compact: bool = False) -> str:
+    """Returns the sql to create the candles table (see create_candles_table)."""
+    if compact:
+        partition_str = "PARTITION BY RANGE (date)" if partitioned else ""
+        # Columns ordered from the widest to the narrowest, so no space is lost to alignment padding
+        return f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                date TIMESTAMP WITH TIME ZONE NOT NULL,
+                updated TIMESTAMP WITH TIME ZONE,
+                market_id SMALLINT NOT NULL,
+                resolution_id SMALLINT,
+                open_price REAL,
+                close_price REAL,
+                high_price REAL,
+                low_price REAL,
+                volume REAL
+            ) {partition_str};
+        """
+
+    if partitioned:
+        return f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                date TIMESTAMP WITH TIME ZONE NOT NULL,
+                updated TIMESTAMP WITH TIME ZONE,
+                market TEXT,
+                resolution TEXT,
+                open_price REAL,
+                close_price REAL,
+                high_price REAL,
+                low_price REAL,
+                volume REAL
+            ) PARTITION BY RANGE (date);
+        """
+
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id BIGSERIAL PRIMARY KEY,
+            date TIMESTAMP WITH TIME ZONE,
+            updated TIMESTAMP WITH TIME ZONE,
+            market TEXT,
+            resolution TEXT,
+            open_price REAL,
+            close_price REAL,
+            high_price REAL,
+            low_price REAL,
+            volume REAL
+        );
+    """
+
+
+def candles_indexes_sql(table_name: str, partitioned: bool = False, compact: bool = False) -> str:
+    """Returns the sql to create the indexes of the candles table (see create_candles_indexes)."""
+    key_columns_str = "date, market_id, resolution_id" if compact else "date, market, resolution"
+    # The previous (date, market) unique index is replaced in the same transaction
+    sql = f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_idx_date_market_resolution
+            ON {table_name} ({key_columns_str});
+        DROP INDEX IF EXISTS {table_name}_idx_date_market;
+    """
+    if partitioned:
+        sql += f"""
+            CREATE INDEX IF NOT EXISTS {table_name}_brin_date
+                ON {table_name} USING BRIN (date);
+        """
+
+    return sql
+
+
+def create_candles_table(
+    db_client: DatabaseConnector, table_name: str, partitioned: bool = False, compact: bool = False
+) -> str:
+    """Creates the candles table if it does not exist. Returns the status message.
+
+    If partitioned == True the table is partitioned by month on date (see create_month_partitions) and has no id
+    column, as nothing reads it.
+
+    If compact == True market and resolution are stored as smallint ids of the markets and resolutions lookup tables
+    (created too), and there is no id column. Rows and index keys are much narrower, so more of the table fits in
+    memory. insert_candles and the queries of DatabaseConnector encode and decode them.
+    """
+    sql = candles_table_sql(table_name, partitioned, compact)
+    if compact:
+        sql = lookup_tables_sql() + sql
+
+    return db_client.send_request(sql)
+
+
+def create_candles_indexes(
+    db_client: DatabaseConnector, table_name: str, partitioned: bool = False, compact: bool = False
+) -> str:
+    """Creates the indexes of the candles table if they do not exist. Returns the status message.
+
+    The unique index is on (date, market, resolution), the conflict key of insert_candles, so candles of different
+    resolutions can be stored in the same table. The (date, market) unique index of previous versions is replaced.
+
+    On a partitioned table the indexes are created on each partition, and a BRIN index on date is added, as the candles
+    are inserted in date order. It is much smaller than a btree and enough to prune range reads inside a partition.
+    """
+    return db_client.send_request(candles_indexes_sql(table_name, partitioned, compact))
+
+
+def create_rollup_tables(db_client: DatabaseConnector, table_name: str) -> str:
+    """Creates the 4HOURS and 1DAY rollup tables of table_name and their indexes if they do not exist.
+    Returns the status message of the last command.
+
+    The rollup tables have the schema of the candles table and are kept up to date by insert_candles.
+    Use DatabaseConnector.refresh_rollups to fill them with the candles already in table_name.
+    """
+    msg = ""
+    for resolution in ROLLUP_RESOLUTIONS:
+        rollup_table_name = db_client.candles_table_name(table_name, resolution)
+        msg = create_candles_table(db_client, rollup_table_name)
+        if msg != "CREATE TABLE":
+            return msg
+
+        msg = create_candles_indexes(db_client, rollup_table_name)
+        if msg != "CREATE INDEX":
+            return msg
+
+    # The rollup tables are looked up again on the next insert
+    db_client.rollup_tables.pop(table_name, None)
+
+    return msg
+
+
+def is_compact(db_client: DatabaseConnector, table_name: str) -> bool:
+    """Returns True if table_name exists and is a compact candles table."""
+    return any(column in DICTIONARY_COLUMNS for column, _ in db_client.get_table_columns(table_name))
+
+
+def is_partitioned(db_client: DatabaseConnector, table_name: str) -> bool:
+    """Returns True if table_name exists and is partitioned."""
+    sql = "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s));"
+    data = db_client.send_query(sql, (table_name,))
+    return bool(data) and data[0][0]
+
+
+def table_exists(db_client: DatabaseConnector, table_name: str) -> bool:
+    """Returns True if table_name exists."""
+    data = db_client.send_query("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+    return bool(data) and data[0][0]
+
+
+def month_start(date: datetime, months: int = 0) -> datetime:
+    """Returns the first instant (UTC) of the month of date plus months."""
+    month_index = date.year * 12 + date.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def month_partition_name(table_name: str, date: datetime) -> str:
+    return f"{table_name}_y{date.year}m{date.month:02d}"
+
+
+def month_partitions_sql(table_name: str, start: datetime, end: datetime) -> list:
+    """Returns the sql commands to create the month partitions of table_name between start and end dates."""
+    sql_list = []
+    partition_start = month_start(start)
+    while partition_start <= end:
+        partition_end = month_start(partition_start, 1)
+        sql_list.append(
+            f"""CREATE TABLE IF NOT EXISTS {month_partition_name(table_name, partition_start)}
+            PARTITION OF {table_name}
+            FOR VALUES FROM ('{partition_start.isoformat()}') TO ('{partition_end.isoformat()}');"""
+        )
+        partition_start = partition_end
+
+    return sql_list
+
+
+def create_month_partitions(db_client: DatabaseConnector, table_name: str, start: datetime, end: datetime) -> str:
+    """Creates the missing month partitions of table_name between start and end dates. Returns the status message.
+
+    Candles can only be inserted into a partitioned table if the partition of their month exists, so the partitions
+    must be created ahead of time.
+    """
+    return db_client.send_request("\n".join(month_partitions_sql(table_name, start, end)))
+
+
+def detach_month_partition(db_client: DatabaseConnector, table_name: str, date: datetime, drop: bool = False) -> str:
+    """Detaches the partition of the month of date from table_name, and drops it if drop == True.
+    Returns the status message.
+
+    Detaching is a metadata change, so removing old months does not rewrite or vacuum the table.
+    """
+    partition_name = month_partition_name(table_name, date)
+    sql = f"ALTER TABLE {table_name} DETACH PARTITION {partition_name};"
+    if drop:
+        sql += f"DROP TABLE {partition_name};"
+
+    return db_client.send_request(sql)
+
+
+def migrate_candles_table(
+    db_client: DatabaseConnector,
+    table_name: str,
+    partitioned: bool = False,
+    compact: bool = False,
+    months_ahead: int = 2,
+) -> bool:
+    """Moves the candles of table_name into a new table with the same name and the schema given by partitioned and
+    compact (see create_candles_table). Returns True if the migration was done.
+
+    Runs in a single transaction. The previous table is kept as {table_name}_previous, it can be dropped once the
+    migration is checked.
+    """
+    previous_table_name = f"{table_name}_previous"
+    columns = ["date", "updated", "market", "resolution", "open_price", "close_price", "high_price", "low_price"]
+    columns += ["volume"]
+
+    # Decoded column: (id column, lookup table)
+    encoded_columns = {}
+    if compact:
+        encoded_columns = {column: (id_column, table) for id_column, (column, table) in DICTIONARY_COLUMNS.items()}
+    insert_columns = [encoded_columns[column][0] if column in encoded_columns else column for column in columns]
+    select_list = [
+        f"{encoded_columns[column][1]}.{encoded_columns[column][0]}" if column in encoded_columns else f"c.{column}"
+        for column in columns
+    ]
+    joins_str = ""
+    if compact:
+        joins_str = f"""
+            JOIN {MARKETS_TABLE_NAME} ON {MARKETS_TABLE_NAME}.market = c.market
+            LEFT JOIN {RESOLUTIONS_TABLE_NAME} ON {RESOLUTIONS_TABLE_NAME}.resolution = c.resolution
+        """
+
+    try:
+        with db_client.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE {table_name} RENAME TO {previous_table_name};")
+                cur.execute(f"ALTER INDEX IF EXISTS {table_name}_idx_date_market RENAME TO {previous_table_name}_idx;")
+                cur.execute(
+                    f"""ALTER INDEX IF EXISTS {table_name}_idx_date_market_resolution
+                    RENAME TO {previous_table_name}_idx_resolution;"""
+                )
+                cur.execute(f"ALTER INDEX IF EXISTS {table_name}_brin_date RENAME TO {previous_table_name}_brin;")
+
+                # The month partitions of the previous table are renamed too, so the new ones can be created
+                cur.execute(
+                    "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass;",
+                    (previous_table_name,),
+                )
+                for (partition_name,) in cur.fetchall():
+                    new_partition_name = partition_name.replace(table_name, previous_table_name, 1)
+                    cur.execute(f"ALTER TABLE {partition_name} RENAME TO {new_partition_name};")
+                candles_source = db_client.get_candles_source(previous_table_name, cur)
+
+                # The new table is created in the same transaction, without going through db_client
+                if compact:
+                    cur.execute(lookup_tables_sql())
+                cur.execute(candles_table_sql(table_name, partitioned, compact))
+                cur.execute(candles_indexes_sql(table_name, partitioned, compact))
+
+                if partitioned:
+                    cur.execute(f"SELECT MIN(date), MAX(date) FROM {previous_table_name};")
+                    first_candle, last_candle = cur.fetchone()
+                    now = datetime.now(timezone.utc)
+                    first_candle = first_candle if first_candle else now
+                    last_candle = max(last_candle, now) if last_candle else now
+                    for sql in month_partitions_sql(table_name, first_candle, month_start(last_candle, months_ahead)):
+                        cur.execute(sql)
+
+                # Adds the markets and resolutions missing in the lookup tables
+                lookup_columns = DICTIONARY_COLUMNS.values() if compact else []
+                for column, lookup_table_name in lookup_columns:
+                    cur.execute(
+                        f"""
+                        INSERT INTO {lookup_table_name} ({column})
+                        SELECT DISTINCT {column} FROM {candles_source} AS c
+                        WHERE {column} IS NOT NULL
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {lookup_table_name}
+                            WHERE {lookup_table_name}.{column} = c.{column}
+                        );
+                        """
+                    )
+
+                cur.execute(
+                    f"""
+                    INSERT INTO {table_name} ({", ".join(insert_columns)})
+                    SELECT {", ".join(select_list)}
+                    FROM {candles_source} AS c
+                    {joins_str}
+                    WHERE c.date IS NOT NULL;
+                    """
+                )
+                db_client.logger.info(f"{cur.rowcount} candles moved to the new {table_name} table.")
+
+    except psycopg.Error as e:
+        db_client.logger.error(e)
+        db_client.logger.error("Unable to migrate the table.")
+        return False
+
+    # The columns of the tables changed
+    db_client.table_columns.pop(table_name, None)
+    db_client.table_columns.pop(previous_table_name, None)
+
+    return True
@@ -1,14 +1,21 @@
+import asyncio
 import threading
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from math import ceil
+from time import perf_counter, sleep
 from typing import Union
 
+import aiohttp
+import numpy as np
 import pandas as pd
 from dydx3 import Client, DydxApiError
 from dydx3.constants import API_HOST_MAINNET, NETWORK_ID_MAINNET
 
 from utils.logger import setup_logger
+from utils.metrics import METRICS
+from utils.rate_limiter import SlidingWindowLimiter, backoff_delay
+from utils.response_archive import ResponseArchive
 
 
 @dataclass
@@ -22,22 +29,89 @@ class Resolution:
     MINS_1: str = "1MIN"
 
 
+RESOLUTION_DELTAS = {
+    Resolution.DAY_1: timedelta(days=1),
+    Resolution.HOURS_4: timedelta(hours=4),
+    Resolution.HOURS_1: timedelta(hours=1),
+    Resolution.MINS_30: timedelta(minutes=30),
+    Resolution.MINS_15: timedelta(minutes=15),
+    Resolution.MINS_5: timedelta(minutes=5),
+    Resolution.MINS_1: timedelta(minutes=1),
+}
+
+CANDLES_PER_REQUEST = 100
+
+REQUEST_LIMIT_GETV3 = 175  # limit of request that can handle dydx in 10 seconds. Subject to change.
+MAX_RETRIES = 8
+
+# Shared by every DydxClient in the process, so all exchange calls count against the same budget.
+RATE_LIMITER = SlidingWindowLimiter(capacity=REQUEST_LIMIT_GETV3, period=10)
+
+# Raw candle field: (column, dtype) of the candles formatted by format_candles. Fields not listed are not decoded.
+CANDLE_SCHEMA = {
+    "startedAt": ("date", "datetime"),
+    "updatedAt": ("updated", "datetime"),
+    "market": ("market", str),
+    "resolution": ("resolution", str),
+    "open": ("open_price", float),
+    "close": ("close_price", float),
+    "high": ("high_price", float),
+    "low": ("low_price", float),
+    "baseTokenVolume": ("volume", float),
+}
+
+CANDLE_COLUMNS = [column for column, _ in CANDLE_SCHEMA.values()]
+
+
 def max_requests(start_date: datetime, end_date: datetime, resolution: str) -> int:
     """Calculates the number of max requests needed to import all candles from the exchange."""
-    resolution_deltas = {
-        Resolution.DAY_1: timedelta(days=1),
-        Resolution.HOURS_4: timedelta(hours=4),
-        Resolution.HOURS_1: timedelta(hours=1),
-        Resolution.MINS_30: timedelta(minutes=30),
-        Resolution.MINS_15: timedelta(minutes=15),
-        Resolution.MINS_5: timedelta(minutes=5),
-        Resolution.MINS_1: timedelta(minutes=1),
-    }
-
-    delta = resolution_deltas[resolution]
+    delta = RESOLUTION_DELTAS[resolution]
     total_lines = ceil((end_date - start_date) / delta)
 
-    return ceil(total_lines / 100)
+    return ceil(total_lines / CANDLES_PER_REQUEST)
+
+
+def candle_windows(start_date: datetime, end_date: datetime, resolution: str) -> list:
+    """Splits start_date to end_date (both included) into (window_start, window_end) tuples.
+    Each window holds at most CANDLES_PER_REQUEST candles, so it can be downloaded with a single request.
+    """
+    delta = RESOLUTION_DELTAS[resolution]
+
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + delta * (CANDLES_PER_REQUEST - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + delta
+
+    return windows
+
+
+def format_candles(records: list) -> pd.DataFrame:
+    """Formats a list of raw candles from the exchange into a DataFrame with the candle table columns.
+
+    Each column is decoded once for all the candles, with the dtype from CANDLE_SCHEMA.
+    """
+    if not records:
+        return pd.DataFrame(columns=CANDLE_COLUMNS)
+
+    start = perf_counter()
+    columns = {}
+    for field, (column, dtype) in CANDLE_SCHEMA.items():
+        values = [record[field] for record in records]
+        if dtype == "datetime":
+            columns[column] = pd.to_datetime(values, utc=True, format="ISO8601")
+        elif dtype == str:
+            columns[column] = values
+        else:
+            columns[column] = np.array(values, dtype=dtype)
+
+    data = pd.DataFrame(columns)
+    data = data.drop_duplicates(subset=["market", "date"], keep="last").reset_index(drop=True)
+
+    METRICS.observe("stage_seconds", perf_counter() - start, stage="transform")
+
+    return data
 
 
 class DydxClient:
@@ -45,24 +119,59 @@ class DydxClient:
     Handles all DYDX execution.
     """
 
-    def __init__(self, logger=None):
-        """ """
+    def __init__(self, logger=None, host: str = API_HOST_MAINNET, archive: ResponseArchive = None):
+        """If archive is given, every candle page received is saved into it (see ResponseArchive)."""
         self.lock = threading.RLock()
 
         self.logger = logger if logger else setup_logger(name="dydx_client_logger")
 
+        self.host = host
         self.public_client = Client(
-            host=API_HOST_MAINNET,
+            host=self.host,
             network_id=NETWORK_ID_MAINNET,
         )
 
-        self.request_limit_getV3 = 175  # limit of request that can handle dydx in 10 seconds. Subject to change.
+        self.request_limit_getV3 = REQUEST_LIMIT_GETV3
+        self.rate_limiter = RATE_LIMITER
+
+        self.archive = archive
+        # (market, window_start, window_end) of the last get_all_markets_candles_async that could not be downloaded
+        self.failed_windows = []
+
+    def request(self, method, *args, **kwargs):
+        """Calls a public_client method through the rate limiter.
+        Throttled requests (429) are retried with jittered exponential backoff up to MAX_RETRIES times.
+        Requests and 429s are counted on METRICS by the market keyword argument ("all" if not given).
+        """
+        market = kwargs.get("market", "all")
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            METRICS.inc("exchange_requests_total", market=market)
+            try:
+                return method(*args, **kwargs)
+            except DydxApiError as e:
+                if e.status_code != 429:
+                    raise
+                self.rate_limiter.throttled()
+                METRICS.inc("exchange_throttled_total", market=market)
+                if attempt >= MAX_RETRIES:
+                    raise
+
+            self.logger.debug(f"Exchange rate limit reached. Retrying {method.__name__} ({attempt + 1}/{MAX_RETRIES}).")
+            self.rate_limiter.retried()
+            sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def rate_limit_stats(self) -> dict:
+        """Returns the requests, waits, throttles and retries counters of the shared rate limiter."""
+        return self.rate_limiter.stats()
 
     def get_online_markets(self) -> list:
         """Downloads all markets and returns a list with only the ONLINE markets."""
 
         try:
-            raw_data = self.public_client.public.get_markets().data["markets"]
+            raw_data = self.request(self.public_client.public.get_markets).data["markets"]
         except Exception as e:
             self.logger.error(e)
             self.logger.error(f"Unable to get markets data.")
@@ -84,106 +193,48 @@ class DydxClient:
     ) -> pd.DataFrame:
         """Downloads candle data for market between start and end dates."""
 
-        data = pd.DataFrame()
+        # Raw candles of all pages. They are formatted once at the end.
+        records = []
         end_date = end
 
         while end_date > start:
             try:
-                raw_data = self.public_client.public.get_candles(
-                    market,
+                raw_data = self.request(
+                    self.public_client.public.get_candles,
+                    market=market,
                     resolution=resolution,
-                    from_iso=datetime.strftime(start - timedelta(hours=1), "%Y-%m-%d %H:%M:%S"),
+                    from_iso=datetime.strftime(start - RESOLUTION_DELTAS[resolution], "%Y-%m-%d %H:%M:%S"),
                     to_iso=datetime.strftime(end_date, "%Y-%m-%d %H:%M:%S"),
                     limit="100",
                 ).data["candles"]
 
             except DydxApiError as e:
                 if e.status_code == 429:
-                    self.logger.error("Exchange rate limit reached.")
+                    self.logger.error(f"Exchange rate limit reached after {MAX_RETRIES} retries.")
                 else:
                     self.logger.error(e)
                     self.logger.error(f"Unable to get candle data for market {market}.")
-                raw_data = pd.DataFrame()
+                raw_data = []
             except Exception as e:
                 self.logger.error(e)
                 self.logger.error(f"Unable to get candle data for market {market}.")
-                raw_data = pd.DataFrame()
-
-            raw_data = pd.DataFrame.from_dict(raw_data)
+                raw_data = []
 
-            if raw_data.empty:
+            if not raw_data:
                 break
 
-            raw_data["startedAt"] = pd.to_datetime(raw_data["startedAt"], utc=True)
-            data = pd.concat([data, raw_data], axis=0)
-
-            end_date = raw_data.loc[raw_data["startedAt"].idxmin(), "startedAt"]
-
-        if data.empty:
-            data = pd.DataFrame(
-                columns=[
-                    "date",
-                    "updated",
-                    "open_price",
-                    "close_price",
-                    "high_price",
-                    "low_price",
-                    "volume",
-                    "volume_usd",
-                ]
-            )
-            if threading.current_thread().name == f"get_market_candle({market})":
-                with self.lock:
-                    self.candles_data[market] = data
-            else:
-                return data
-
-        data = data.drop_duplicates(subset="startedAt", keep="last")
-
-        # Format data
-        data = data.reset_index(drop=True)
-        data["startedAt"] = pd.to_datetime(data["startedAt"], utc=True)
-        data["updatedAt"] = pd.to_datetime(data["updatedAt"], utc=True)
-        data["market"] = data["market"].astype(str)
-        data["resolution"] = data["resolution"].astype(str)
-        data["low"] = data["low"].astype(float)
-        data["high"] = data["high"].astype(float)
-        data["open"] = data["open"].astype(float)
-        data["close"] = data["close"].astype(float)
-        data["baseTokenVolume"] = data["baseTokenVolume"].astype(float)
-        data["trades"] = data["trades"].astype(int)
-        data["usdVolume"] = data["usdVolume"].astype(float)
-        data["startingOpenInterest"] = data["startingOpenInterest"].astype(float)
-
-        # Rename columns
-        data = data.rename(
-            columns={
-                "startedAt": "date",
-                "updatedAt": "updated",
-                "low": "low_price",
-                "high": "high_price",
-                "open": "open_price",
-                "close": "close_price",
-                "baseTokenVolume": "volume",
-                "usdVolume": "volume_usd",
-                "startingOpenInterest": "starting_interest",
-            }
-        )
+            # A failed archive does not lose the page downloaded
+            if self.archive is not None:
+                try:
+                    self.archive.append(market, resolution, raw_data)
+                except Exception as e:
+                    self.logger.warning(f"Unable to archive the candles of {market}: {e!r}")
 
-        # Delete unused columns and rearrange the columns
-        data = data[
-            [
-                "date",
-                "updated",
-                "market",
-                "resolution",
-                "open_price",
-                "close_price",
-                "high_price",
-                "low_price",
-                "volume",
-            ]
-        ]
+            records += raw_data
+
+            end_date = min(pd.Timestamp(candle["startedAt"]) for candle in raw_data)
+
+        data = format_candles(records)
 
         # Check if its running from get_all_market_candles thread
         if threading.current_thread().name == f"get_market_candle({market})":
@@ -206,21 +257,7 @@ class DydxClient:
         Uses threading to send multiple request. When request limit is reached, it will sleep(10) and continue.
         """
         # Defines a variable to store all candle data from the threads
-        self.candles_data = {
-            market: pd.DataFrame(
-                columns=[
-                    "date",
-                    "updated",
-                    "open_price",
-                    "close_price",
-                    "high_price",
-                    "low_price",
-                    "volume",
-                    "volume_usd",
-                ]
-            )
-            for market in market_list
-        }
+        self.candles_data = {market: pd.DataFrame(columns=CANDLE_COLUMNS) for market in market_list}
 
         # Checks the max number of request needed to get the data
         requests = max_requests(start, end, resolution)
@@ -254,8 +291,153 @@ class DydxClient:
 
         return self.candles_data
 
+    def create_session(self, max_concurrency: int = 20) -> aiohttp.ClientSession:
+        """Creates an aiohttp session with keep-alive connections for the async methods."""
+        connector = aiohttp.TCPConnector(limit=max_concurrency, keepalive_timeout=30)
+        return aiohttp.ClientSession(base_url=self.host, connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+    async def get_candles_window_async(
+        self,
+        session: aiohttp.ClientSession,
+        market: str,
+        start: datetime,
+        end: datetime,
+        resolution: str = Resolution.HOURS_1,
+    ) -> Union[list, None]:
+        """Downloads the raw candles of market between start and end dates with a single request.
+        The window must hold at most CANDLES_PER_REQUEST candles (see candle_windows).
+        Returns None if the window could not be downloaded.
+
+        Throttled requests (429) and transient errors (timeouts, dropped connections and 5xx answers) are retried up
+        to MAX_RETRIES times with jittered exponential backoff. Other errors are not retried.
+
+        The bounds are sent half a candle outside the window, so the result does not depend on the exchange treating
+        them as inclusive or exclusive.
+        """
+        half_delta = RESOLUTION_DELTAS[resolution] / 2
+        params = {
+            "resolution": resolution,
+            "fromISO": datetime.strftime(start - half_delta, "%Y-%m-%d %H:%M:%S"),
+            "toISO": datetime.strftime(end + half_delta, "%Y-%m-%d %H:%M:%S"),
+            "limit": str(CANDLES_PER_REQUEST),
+        }
+
+        for attempt in range(MAX_RETRIES + 1):
+            await self.rate_limiter.acquire_async()
+            METRICS.inc("exchange_requests_total", market=market)
+            try:
+                async with session.get(f"/v3/candles/{market}", params=params) as response:
+                    if response.status == 429:
+                        error = "Exchange rate limit reached"
+                        self.rate_limiter.throttled()
+                        METRICS.inc("exchange_throttled_total", market=market)
+                    elif response.status >= 500:
+                        error = f"Exchange error {response.status}"
+                        METRICS.inc("exchange_errors_total", market=market)
+                    else:
+                        response.raise_for_status()
+                        candles = (await response.json())["candles"]
+                        break
+
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                error = f"Exchange request failed ({e!r})"
+                METRICS.inc("exchange_errors_total", market=market)
+            except Exception as e:
+                self.logger.error(e)
+                self.logger.error(f"Unable to get candle data for market {market}.")
+                return None
+
+            if attempt < MAX_RETRIES:
+                self.logger.debug(f"{error}. Retrying {market} ({attempt + 1}/{MAX_RETRIES}).")
+                self.rate_limiter.retried()
+                await asyncio.sleep(backoff_delay(attempt))
+        else:
+            self.logger.error(f"{error} after {MAX_RETRIES} retries.")
+            self.logger.error(f"Unable to get candle data for market {market}.")
+            return None
+
+        # Compressed and written off the event loop, a failed archive does not lose the page downloaded
+        if self.archive is not None:
+            try:
+                await asyncio.to_thread(self.archive.append, market, resolution, candles)
+            except Exception as e:
+                self.logger.warning(f"Unable to archive the candles of {market}: {e!r}")
+
+        return candles
+
+    async def get_market_candles_async(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        market: str,
+        start: datetime,
+        end: datetime,
+        resolution: str = Resolution.HOURS_1,
+    ) -> pd.DataFrame:
+        """Downloads candle data for market between start and end dates.
+
+        All the pages are requested concurrently. The number of requests in flight is bounded by semaphore, which
+        can be shared between markets.
+        """
+
+        async def get_window(window_start: datetime, window_end: datetime) -> Union[list, None]:
+            async with semaphore:
+                page = await self.get_candles_window_async(session, market, window_start, window_end, resolution)
+            if page is None:
+                self.failed_windows.append((market, window_start, window_end))
+            return page
+
+        pages = await asyncio.gather(*[get_window(*window) for window in candle_windows(start, end, resolution)])
+
+        return format_candles([candle for page in pages if page for candle in page])
+
+    async def get_all_markets_candles_async(
+        self,
+        market_list: Union[tuple, list],
+        start: datetime,
+        end: datetime,
+        resolution: str = Resolution.HOURS_1,
+        max_concurrency: int = 20,
+    ) -> pd.DataFrame:
+        """Downloads candle data for all markets inside market_list between start and end dates.
+        Return a unique DataFrame with all data.
+
+        All markets and pages are downloaded concurrently over keep-alive connections, with at most max_concurrency
+        requests in flight.
+
+        The windows that could not be downloaded (see get_candles_window_async) are left in failed_windows as a list of
+        (market, window_start, window_end), so they can be downloaded again (for example with backfill.run_backfill).
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        self.failed_windows = []
+
+        async with self.create_session(max_concurrency) as session:
+            candles_data = await asyncio.gather(
+                *[
+                    self.get_market_candles_async(session, semaphore, market, start, end, resolution)
+                    for market in market_list
+                ]
+            )
+
+        self.logger.debug(f"Rate limiter stats: {self.rate_limit_stats()}")
+        if self.failed_windows:
+            self.logger.error(f"Unable to download {len(self.failed_windows)} windows, see failed_windows.")
+
+        candles_data = [data for data in candles_data if not data.empty]
+        if not candles_data:
+            return pd.DataFrame(columns=CANDLE_COLUMNS)
+
+        candles_data = pd.concat(candles_data, ignore_index=True)
+        candles_data = candles_data.sort_values(by="date", ascending=True).reset_index(drop=True)
+
+        return candles_data
+
     def get_market_list_6mo(self, number_of_markets: int = 25) -> tuple:
-        """Get a market list with the first number_of_markets ONLINE markets by traded volume in usd."""
+        """Get a market list with the first number_of_markets ONLINE markets by traded volume in usd.
+
+        It downloads 6 months of daily candles of every market from the exchange. If the candles are stored in the db,
+        use DatabaseConnector.rank_markets with the online markets instead.
+        """
         end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
         start = end - timedelta(days=30 * 6)
 
@@ -263,7 +445,7 @@ class DydxClient:
 
         vol_traded_usd = {}
         for market in online_markets:
-            candle_data = self.get_market_candle(market, start, end, resolution=Resolution.DAY_1)
+            candle_data = self.get_market_candles(market, start, end, resolution=Resolution.DAY_1)
             vol_usd = candle_data["volume"] * candle_data["close_price"]
             vol_traded_usd[market] = vol_usd.sum()
 
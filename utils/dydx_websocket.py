@@ -0,0 +1,309 @@
+import asyncio
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+import pandas as pd
+from dydx3.constants import WS_HOST_MAINNET
+
+from utils.db_connector import DatabaseConnector
+from utils.dydx_client import CANDLE_COLUMNS, RESOLUTION_DELTAS, Resolution
+from utils.logger import setup_logger
+from utils.metrics import METRICS
+from utils.rate_limiter import backoff_delay
+
+MARKETS_CHANNEL = "v3_markets"
+TRADES_CHANNEL = "v3_trades"
+
+HEARTBEAT = 30  # seconds between the pings sent to the exchange, the connection is dropped if a pong is missed
+FLUSH_INTERVAL = 10.0  # seconds between two saves of the bars into the db
+CLOSE_DELAY = timedelta(seconds=5)  # time waited after the end of a bar for late trades before closing it
+
+
+def parse_date(date: str) -> datetime:
+    return datetime.fromisoformat(date.replace("Z", "+00:00"))
+
+
+def bar_start(date: datetime, resolution: str) -> datetime:
+    """Returns the start date of the bar of resolution that contains date."""
+    seconds = RESOLUTION_DELTAS[resolution].total_seconds()
+    return datetime.fromtimestamp(date.timestamp() // seconds * seconds, tz=timezone.utc)
+
+
+class DydxTradesCollector:
+    """
+    Builds the candles of resolution in real time from the dYdX v3 public trades stream, and upserts them into
+    table_name with DatabaseConnector.insert_candles (rollup tables included).
+
+    The v3_markets channel gives the ONLINE markets (only the ones in markets, if given), and the v3_trades channel of
+    each of them is subscribed. Trades are aggregated in memory into OHLCV bars keyed on (market, bar start). Every
+    flush_interval seconds the bars with new trades are saved, so the bar in progress can be read from the db within
+    seconds. A bar is closed, saved one last time and dropped from memory once the stream (the newest trade of any
+    market) is close_delay past its end, so closing only depends on the trades and replays behave the same as live.
+
+    Only bars fully seen are built: the snapshot of recent trades sent on subscription is not aggregated, and the
+    trades of a market are only used from the start of the bar after the snapshot. On reconnection the bars in
+    progress are saved and dropped, and the same rule is applied again, so no bar is built from a partial stream. The
+    bars skipped (and any trade missed) are filled by the REST downloader, which downloads and overwrites the last
+    candles every cycle. Bars are saved with keep_newer, so a bar never overwrites a candle of the downloader updated
+    after its last trade.
+
+    If record_path is given, every message received is appended to it (one JSON message per line). The recordings can
+    be replayed with benchmarks/fake_dydx_websocket.py.
+
+    Call run (a coroutine) to start, stop (from any thread) to end it.
+    """
+
+    def __init__(
+        self,
+        db_client: DatabaseConnector,
+        logger=None,
+        table_name: str = "dydx_candles",
+        resolution: str = Resolution.HOURS_1,
+        markets: list = None,
+        host: str = WS_HOST_MAINNET,
+        flush_interval: float = FLUSH_INTERVAL,
+        close_delay: timedelta = CLOSE_DELAY,
+        record_path: str = None,
+    ):
+        self.db_client = db_client
+        self.logger = logger if logger else setup_logger(name="dydx_trades_collector", folder_path=".//data")
+        self.table_name = table_name
+        self.resolution = resolution
+        self.markets = markets
+        self.host = host
+        self.flush_interval = flush_interval
+        self.close_delay = close_delay
+        self.record_path = record_path
+
+        # (market, bar start): {"first", "last", "open", "close", "high", "low", "volume", "trades"}
+        self.bars = {}
+        # Bars with trades not saved yet
+        self.dirty = set()
+        # Markets subscribed: first bar start whose trades are aggregated
+        self.complete_from = {}
+        # Date of the newest trade received, of any market
+        self.event_time = None
+
+        self.running = False
+        self.loop = None
+        # Task connected (or connecting) to the exchange, cancelled by stop
+        self.connection = None
+        self.attempt = 0
+        self.record_file = None
+        self.stop_event = threading.Event()
+        # The periodic flush and the flush on reconnection must not run at the same time
+        self.flush_lock = asyncio.Lock()
+
+    def stop(self):
+        """Stops the collector, the bars in memory are saved first. It can be called from any thread."""
+        self.running = False
+        self.stop_event.set()
+        # Cancels the connection, whether it is still connecting or receiving messages
+        if self.loop is not None and self.connection is not None:
+            self.loop.call_soon_threadsafe(self.connection.cancel)
+
+    async def run(self):
+        self.logger.info("Trades collector start.")
+        self.running = True
+        self.loop = asyncio.get_running_loop()
+        if self.record_path:
+            self.record_file = open(self.record_path, "a")
+
+        flush_task = asyncio.create_task(self.flush_periodically())
+        async with aiohttp.ClientSession() as session:
+            while self.running:
+                self.connection = asyncio.create_task(self.connect(session))
+                try:
+                    await self.connection
+                except asyncio.CancelledError:
+                    # Cancelled by stop, anything else cancelling run is propagated
+                    if self.running:
+                        raise
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.logger.error(f"Websocket error: {e!r}")
+                self.connection = None
+
+                # Trades may have been missed while disconnected
+                await self.reset()
+                if self.running:
+                    delay = backoff_delay(self.attempt)
+                    self.attempt += 1
+                    METRICS.inc("ws_reconnects_total")
+                    self.logger.warning(f"Websocket closed, reconnecting in {delay:.1f}s.")
+                    await asyncio.to_thread(self.stop_event.wait, delay)
+
+        flush_task.cancel()
+        if self.record_file:
+            self.record_file.close()
+        self.logger.info("Trades collector end.")
+
+    async def connect(self, session: aiohttp.ClientSession):
+        """Connects to host and handles the messages until the connection is closed or the collector is stopped."""
+        if not self.running:
+            return
+
+        async with session.ws_connect(self.host, heartbeat=HEARTBEAT) as websocket:
+            # Stopped during the handshake
+            if not self.running:
+                return
+            self.logger.info(f"Connected to {self.host}.")
+            self.attempt = 0
+            await self.listen(websocket)
+
+    async def listen(self, websocket: aiohttp.ClientWebSocketResponse):
+        """Subscribes to the markets channel and handles the messages until the connection is closed."""
+        await websocket.send_json({"type": "subscribe", "channel": MARKETS_CHANNEL})
+
+        async for message in websocket:
+            if not self.running:
+                break
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            if self.record_file:
+                self.record_file.write(message.data + "\n")
+            await self.handle_message(websocket, json.loads(message.data))
+
+    async def handle_message(self, websocket: aiohttp.ClientWebSocketResponse, message: dict):
+        message_type, channel = message.get("type"), message.get("channel")
+        METRICS.inc("ws_messages_total", type=message_type, channel=channel)
+
+        if message_type == "error":
+            self.logger.error(f"Websocket error message: {message.get('message')}")
+
+        elif channel == MARKETS_CHANNEL and message_type in ("subscribed", "channel_data"):
+            # The snapshot holds every market, the updates only the markets (and fields) changed
+            markets = message["contents"].get("markets", message["contents"])
+            for market, values in markets.items():
+                if market in self.complete_from or values.get("status") != "ONLINE":
+                    continue
+                if self.markets is not None and market not in self.markets:
+                    continue
+                # Set before the snapshot is received, so the market is only subscribed once
+                self.complete_from[market] = datetime.max.replace(tzinfo=timezone.utc)
+                await websocket.send_json({"type": "subscribe", "channel": TRADES_CHANNEL, "id": market})
+
+        elif channel == TRADES_CHANNEL and message_type == "subscribed":
+            # The snapshot trades are not aggregated, the bar they end in may have started before them
+            market = message["id"]
+            dates = [parse_date(trade["createdAt"]) for trade in message["contents"]["trades"]]
+            newest = max(dates, default=self.event_time or datetime.now(timezone.utc))
+            self.complete_from[market] = bar_start(newest, self.resolution) + RESOLUTION_DELTAS[self.resolution]
+            self.logger.debug(f"{market}: Subscribed to trades, building bars from {self.complete_from[market]}.")
+
+        elif channel == TRADES_CHANNEL and message_type == "channel_data":
+            # Trades are sent newest first
+            for trade in reversed(message["contents"]["trades"]):
+                self.add_trade(message["id"], trade)
+
+    def add_trade(self, market: str, trade: dict):
+        """Adds trade to the bar of market it falls in."""
+        date = parse_date(trade["createdAt"])
+        self.event_time = max(self.event_time, date) if self.event_time else date
+        if date < self.complete_from.get(market, datetime.max.replace(tzinfo=timezone.utc)):
+            return
+
+        # Trades of bars already closed are dropped, a new bar would overwrite the saved one with a single trade
+        key = (market, bar_start(date, self.resolution))
+        if key[1] + RESOLUTION_DELTAS[self.resolution] + self.close_delay <= self.event_time:
+            METRICS.inc("ws_late_trades_total", market=market)
+            return
+
+        METRICS.inc("ws_trades_total", market=market)
+        price, size = float(trade["price"]), float(trade["size"])
+        bar = self.bars.get(key)
+        if bar is None:
+            self.bars[key] = {
+                "first": date,
+                "last": date,
+                "open": price,
+                "close": price,
+                "high": price,
+                "low": price,
+                "volume": size,
+                "trades": 1,
+            }
+        else:
+            if date < bar["first"]:
+                bar["first"], bar["open"] = date, price
+            if date >= bar["last"]:
+                bar["last"], bar["close"] = date, price
+            bar["high"] = max(bar["high"], price)
+            bar["low"] = min(bar["low"], price)
+            bar["volume"] += size
+            bar["trades"] += 1
+        self.dirty.add(key)
+
+    def candles(self, keys: list) -> pd.DataFrame:
+        """Returns the bars of keys as candles, with the columns of format_candles."""
+        rows = []
+        for market, start in keys:
+            bar = self.bars[(market, start)]
+            rows.append(
+                (
+                    start,
+                    bar["last"],
+                    market,
+                    self.resolution,
+                    bar["open"],
+                    bar["close"],
+                    bar["high"],
+                    bar["low"],
+                    bar["volume"],
+                )
+            )
+        data = pd.DataFrame(rows, columns=CANDLE_COLUMNS)
+        data["date"] = pd.to_datetime(data["date"], utc=True)
+        data["updated"] = pd.to_datetime(data["updated"], utc=True)
+
+        return data
+
+    async def flush(self, close_all: bool = False) -> bool:
+        """Saves the bars with new trades into the db, and drops the closed bars from memory. If close_all == True
+        every bar is considered closed. Returns False if the bars could not be saved, they are saved again next time.
+        """
+        async with self.flush_lock:
+            return await self._flush(close_all)
+
+    async def _flush(self, close_all: bool) -> bool:
+        delta = RESOLUTION_DELTAS[self.resolution]
+        closed = {
+            key
+            for key in self.bars
+            if close_all or (self.event_time is not None and key[1] + delta + self.close_delay <= self.event_time)
+        }
+
+        keys, self.dirty = sorted(self.dirty), set()
+        if keys:
+            with METRICS.time("stage_seconds", stage="ws_flush"):
+                status = await asyncio.to_thread(
+                    self.db_client.insert_candles, self.table_name, self.candles(keys), keep_newer=True
+                )
+            if status == "":
+                self.logger.error(f"Something happened saving {len(keys)} bars into {self.table_name}.")
+                self.dirty.update(keys)
+                return False
+            METRICS.inc("ws_bars_saved_total", len(keys), table=self.table_name)
+
+        # Closed bars with trades received during the save are kept until the next one
+        for key in closed - self.dirty:
+            del self.bars[key]
+        METRICS.set("ws_open_bars", len(self.bars), table=self.table_name)
+        if self.event_time is not None:
+            METRICS.set("ws_event_lag_seconds", (datetime.now(timezone.utc) - self.event_time).total_seconds())
+
+        return True
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def reset(self):
+        """Saves and drops every bar, and forgets the subscriptions."""
+        while not await self.flush(close_all=True) and self.running:
+            await asyncio.to_thread(self.stop_event.wait, self.flush_interval)
+        self.bars = {}
+        self.dirty = set()
+        self.complete_from = {}
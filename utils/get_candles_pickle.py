@@ -1,21 +1,22 @@
 """
 Run this file to import dydx candles from the DB. Just change the settings.
 
-pysicopg3 should be installed:
+The requirements of the downloader should be installed (the candles cache uses utils/dydx_client.py, which needs
+dydx-v3-python and aiohttp):
 
-pip install psycopg[binary]
+pip install aiohttp dydx-v3-python pandas psycopg[binary,pool]
 
 All dydx markets should be available. 1-hour candles only.
 
 A dataframe with all the data will be saved on ./dydx_candles.pkl
+If USE_CACHE = True, the candles are kept on a local cache on CACHE_FOLDER instead, so the next runs only download the
+new candles from the DB (check utils/candles_cache.py).
 """
 from datetime import datetime, timedelta, timezone
-from typing import Union
-
-import pandas as pd
-import psycopg
 
+from utils.candles_cache import CandlesCache
 from utils.db_connector import DatabaseConnector
+from utils.logger import setup_logger
 
 ### SETTINGS ###
 end = datetime.utcnow().replace(tzinfo=timezone.utc)
@@ -35,88 +36,8 @@ market_list = [
     "ETH-USD",
 ]
 
-
-class DatabaseConnector:
-    """
-    Class to interact with the database.
-    """
-
-    def __init__(self, db_credentials: dict):
-        self.conninfo_str = f"""
-        host={db_credentials["host"]}
-        port={db_credentials["port"]}
-        dbname={db_credentials["database"]}
-        user={db_credentials["user"]}
-        password={db_credentials["password"]}
-        """
-
-    def send_query(self, sql: str, values: tuple = ()) -> str:
-        """Sends sql query to the db and return all data queried."""
-        try:
-            with psycopg.connect(self.conninfo_str) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(sql, values)
-                    data = cur.fetchall()
-                    conn.commit()
-
-        except psycopg.Error as e:
-            print(e)
-            print("Unable to execute command.")
-            return ""
-
-        return data
-
-    def get_candles(
-        self,
-        market_list: Union[tuple, list, str],
-        start: datetime = None,
-        end: datetime = datetime.utcnow().replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc),
-        table_name: str = "dydx_candles",
-        to_file: bool = False,
-        file_path: str = "./dydx_candles.pkl",
-    ):
-        start = end - timedelta(hours=1) if start == None else start
-        market_list = [market_list] if isinstance(market_list, str) else market_list
-
-        market_placeholders = ",".join(["%s"] * len(market_list))
-
-        sql = f"""
-            SELECT date, market, resolution, open_price, close_price, high_price, low_price, volume FROM {table_name}
-            WHERE date BETWEEN %s AND %s
-            AND market IN ({market_placeholders})
-        """
-
-        # Add the start and end values to the values tuple
-        values = (start, end) + tuple(market_list)
-
-        # Send the query
-        data = self.send_query(sql, values)
-
-        candle_data = pd.DataFrame(
-            data,
-            columns=["date", "market", "resolution", "open_price", "close_price", "high_price", "low_price", "volume"],
-        )
-
-        candle_data = candle_data.astype(
-            {
-                "date": str,
-                "market": str,
-                "resolution": str,
-                "open_price": float,
-                "close_price": float,
-                "high_price": float,
-                "low_price": float,
-                "volume": float,
-            }
-        )
-
-        candle_data["date"] = pd.to_datetime(candle_data["date"], utc=True)
-        candle_data = candle_data.sort_values(by="date").reset_index(drop=True)
-
-        if to_file:
-            candle_data.to_pickle(file_path)
-
-        return candle_data
+USE_CACHE = True
+CACHE_FOLDER = "./candles_cache"
 
 
 def main():
@@ -124,9 +45,13 @@ def main():
     print(f"Selected markets: {market_list}.")
 
     time_start = datetime.now()
-    db_client = DatabaseConnector(db_credentials)
+    logger = setup_logger(name="get_candles_pickle", save_on_file=False, debug_level="INFO")
+    db_client = DatabaseConnector(db_credentials, logger)
 
-    candles = db_client.get_candles(market_list, start, end, to_file=True, file_path="./dydx_candles.pkl")
+    if USE_CACHE:
+        candles = CandlesCache(db_client, folder_path=CACHE_FOLDER).get_candles(market_list, start, end)
+    else:
+        candles = db_client.get_candles(market_list, start, end, to_file=True, file_path="./dydx_candles.pkl")
 
     print(candles)
     print(f"Done in {(datetime.now() - time_start).seconds}s.")
@@ -1,29 +1,94 @@
+import atexit
 import logging
 import os
+import queue
 import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
+FILE_FORMAT = "%(asctime)s - [%(levelname)s] - %(threadName)s - %(funcName)s >> %(message)s"
+STREAM_FORMAT = "%(asctime)s - [%(levelname)s] >> %(message)s"
 
-def setup_logger(debug_level='DEBUG', name='root', save_on_file=True, clear_files_on_start=True, folder_path='.//', file_name ='logs.log'):
+# Listener of each logger set up, keyed by logger name. Handlers are only added the first time.
+LISTENERS = {}
+# File handlers, keyed by file path, shared by all the loggers writing to the same file.
+FILE_HANDLERS = {}
+LOCK = threading.Lock()
 
+
+def file_handler(file_path: str, clear_file: bool, max_bytes: int, backup_count: int, when: str) -> logging.Handler:
+    """Returns the rotating handler of file_path, creating it the first time.
+
+    The file is rotated when it reaches max_bytes, or at each when interval (see TimedRotatingFileHandler) if when is
+    given. Only backup_count old files are kept. If clear_file == True, the file is rotated on creation, so each run
+    starts a new file.
+    """
+    if file_path in FILE_HANDLERS:
+        return FILE_HANDLERS[file_path]
+
+    if when:
+        handler = TimedRotatingFileHandler(file_path, when=when, backupCount=backup_count, utc=True)
+    else:
+        handler = RotatingFileHandler(file_path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter(FILE_FORMAT))
+
+    if clear_file and os.path.getsize(file_path) > 0:
+        handler.doRollover()
+
+    FILE_HANDLERS[file_path] = handler
+
+    return handler
+
+
+def stop_listeners():
+    """Writes the records still queued and stops the listener threads."""
+    for listener in LISTENERS.values():
+        listener.stop()
+
+
+atexit.register(stop_listeners)
+
+
+def setup_logger(
+    debug_level="DEBUG",
+    name="root",
+    save_on_file=True,
+    clear_files_on_start=True,
+    folder_path=".//",
+    file_name="logs.log",
+    max_bytes=10 * 1024**2,
+    backup_count=5,
+    when=None,
+):
+    """Returns the logger name, writing to stdout and (if save_on_file == True) to folder_path/file_name.
+
+    The calling threads only put the records into a queue. A single listener thread per logger formats and writes
+    them, so logging never waits for the disk. The file is rotated by size or time (see file_handler).
+
+    Calling it again for the same name only updates the level, the handlers are not added twice.
+    """
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, debug_level))
 
-    if save_on_file:
-        os.makedirs(folder_path, exist_ok=True)
-
-        file_path = f'.//{folder_path}//{file_name}'
-        if not os.path.exists(file_name) or clear_files_on_start:
-            with open(file_path, 'w') as logfile:
-                logfile.truncate()
+    with LOCK:
+        if name in LISTENERS:
+            return logger
 
-        handler = logging.FileHandler(file_path)
-        handler.setFormatter(logging.Formatter('%(asctime)s - [%(levelname)s] - %(threadName)s - %(funcName)s >> %(message)s'))
+        handlers = []
+        if save_on_file:
+            os.makedirs(folder_path, exist_ok=True)
+            file_path = os.path.normpath(os.path.join(folder_path, file_name))
+            handlers.append(file_handler(file_path, clear_files_on_start, max_bytes, backup_count, when))
 
-        logger.addHandler(handler)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(STREAM_FORMAT, "%H:%M:%S"))
+        handlers.append(stream_handler)
 
-    handler = logging.StreamHandler(sys.stdout) 
-    handler.setFormatter(logging.Formatter('%(asctime)s - [%(levelname)s] >> %(message)s', "%H:%M:%S"))
+        records_queue = queue.Queue(-1)
+        listener = QueueListener(records_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        LISTENERS[name] = listener
 
-    logger.addHandler(handler)
+        logger.addHandler(QueueHandler(records_queue))
 
-    return logger
\ No newline at end of file
+    return logger
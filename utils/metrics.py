@@ -0,0 +1,158 @@
+import os
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# The metrics are not authenticated, so they are only served on localhost unless DYDX_METRICS_HOST is set (for example
+# to 0.0.0.0 inside a container, see docker-compose.yml)
+METRICS_HOST_ENV_VAR = "DYDX_METRICS_HOST"
+METRICS_HOST = "127.0.0.1"
+
+
+def metrics_host() -> str:
+    """Returns the address the metrics are served on."""
+    return os.environ.get(METRICS_HOST_ENV_VAR, METRICS_HOST)
+
+
+def labels_str(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    Thread safe registry of counters, gauges and histograms, rendered in the Prometheus text format.
+
+    Each metric is identified by its name and its labels (keyword arguments). Metrics are created on first use:
+        METRICS.inc("exchange_requests_total", market="BTC-USD")
+        METRICS.set("cycle_lag_seconds", 0.5, table="dydx_candles")
+        with METRICS.time("stage_seconds", stage="download"):
+            ...
+
+    Values only known when scraping (as the db pool stats) can be added with add_collector. Use serve to expose
+    the metrics on http://host:port/metrics.
+    """
+
+    def __init__(self, prefix: str = "dydx_", buckets: tuple = LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+
+        self.lock = threading.Lock()
+        # name: {labels tuple: value}
+        self.counters = {}
+        self.gauges = {}
+        # name: {labels tuple: [bucket counts..., sum, count]}
+        self.histograms = {}
+        self.collectors = []
+
+        self.server = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Adds value to a counter."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """Sets the value of a gauge."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """Adds value to a histogram."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            histogram = values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """Context manager that adds the seconds spent inside to a histogram."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        """Adds a function called on each render. It must return a list of (name, value, labels dict) gauges."""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text format."""
+        gauges = []
+        for collector in list(self.collectors):
+            gauges += collector()
+
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines.append(f"# TYPE {self.prefix}{name} counter")
+                lines += [f"{self.prefix}{name}{labels_str(dict(key))} {value}" for key, value in values.items()]
+
+            collected = {}
+            for name, value, labels in gauges:
+                collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            for name, values in sorted({**self.gauges, **collected}.items()):
+                lines.append(f"# TYPE {self.prefix}{name} gauge")
+                lines += [f"{self.prefix}{name}{labels_str(dict(key))} {value}" for key, value in values.items()]
+
+            for name, values in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {self.prefix}{name} histogram")
+                for key, histogram in values.items():
+                    labels = dict(key)
+                    for bucket, count in zip(self.buckets, histogram):
+                        lines.append(f"{self.prefix}{name}_bucket{labels_str({**labels, 'le': bucket})} {count}")
+                    lines.append(f"{self.prefix}{name}_bucket{labels_str({**labels, 'le': '+Inf'})} {histogram[-1]}")
+                    lines.append(f"{self.prefix}{name}_sum{labels_str(labels)} {histogram[-2]}")
+                    lines.append(f"{self.prefix}{name}_count{labels_str(labels)} {histogram[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9100, host: str = None):
+        """Serves the metrics on http://host:port/metrics from a background thread (host: metrics_host() if None)."""
+        host = host if host else metrics_host()
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics_server", daemon=True).start()
+
+    def close(self):
+        """Stops the metrics server, if any."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# Shared by every module in the process, so all metrics are served together.
+METRICS = Metrics()
@@ -0,0 +1,161 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter, process_time
+
+# Profiling is switched on by setting DYDX_PROFILE=1. DYDX_PROFILE_CYCLE=N profiles the Nth downloader cycle (default 1).
+PROFILE_ENV_VAR = "DYDX_PROFILE"
+PROFILE_CYCLE_ENV_VAR = "DYDX_PROFILE_CYCLE"
+PROFILE_FOLDER = "./data/profiles"
+TRACEMALLOC_FRAMES = 5
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 25
+# From Python 3.12 cProfile is built on sys.monitoring: one profiler covers every thread, and no second can be enabled
+PROFILER_COVERS_THREADS = sys.version_info >= (3, 12)
+
+# Profile running, used by profile_stage. Only one profile can run at a time.
+ACTIVE_PROFILE = None
+
+
+def profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+def profile_cycle() -> int:
+    """Returns the number (starting at 1) of the downloader cycle to profile."""
+    return int(os.environ.get(PROFILE_CYCLE_ENV_VAR, "1"))
+
+
+class Profile:
+    """
+    CPU and memory profile of a block of code, written to folder_path/name_date/ when it ends:
+        cpu.prof                        cProfile stats (open with pstats or snakeviz)
+        cpu.txt                         top TOP_FUNCTIONS functions by cumulative time
+        memory_{n}_{stage}.tracemalloc  tracemalloc snapshot at the end of each stage (open with tracemalloc)
+        stages.json                     wall time, cpu time, traced memory (current and peak) and top allocations
+                                        added during each stage
+
+    Use it as a context manager, and annotate the stages inside with profile_stage. Threads running inside are
+    profiled too, and their stats are merged with the ones of the thread that started the profile. Before Python 3.12
+    only the threads started inside are, by a profiler of their own (see profile_thread).
+    """
+
+    def __init__(self, name: str, folder_path: str = PROFILE_FOLDER, logger=None):
+        self.name = name
+        self.folder_path = os.path.join(folder_path, f"{name}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}")
+        self.logger = logger
+
+        self.profiler = cProfile.Profile()
+        self.thread_profilers = []
+        self.lock = threading.Lock()
+
+        self.stages = []
+        self.last_snapshot = None
+
+    def profile_thread(self, frame, event, arg):
+        """Installed with threading.setprofile before Python 3.12, it starts a new profiler on each thread started.
+        The profiler replaces this hook on the thread. If it can not be enabled, the thread is not profiled.
+        """
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            sys.setprofile(None)
+            if self.logger:
+                self.logger.warning(f"Unable to profile thread {threading.current_thread().name}: {e}")
+            return
+        with self.lock:
+            self.thread_profilers.append(profiler)
+
+    def start(self):
+        global ACTIVE_PROFILE
+        ACTIVE_PROFILE = self
+
+        os.makedirs(self.folder_path, exist_ok=True)
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.last_snapshot = tracemalloc.take_snapshot()
+        if not PROFILER_COVERS_THREADS:
+            threading.setprofile(self.profile_thread)
+        self.profiler.enable()
+
+    def stop(self):
+        global ACTIVE_PROFILE
+        self.profiler.disable()
+        if not PROFILER_COVERS_THREADS:
+            threading.setprofile(None)
+        tracemalloc.stop()
+        ACTIVE_PROFILE = None
+
+        self.profiler.create_stats()
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            for profiler in self.thread_profilers:
+                profiler.create_stats()
+                stats.add(profiler)
+        stats.dump_stats(os.path.join(self.folder_path, "cpu.prof"))
+
+        output = io.StringIO()
+        pstats.Stats(os.path.join(self.folder_path, "cpu.prof"), stream=output).sort_stats("cumulative").print_stats(
+            TOP_FUNCTIONS
+        )
+        with open(os.path.join(self.folder_path, "cpu.txt"), "w") as f:
+            f.write(output.getvalue())
+
+        with open(os.path.join(self.folder_path, "stages.json"), "w") as f:
+            json.dump(self.stages, f, indent=2)
+
+        if self.logger:
+            self.logger.info(f"Profile {self.name} saved on {self.folder_path}.")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager that records the time and memory allocated by the code inside as stage name."""
+        tracemalloc.reset_peak()
+        start, cpu_start = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            seconds, cpu_seconds = perf_counter() - start, process_time() - cpu_start
+            current, peak = tracemalloc.get_traced_memory()
+
+            # The snapshots taken by the profile are not counted
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            snapshot.dump(os.path.join(self.folder_path, f"memory_{len(self.stages) + 1}_{name}.tracemalloc"))
+            top_allocations = snapshot.compare_to(self.last_snapshot, "lineno")[:TOP_ALLOCATIONS]
+            self.last_snapshot = snapshot
+
+            self.stages.append(
+                {
+                    "stage": name,
+                    "seconds": seconds,
+                    "cpu_seconds": cpu_seconds,
+                    "memory_current": current,
+                    "memory_peak": peak,
+                    "top_allocations": [str(stat) for stat in top_allocations],
+                }
+            )
+
+
+@contextmanager
+def profile_stage(name: str):
+    """Annotates the code inside as stage name of the running profile. Does nothing if no profile is running."""
+    if ACTIVE_PROFILE is None:
+        yield
+        return
+
+    with ACTIVE_PROFILE.stage(name):
+        yield
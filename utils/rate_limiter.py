@@ -0,0 +1,94 @@
+import asyncio
+import random
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Returns the seconds to wait before retry number attempt (starting at 0), using exponential backoff with full
+    jitter, so clients throttled at the same time do not retry at the same time."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class SlidingWindowLimiter:
+    """
+    Thread safe rate limiter that allows at most capacity calls in any window of period seconds.
+
+    A token bucket refilled at capacity / period would allow up to twice capacity calls in a window (a full bucket plus
+    the tokens refilled meanwhile), so the start time of the last capacity calls is kept instead (a sliding window
+    log): each call starts once the call capacity calls before it is period seconds old.
+
+    Call acquire (or await acquire_async from a coroutine) before each request, it waits until the request can be sent.
+    Both methods share the same window, so threads and coroutines can be mixed.
+
+    Counters for requests, waits, throttles (429 responses) and retries are kept to check how close to the limit the
+    limiter is running. Use stats to get them.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+
+        self.lock = threading.Lock()
+        # Start times (monotonic) of the last capacity calls, in order
+        self.starts = deque(maxlen=capacity)
+
+        self.requests = 0
+        self.waits = 0
+        self.throttles = 0
+        self.retries = 0
+
+    def _reserve(self) -> float:
+        """Reserves the start time of a call and returns the seconds to wait until it."""
+        with self.lock:
+            now = monotonic()
+            start = now
+            if len(self.starts) == self.capacity:
+                start = max(now, self.starts[0] + self.period)
+            self.starts.append(start)
+
+            self.requests += 1
+            if start <= now:
+                return 0.0
+
+            self.waits += 1
+            return start - now
+
+    def acquire(self):
+        """Blocks until the request can be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            sleep(wait)
+
+    async def acquire_async(self):
+        """Waits without blocking the event loop until the request can be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def throttled(self):
+        """Registers a throttled request. The window is filled as if capacity calls had been evenly spread over the last
+        period, so every caller slows down to capacity / period calls per second, not only the throttled one."""
+        with self.lock:
+            self.throttles += 1
+            now = monotonic()
+            starts = [float("-inf")] * (self.capacity - len(self.starts)) + list(self.starts)
+            self.starts.extend(
+                max(start, now - self.period + (i + 1) * self.period / self.capacity) for i, start in enumerate(starts)
+            )
+
+    def retried(self):
+        """Registers a retried request."""
+        with self.lock:
+            self.retries += 1
+
+    def stats(self) -> dict:
+        """Returns the counters of the limiter."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "waits": self.waits,
+                "throttles": self.throttles,
+                "retries": self.retries,
+            }
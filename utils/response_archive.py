@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Iterator, Union
+from uuid import uuid4
+
+
+class ResponseArchive:
+    """
+    Append-only archive of the raw candle pages received from the exchange, used to rebuild the candle tables without
+    downloading them again (see apps/dydx_candles_downloader/reingest.py).
+
+    Pages are stored on folder_path as segment files (.gz), each page compressed as a separate gzip member, so a segment
+    can be appended to and read back page by page. Each segment has an index file (.idx) with one json line per page:
+    market, resolution, first and last candle, time received, and offset and length of the page inside the segment.
+    The page is written before its index line, so the index never points to data that is not on disk.
+
+    Every ResponseArchive writes its own segments, named with the time it was created, so several processes can
+    archive into the same folder. A new segment is started when the current one reaches segment_size bytes.
+    """
+
+    def __init__(self, folder_path: str = "./data/archive", segment_size: int = 64 * 1024**2):
+        self.folder_path = folder_path
+        self.segment_size = segment_size
+
+        self.lock = threading.Lock()
+        self.prefix = f"{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}_{uuid4().hex[:6]}"
+        self.segment_number = 0
+        self.segment_path = None
+
+        os.makedirs(folder_path, exist_ok=True)
+
+    def next_segment(self):
+        self.segment_number += 1
+        self.segment_path = os.path.join(self.folder_path, f"{self.prefix}_{self.segment_number:04d}.gz")
+
+    def append(self, market: str, resolution: str, candles: list) -> None:
+        """Archives a page of raw candles of market, as received from the exchange. Empty pages are skipped."""
+        if not candles:
+            return
+
+        received = datetime.now(timezone.utc)
+        dates = [candle["startedAt"] for candle in candles]
+        data = gzip.compress(json.dumps(candles, separators=(",", ":")).encode(), compresslevel=6)
+
+        with self.lock:
+            if self.segment_path is None or os.path.getsize(self.segment_path) >= self.segment_size:
+                self.next_segment()
+
+            with open(self.segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+
+            entry = {
+                "market": market,
+                "resolution": resolution,
+                "first_candle": min(dates),
+                "last_candle": max(dates),
+                "received": received.isoformat(),
+                "offset": offset,
+                "length": len(data),
+            }
+            with open(self.segment_path[:-3] + ".idx", "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def read_index(self) -> list:
+        """Returns the index entries of all the segments, in the order they were received. Each entry has the segment
+        path too. Entries of pages not fully written (an interrupted append) are skipped."""
+        entries = []
+        for file_name in sorted(os.listdir(self.folder_path)):
+            if not file_name.endswith(".idx"):
+                continue
+
+            segment_path = os.path.join(self.folder_path, file_name[:-4] + ".gz")
+            segment_size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            with open(os.path.join(self.folder_path, file_name), "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["offset"] + entry["length"] <= segment_size:
+                        entries.append({**entry, "segment": segment_path})
+
+        return sorted(entries, key=lambda entry: entry["received"])
+
+    def find_pages(
+        self,
+        market_list: Union[tuple, list, str] = None,
+        resolution: str = None,
+        start: datetime = None,
+        end: datetime = None,
+    ) -> list:
+        """Returns the index entries of the pages of market_list and resolution with candles between start and end
+        dates, in the order they were received. None matches everything."""
+        market_list = [market_list] if isinstance(market_list, str) else market_list
+
+        entries = []
+        for entry in self.read_index():
+            if market_list is not None and entry["market"] not in market_list:
+                continue
+            if resolution is not None and entry["resolution"] != resolution:
+                continue
+            if start is not None and datetime.fromisoformat(entry["last_candle"]) < start:
+                continue
+            if end is not None and datetime.fromisoformat(entry["first_candle"]) > end:
+                continue
+            entries.append(entry)
+
+        return entries
+
+    @staticmethod
+    def read_page(entry: dict) -> list:
+        """Returns the raw candles of the page of an index entry."""
+        with open(entry["segment"], "rb") as f:
+            f.seek(entry["offset"])
+            return json.loads(gzip.decompress(f.read(entry["length"])))
+
+    def iter_pages(
+        self,
+        market_list: Union[tuple, list, str] = None,
+        resolution: str = None,
+        start: datetime = None,
+        end: datetime = None,
+    ) -> Iterator[list]:
+        """Yields the raw candles of each page found by find_pages, in the order they were received."""
+        for entry in self.find_pages(market_list, resolution, start, end):
+            yield self.read_page(entry)